@@ -0,0 +1,89 @@
+"""
+    Benchmark how the time to build the ticket index scales with the number of tickets.
+
+    Compares adding synthetic ticket metadata one row at a time with `df.loc` (how the index used to
+    be built) against building it in one step with `zendesk_wrapper.IndexBuilder`.
+
+    Usage:
+        python benchmark_index.py [--sizes 1000 10000 100000] [--max_loc 20000]
+"""
+import datetime
+import os
+import random
+import time
+from argparse import ArgumentParser
+
+# zendesk_wrapper needs Zendesk credentials to be importable. This benchmark makes no API calls.
+for key in ["ZENDESK_USER", "ZENDESK_TOKEN", "ZENDESK_SUBDOMAIN"]:
+    os.environ.setdefault(key, "benchmark")
+
+from config import RANDOM_SEED
+from utils import since
+from zendesk_wrapper import IndexBuilder, make_empty_index, format_index_df, panderise_date
+
+STATUSES = ["new", "open", "pending", "hold", "solved", "closed"]
+PRIORITIES = ["low", "normal", "high", "urgent"]
+
+def make_metadata(ticket_number, rng):
+    "Returns synthetic metadata, shaped like extract_metadata() output, for ticket `ticket_number`."
+    created_at = datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=ticket_number)
+    updated_at = created_at + datetime.timedelta(hours=rng.randint(1, 1_000))
+    return {
+        "created_at": panderise_date(created_at),
+        "updated_at": panderise_date(updated_at),
+        "status": rng.choice(STATUSES),
+        "priority": rng.choice(PRIORITIES),
+        "recipient": "support@example.com",
+        "subject": f"Synthetic ticket {ticket_number}",
+        "custom_fields": {25019086: rng.choice(["Mobility Print", "Print Deploy", "MF"])},
+        "comments_num": rng.randint(1, 30),
+        "comments_size": rng.randint(100, 100_000),
+    }
+
+def index_with_loc(metadata_list):
+    "Builds the index by inserting one row at a time."
+    df = make_empty_index(add_custom_fields=True)
+    for ticket_number, metadata in metadata_list:
+        df.loc[ticket_number] = metadata
+    return format_index_df(df)
+
+def index_with_builder(metadata_list):
+    "Builds the index from column buffers in one step."
+    df = make_empty_index(add_custom_fields=True)
+    builder = IndexBuilder(df.columns)
+    for ticket_number, metadata in metadata_list:
+        builder.add(ticket_number, metadata)
+    return builder.merge_into(df)
+
+def time_func(func, metadata_list):
+    "Returns the seconds taken to run `func` on `metadata_list` and the resulting DataFrame."
+    t0 = time.time()
+    df = func(metadata_list)
+    return since(t0), df
+
+def main():
+    parser = ArgumentParser(description="Benchmark building the ticket index.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000],
+        help="Numbers of tickets to index.")
+    parser.add_argument("--max_loc", type=int, default=20_000,
+        help="Largest number of tickets to index one row at a time. It is quadratic.")
+    args = parser.parse_args()
+
+    rng = random.Random(RANDOM_SEED)
+    print(f"{'tickets':>9} {'loc secs':>9} {'bulk secs':>9} {'loc/10k':>8} {'bulk/10k':>8} {'speedup':>8}")
+    for size in args.sizes:
+        metadata_list = [(1_000_000 + i, make_metadata(i, rng)) for i in range(size)]
+        bulk_secs, bulk_df = time_func(index_with_builder, metadata_list)
+        assert len(bulk_df) == size, (len(bulk_df), size)
+        bulk_per_10k = 10_000 * bulk_secs / size
+        if size <= args.max_loc:
+            loc_secs, loc_df = time_func(index_with_loc, metadata_list)
+            assert loc_df.index.equals(bulk_df.index)
+            loc_per_10k = 10_000 * loc_secs / size
+            print(f"{size:9} {loc_secs:9.2f} {bulk_secs:9.2f} {loc_per_10k:8.2f} {bulk_per_10k:8.2f} " +
+                  f"{loc_secs / bulk_secs:7.1f}x")
+        else:
+            print(f"{size:9} {'-':>9} {bulk_secs:9.2f} {'-':>8} {bulk_per_10k:8.2f} {'-':>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+    Benchmark ticket ingestion against a local fake Zendesk API, without calling Zendesk.
+
+    Starts a fake_zendesk.FakeZendeskServer, points zendesk_wrapper at it and a fresh temporary data
+    directory, then times
+    - update_index() fetching, downloading the comments of and indexing every listed ticket, and
+    - add_tickets_to_index() adding tickets that weren't in the listing,
+    and reports tickets/sec and requests/sec for each.
+
+    Usage:
+        python benchmark_ingest.py [--tickets 2000] [--add 200] [--latency 0.05] [--rate_limit 0]
+                                   [--shards 8]
+"""
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from fake_zendesk import FakeZendesk, FakeZendeskServer
+
+def report(name, num_tickets, num_requests, secs):
+    print(f"{name:22} {num_tickets:8} {num_requests:9} {secs:8.1f} " +
+          f"{num_tickets / secs:12.1f} {num_requests / secs:13.1f}")
+
+def main():
+    parser = ArgumentParser(description="Benchmark ticket ingestion against a fake Zendesk API.")
+    parser.add_argument("--tickets", type=int, default=2_000, help="Number of tickets to index.")
+    parser.add_argument("--add", type=int, default=200,
+        help="Number of tickets to add with add_tickets_to_index().")
+    parser.add_argument("--comments", type=int, default=10, help="Mean number of comments per ticket.")
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="Seconds the fake server takes to respond.")
+    parser.add_argument("--rate_limit", type=int, default=0,
+        help="Requests per minute before the fake server responds 429. 0 for no limit.")
+    parser.add_argument("--client_rate", type=int, default=100_000,
+        help="ZENDESK_REQUESTS_PER_MINUTE for the client.")
+    parser.add_argument("--workers", type=int, default=0,
+        help="Threads used to download comments. Defaults to NUM_DOWNLOAD_WORKERS.")
+    parser.add_argument("--shards", type=int, default=0,
+        help="Fetch the tickets in this many date shards. See fetch_sharded_ticket_batches().")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary data directory.")
+    args = parser.parse_args()
+
+    corpus = FakeZendesk(args.tickets, args.add, args.comments)
+    server = FakeZendeskServer(corpus, latency=args.latency, rate_limit=args.rate_limit)
+    server.start()
+    file_root = tempfile.mkdtemp(prefix="zendesk_benchmark_")
+
+    # zendesk_wrapper reads these when it is imported.
+    os.environ["ZENDESK_API_URL"] = server.api_url()
+    os.environ["ZENDESK_FILE_ROOT"] = file_root
+    os.environ["ZENDESK_REQUESTS_PER_MINUTE"] = str(args.client_rate)
+    for key in ["ZENDESK_USER", "ZENDESK_TOKEN", "ZENDESK_SUBDOMAIN"]:
+        os.environ.setdefault(key, "benchmark")
+    import zendesk_wrapper
+    from zendesk_wrapper import load_create_index, update_index, add_tickets_to_index
+
+    num_workers = args.workers or zendesk_wrapper.NUM_DOWNLOAD_WORKERS
+    print(f"Benchmarking ingestion of {args.tickets} + {args.add} tickets from {server.api_url()} " +
+          f"into {file_root} with {num_workers} workers, {args.latency} secs latency")
+    try:
+        df = load_create_index(add_custom_fields=True)
+
+        t0 = time.time()
+        n0 = server.num_requests()
+        df, _, _ = update_index(df, do_fetch=True, num_workers=num_workers, num_shards=args.shards)
+        update_secs, update_requests = time.time() - t0, server.num_requests() - n0
+        assert len(df) == args.tickets, (len(df), args.tickets)
+
+        t0 = time.time()
+        n0 = server.num_requests()
+        df, new_numbers, bad_numbers = add_tickets_to_index(df, list(corpus.ticket_numbers(unlisted=True)))
+        add_secs, add_requests = time.time() - t0, server.num_requests() - n0
+        assert len(new_numbers) == args.add and not bad_numbers, (len(new_numbers), bad_numbers)
+
+        print()
+        print(f"{'stage':22} {'tickets':>8} {'requests':>9} {'secs':>8} {'tickets/sec':>12} {'requests/sec':>13}")
+        report("update_index", args.tickets, update_requests, update_secs)
+        report("add_tickets_to_index", args.add, add_requests, add_secs)
+        print(f"Requests by endpoint: {dict(server.request_counts)}")
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(file_root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+    Benchmark finding similar tickets for many tickets in one batch against one ticket at a time.
+
+    Finds the closest tickets to N tickets with
+    - N single query pipeline runs (what GET /similar_tickets/{id} does for an uncached ticket), and
+    - one HaystackQueryEngine.find_closest_batch() call (what POST /similar_tickets does),
+    bypassing the cached results, and reports the latency of each, the Jina requests made and how
+    often their results agree.
+
+    By default this runs on synthetic tickets and summaries in a temporary data directory against a
+    fake_jina.FakeJinaServer, so it needs no Jina API key or LLM. --real runs it on the configured
+    data with the Jina API and the model's Chroma index, loaded by a SimilarityService as server.py
+    does. That needs JINA_API_KEY.
+
+    Usage:
+        python benchmark_similarity.py [--tickets 10 50 100] [--top_k 3] [--corpus 2000]
+                                       [--latency 0.05] [--text_latency 0.002]
+        python benchmark_similarity.py --real [--model claude] [--tickets 10 50 100]
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from fake_jina import FakeJinaServer
+
+# Topics of the synthetic tickets. Tickets on the same topic share most of their summary words.
+TOPICS = [
+    "printer queue driver job failed windows",
+    "secure release card swipe user login",
+    "mobility print client install mac network",
+    "print deploy server upgrade license error",
+    "scan to email timeout restart smtp",
+    "hive cloud connector offline sync",
+]
+FILLER = ("log restart service config update version customer site device report issue check " +
+          "setting page colour duplex tray toner account group quota balance").split()
+
+def make_summary(rng, topic, section_names, divider):
+    "Returns a synthetic feature summary of a ticket on `topic` in the format SummaryReader reads."
+    lines = []
+    for name in section_names:
+        words = topic.split() + rng.sample(FILLER, 4)
+        rng.shuffle(words)
+        lines += [f"{divider} {name}", " ".join(words), ""]
+    return "\n".join(lines)
+
+def make_fake_data(num_tickets, model, rng):
+    """ Saves an index of `num_tickets` synthetic tickets and their feature summaries for LLM `model`.
+        Returns the index.
+    """
+    from llama_index.core.llms import MockLLM
+    from config import DIVIDER
+    from utils import save_text
+    from zendesk_wrapper import IndexBuilder, make_empty_index, save_index
+    from rag_classifier import PydanticFeatureGenerator
+    from reranker import SECTION_NAMES
+    from benchmark_index import make_metadata
+
+    df = make_empty_index(add_custom_fields=True)
+    builder = IndexBuilder(df.columns)
+    summariser = PydanticFeatureGenerator(MockLLM(), model)
+    for i in range(num_tickets):
+        ticket_number = 1_000_000 + i
+        topic = TOPICS[i % len(TOPICS)]
+        metadata = make_metadata(i, rng)
+        metadata["subject"] = topic
+        builder.add(ticket_number, metadata)
+        save_text(summariser.summary_path(ticket_number),
+                  make_summary(rng, topic, SECTION_NAMES, DIVIDER))
+    df = builder.merge_into(df)
+    save_index(df)
+    return df
+
+def main():
+    parser = ArgumentParser(description="Benchmark batch against single similar ticket lookups.")
+    parser.add_argument("--real", action="store_true",
+        help="Use the configured data and the Jina API instead of synthetic data and a fake Jina API.")
+    parser.add_argument("--model", type=str, required=False,
+        help="LLM model name for --real. Defaults to the first of LLM_MODELS.")
+    parser.add_argument("--tickets", type=int, nargs="+", default=[10, 50, 100],
+        help="Numbers of tickets to look up.")
+    parser.add_argument("--top_k", type=int, default=3, help="Number of closest tickets to return.")
+    parser.add_argument("--corpus", type=int, default=2_000, help="Number of synthetic tickets.")
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="Seconds the fake Jina API takes to respond.")
+    parser.add_argument("--text_latency", type=float, default=0.002,
+        help="Seconds the fake Jina API takes per text embedded or document reranked.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary data directory.")
+    args = parser.parse_args()
+
+    server = None
+    file_root = None
+    if not args.real:
+        server = FakeJinaServer(latency=args.latency, text_latency=args.text_latency)
+        server.start()
+        file_root = tempfile.mkdtemp(prefix="similarity_benchmark_")
+        # config.py reads these when it is imported.
+        os.environ["JINA_API_URL"] = server.api_url()
+        os.environ["ZENDESK_FILE_ROOT"] = file_root
+        os.environ.setdefault("JINA_API_KEY", "benchmark")
+        for key in ["ZENDESK_USER", "ZENDESK_TOKEN", "ZENDESK_SUBDOMAIN"]:
+            os.environ.setdefault(key, "benchmark")
+    from config import RANDOM_SEED
+    from utils import since, match_key, print_exit
+    from models import LLM_MODELS
+
+    rng = random.Random(RANDOM_SEED)
+    t0 = time.time()
+    if args.real:
+        from similarity_service import SimilarityService
+        model_name = match_key(LLM_MODELS, args.model) if args.model else None
+        if args.model and not model_name:
+            print_exit(f"Unknown model '{args.model}'")
+        service = SimilarityService(model_name)
+        service.load()
+        query_engine = service.query_engine
+    else:
+        from llama_index.core.llms import MockLLM
+        from reranker import QueryEngine
+        model = "benchmark"
+        df = make_fake_data(args.corpus, model, rng)
+        query_engine = QueryEngine(df, MockLLM(), model)
+        print(f"Indexed {args.corpus} synthetic tickets in {file_root}, fake Jina API at " +
+              f"{server.api_url()} with {args.latency} + {args.text_latency} secs per text latency")
+    print(f"Loaded the query engine in {since(t0):.1f} secs")
+    hsqe = query_engine.hsqe
+    all_numbers = list(query_engine.ticket_numbers())
+
+    # Warm up both paths, so the first row doesn't include one-off setup costs.
+    warm_up = all_numbers[0]
+    hsqe.find_closest_tickets(warm_up, args.top_k)
+    hsqe.find_closest_batch([(warm_up, hsqe.ticket_content(warm_up))], args.top_k)
+
+    print(f"{'tickets':>8} {'single secs':>12} {'batch secs':>11} {'speedup':>8} " +
+          f"{'single reqs':>12} {'batch reqs':>11} {'agree':>6}")
+    for num_tickets in args.tickets:
+        ticket_numbers = rng.sample(all_numbers, min(num_tickets, len(all_numbers)))
+
+        requests0 = sum(server.request_counts.values()) if server else 0
+        t0 = time.time()
+        single = [hsqe.find_closest_tickets(t, args.top_k) for t in ticket_numbers]
+        single_secs = since(t0)
+        requests1 = sum(server.request_counts.values()) if server else 0
+
+        t0 = time.time()
+        queries = [(t, hsqe.ticket_content(t)) for t in ticket_numbers]
+        batch = hsqe.find_closest_batch(queries, args.top_k)
+        batch_secs = since(t0)
+        requests2 = sum(server.request_counts.values()) if server else 0
+
+        # The fraction of the tickets for which both lookups found the same closest tickets.
+        agree = sum([t for t, _ in s] == [t for t, _ in b] for s, b in zip(single, batch))
+        print(f"{len(ticket_numbers):8} {single_secs:12.2f} {batch_secs:11.2f} " +
+              f"{single_secs / batch_secs:7.1f}x {requests1 - requests0:12} " +
+              f"{requests2 - requests1:11} {agree / len(ticket_numbers):6.2f}")
+
+    if server:
+        server.shutdown()
+    if file_root and not args.keep:
+        shutil.rmtree(file_root)
+
+if __name__ == "__main__":
+    main()
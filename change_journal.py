@@ -0,0 +1,118 @@
+"""
+    An append-only journal of ticket changes, written by ingestion and read by the downstream
+    stages such as summarisation, Chroma indexing and the server.
+
+    Each line of the journal is a JSON event
+        {"type": <event type>, "ticket_number": <int>, "updated_at": <Zendesk updated_at>, "time": <Unix time>}
+    where the event type is one of EVENT_TYPES. Events may also have the ticket's "created_at", which
+    tells a consumer which month partition of the index holds the ticket. Older events don't.
+
+    Each consumer (a stage) saves the byte offset in the journal up to which it has processed the
+    events, one JSON file per consumer in the offsets directory. A stage reads only the events
+    after its offset with pending() or pending_tickets(), processes them and then calls commit()
+    with the end offset those returned, so the events are processed again if the stage crashes
+    before committing. Consumers in different processes don't share an offset file.
+"""
+import json
+import os
+import threading
+import time
+from utils import load_json, save_json
+
+TICKET_CREATED = "ticket_created"
+COMMENT_ADDED = "comment_added"
+TICKET_UPDATED = "ticket_updated"
+TICKET_DELETED = "ticket_deleted"
+EVENT_TYPES = [TICKET_CREATED, COMMENT_ADDED, TICKET_UPDATED, TICKET_DELETED]
+
+class ChangeJournal:
+    """
+    The change journal `path` and the offsets of its consumers in directory `offsets_dir`.
+    """
+    def __init__(self, path, offsets_dir):
+        self.path = path
+        self.offsets_dir = offsets_dir
+        self.lock = threading.Lock()
+
+    def append(self, events):
+        """ Appends `events`, a list of (event_type, ticket_number, updated_at) or
+            (event_type, ticket_number, updated_at, created_at) tuples, to the journal.
+            The events are synced to disk before this returns.
+        """
+        if not events:
+            return
+        now = int(time.time())
+        lines = []
+        for event_type, ticket_number, updated_at, *created_at in events:
+            assert event_type in EVENT_TYPES, event_type
+            event = {"type": event_type, "ticket_number": int(ticket_number),
+                     "updated_at": str(updated_at), "time": now}
+            if created_at and created_at[0] is not None:
+                event["created_at"] = str(created_at[0])
+            lines.append(json.dumps(event) + "\n")
+        with self.lock:
+            # Start a new line after a partly written event, from a crash while appending.
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        lines.insert(0, "\n")
+            with open(self.path, "a") as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _offset_path(self, consumer):
+        return os.path.join(self.offsets_dir, f"{consumer}.json")
+
+    def offset(self, consumer):
+        "Returns the journal offset up to which `consumer` has processed the events."
+        path = self._offset_path(consumer)
+        return load_json(path)["offset"] if os.path.exists(path) else 0
+
+    def commit(self, consumer, offset):
+        "Records that `consumer` has processed the events up to journal offset `offset`."
+        os.makedirs(self.offsets_dir, exist_ok=True)
+        save_json(self._offset_path(consumer), {"offset": offset, "committed_at": int(time.time())})
+
+    def read(self, offset=0):
+        """ Returns (events, end_offset) for the events in the journal after `offset`, where
+            `end_offset` is the offset after the last complete event. A partly written last line is
+            left for the next read, and partly written lines before it are skipped.
+        """
+        if not os.path.exists(self.path):
+            return [], 0
+        if offset > os.path.getsize(self.path):
+            print(f"{self.path} is shorter than offset {offset}. Reading it from the start.")
+            offset = 0
+        events = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping a partly written event in {self.path}")
+        return events, offset
+
+    def pending(self, consumer):
+        "Returns (events, end_offset) for the events that `consumer` hasn't processed."
+        return self.read(self.offset(consumer))
+
+    def pending_tickets(self, consumer, event_types=None, include_deleted=False):
+        """ Returns (ticket_numbers, end_offset) where `ticket_numbers` are the sorted numbers of the
+            tickets with events of `event_types` (default all types) that `consumer` hasn't
+            processed. Tickets whose last event is TICKET_DELETED are left out unless
+            `include_deleted` is True.
+        """
+        events, end_offset = self.pending(consumer)
+        last_type = {}
+        for event in events:
+            if event_types is None or event["type"] in event_types or event["type"] == TICKET_DELETED:
+                last_type[event["ticket_number"]] = event["type"]
+        ticket_numbers = [t for t, event_type in last_type.items()
+                          if include_deleted or event_type != TICKET_DELETED]
+        return sorted(ticket_numbers), end_offset
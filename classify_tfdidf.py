@@ -1,4 +1,3 @@
-import ast
 from collections import defaultdict
 import random
 import sys
@@ -12,7 +11,9 @@ from sklearn.metrics import f1_score, confusion_matrix
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from sklearn.utils import check_random_state
-from config import CUSTOM_FIELDS_KEY, RANDOM_SEED
+from config import RANDOM_SEED
+from index_store import custom_field_value
+from zendesk_wrapper import ticket_comments
 from config_keywords import PRODUCT_KINDS
 from utils import load_text, truncate, round_score, SummaryReader, directory_ticket_numbers
 
@@ -32,12 +33,12 @@ def avoidable(text):
     "Ensure that the text is not a conversation or chat."
     return any(text.startswith(s) for s in AVOID)
 
-def load_comments(paths, subject, max_comments=2, max_size=100_000_000):
+def load_comments(ticket_number, subject, max_comments=2, max_size=100_000_000):
     """
-    Load comments from multiple paths and concatenate them into a single text.
+    Load the comments of a ticket and concatenate them into a single text.
 
     Args:
-        paths (list): A list of file paths to load comments from.
+        ticket_number (int): The number of the ticket to load comments from.
         subject (str): The subject of the comments.
         max_size (int, optional): The maximum size of the concatenated text. Defaults to 100_000_000.
 
@@ -46,8 +47,7 @@ def load_comments(paths, subject, max_comments=2, max_size=100_000_000):
     """
     texts = [f"{subject}::-::"]
     size = 0
-    for path in paths:
-        text = load_text(path)
+    for _, text in ticket_comments(ticket_number):
         if avoidable(text):
             continue
         texts.append(text)
@@ -84,9 +84,7 @@ def data_to_Xy(data_list, get_features):
         subject = meta["subject"]
         if avoidable(subject):
             continue
-        fields = meta[CUSTOM_FIELDS_KEY]
-        fields = ast.literal_eval(fields)
-        product_name = fields.get(25019086)
+        product_name = custom_field_value(meta, 25019086)
         if not product_name:
             continue
         product_kind = None
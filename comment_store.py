@@ -0,0 +1,177 @@
+"""
+    Storage backends for downloaded ticket comments.
+
+    - FileCommentStore saves one text file per comment in one directory per ticket.
+    - PackedCommentStore appends comments to a few large segment files and keeps the ticket number,
+      comment number, segment, offset and length of each comment in an SQLite offset index.
+      Comments may be zlib compressed. This avoids millions of tiny files and a directory glob for
+      every ticket.
+
+    Both stores number comments by their position in the Zendesk ticket, so new comments can be
+    appended to a ticket, and both return comments as (name, text) pairs in comment order.
+"""
+import glob
+import os
+import sqlite3
+import threading
+import zlib
+from utils import save_text, load_text
+
+def _comment_name(i):
+    return f"comment_{i:03d}"
+
+def _comment_number(path):
+    "Returns the comment number in file name `path`. Numbers above 999 are wider than the padding."
+    return int(os.path.basename(path)[len("comment_"):-len(".txt")])
+
+class FileCommentStore:
+    "Saves the comments of each ticket as `comments_dir`/ticket_number/comment_NNN.txt files."
+    def __init__(self, comments_dir):
+        self.comments_dir = comments_dir
+        os.makedirs(comments_dir, exist_ok=True)
+
+    def ticket_dir(self, ticket_number):
+        return os.path.abspath(os.path.join(self.comments_dir, f"{ticket_number}"))
+
+    def comment_paths(self, ticket_number):
+        "Returns the file paths of the comments in ticket `ticket_number` in comment order."
+        paths = glob.glob(os.path.join(self.ticket_dir(ticket_number), "comment_*.txt"))
+        return sorted(paths, key=_comment_number)
+
+    def has_ticket(self, ticket_number):
+        return os.path.exists(self.ticket_dir(ticket_number))
+
+    def ticket_numbers(self):
+        "Returns the numbers of the tickets with saved comments."
+        names = os.listdir(self.comments_dir)
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def num_comments_saved(self, ticket_number):
+        "Returns the number of ticket comments that the saved comments were numbered from."
+        numbers = [_comment_number(path) for path in self.comment_paths(ticket_number)]
+        return max(numbers) + 1 if numbers else 0
+
+    def save_comments(self, ticket_number, numbered_texts):
+        "Saves the (comment number, text) pairs in `numbered_texts` for ticket `ticket_number`."
+        if not numbered_texts:
+            return
+        folder = self.ticket_dir(ticket_number)
+        os.makedirs(folder, exist_ok=True)
+        for i, text in numbered_texts:
+            save_text(os.path.join(folder, f"{_comment_name(i)}.txt"), text)
+
+    def comments(self, ticket_number):
+        "Returns the (path, text) pairs of the comments in ticket `ticket_number`."
+        return [(path, load_text(path)) for path in self.comment_paths(ticket_number)]
+
+    def comment_sizes(self, ticket_number):
+        "Returns the sizes in bytes of the comments in ticket `ticket_number`."
+        return [os.path.getsize(path) for path in self.comment_paths(ticket_number)]
+
+# Start a new segment file when the current one is bigger than this.
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+class PackedCommentStore:
+    """
+    Appends the comments of all tickets to segment files `store_dir`/segment_NNNNN.dat and records
+    where each comment is in the offset index `store_dir`/index.sqlite.
+    Comments are zlib compressed if `compress` is True.
+    Rewriting a comment appends the new text and points the offset index at it.
+    """
+    def __init__(self, store_dir, compress=True):
+        self.store_dir = store_dir
+        self.compress = compress
+        os.makedirs(store_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(store_dir, "index.sqlite"), check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS comments (
+                ticket_number INTEGER, comment_number INTEGER,
+                segment INTEGER, offset INTEGER, length INTEGER, size INTEGER, compressed INTEGER,
+                PRIMARY KEY (ticket_number, comment_number))""")
+        self.db.commit()
+        segments = sorted(glob.glob(os.path.join(store_dir, "segment_*.dat")))
+        self.segment = int(os.path.basename(segments[-1])[8:13]) if segments else 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.store_dir, f"segment_{segment:05d}.dat")
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def has_ticket(self, ticket_number):
+        rows = self._query("SELECT 1 FROM comments WHERE ticket_number = ? LIMIT 1", (ticket_number,))
+        return bool(rows)
+
+    def ticket_numbers(self):
+        "Returns the numbers of the tickets with saved comments."
+        rows = self._query("SELECT DISTINCT ticket_number FROM comments ORDER BY ticket_number")
+        return [row[0] for row in rows]
+
+    def num_comments_saved(self, ticket_number):
+        "Returns the number of ticket comments that the saved comments were numbered from."
+        rows = self._query("SELECT MAX(comment_number) FROM comments WHERE ticket_number = ?",
+                           (ticket_number,))
+        return rows[0][0] + 1 if rows and rows[0][0] is not None else 0
+
+    def save_comments(self, ticket_number, numbered_texts):
+        "Appends the (comment number, text) pairs in `numbered_texts` for ticket `ticket_number`."
+        if not numbered_texts:
+            return
+        records = []
+        for i, text in numbered_texts:
+            data = text.encode("utf-8")
+            size = len(data)
+            if self.compress:
+                data = zlib.compress(data)
+            records.append((i, data, size))
+        with self.lock:
+            path = self._segment_path(self.segment)
+            if os.path.exists(path) and os.path.getsize(path) > SEGMENT_SIZE:
+                self.segment += 1
+                path = self._segment_path(self.segment)
+            rows = []
+            # The data is written before the offsets are committed, so a crash can only leave
+            # unreferenced bytes at the end of a segment.
+            with open(path, "ab") as f:
+                for i, data, size in records:
+                    offset = f.tell()
+                    f.write(data)
+                    rows.append((ticket_number, i, self.segment, offset, len(data), size,
+                                 int(self.compress)))
+            self.db.executemany("INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def comments(self, ticket_number):
+        "Returns the (name, text) pairs of the comments in ticket `ticket_number`."
+        rows = self._query("""SELECT comment_number, segment, offset, length, compressed
+                FROM comments WHERE ticket_number = ? ORDER BY comment_number""", (ticket_number,))
+        results = []
+        files = {}
+        try:
+            for i, segment, offset, length, compressed in rows:
+                if segment not in files:
+                    files[segment] = open(self._segment_path(segment), "rb")
+                f = files[segment]
+                f.seek(offset)
+                data = f.read(length)
+                if compressed:
+                    data = zlib.decompress(data)
+                results.append((f"{ticket_number}/{_comment_name(i)}", data.decode("utf-8")))
+        finally:
+            for f in files.values():
+                f.close()
+        return results
+
+    def comment_sizes(self, ticket_number):
+        "Returns the uncompressed sizes in bytes of the comments in ticket `ticket_number`."
+        rows = self._query("""SELECT size FROM comments WHERE ticket_number = ?
+                ORDER BY comment_number""", (ticket_number,))
+        return [row[0] for row in rows]
+
+def make_comment_store(storage, comments_dir, store_dir, compress=True):
+    "Returns the comment store for `storage` which is 'files' or 'packed'."
+    if storage == "packed":
+        return PackedCommentStore(store_dir, compress=compress)
+    assert storage == "files", f"Unknown comment storage '{storage}'"
+    return FileCommentStore(comments_dir)
@@ -4,7 +4,8 @@
 """
 import os
 
-FILE_ROOT = os.path.expanduser("~/zendesk_data")
+# Set ZENDESK_FILE_ROOT to keep the data somewhere else, e.g. for benchmark_ingest.py.
+FILE_ROOT = os.environ.get("ZENDESK_FILE_ROOT") or os.path.expanduser("~/zendesk_data")
 
 # The directory containing the downloaded ticket data.
 DATA_ROOT = os.path.join(FILE_ROOT, "data")
@@ -15,8 +16,61 @@ TICKET_BATCHES_DIR = os.path.join(DATA_ROOT, "ticket_batches")
 # The directory containing the downloaded ticket comments data.
 COMMENTS_DIR = os.path.join(DATA_ROOT, "comments")
 
+# How the downloaded comments are stored: "files" for one text file per comment in COMMENTS_DIR,
+# or "packed" for segment files with an offset index in COMMENT_STORE_DIR.
+# Run migrate_comments.py to copy the comments in COMMENTS_DIR to COMMENT_STORE_DIR.
+COMMENT_STORAGE = "files"
+COMMENT_STORE_DIR = os.path.join(DATA_ROOT, "comment_store")
+# Whether the packed comment store compresses comments.
+COMMENT_STORE_COMPRESS = True
+
+# The full-text index of the downloaded comments, used to filter tickets by pattern.
+COMMENT_SEARCH_INDEX_PATH = os.path.join(DATA_ROOT, "comment_search.sqlite")
+
+# The Zendesk updated_at and number of comments that each ticket's comments were downloaded at.
+COMMENTS_STATE_PATH = os.path.join(DATA_ROOT, "comments_state.json")
+
+# The last fetched copy of each ticket fetched by number, with its ETag.
+TICKET_CACHE_PATH = os.path.join(DATA_ROOT, "ticket_cache.sqlite")
+
+# The Zendesk users who wrote the downloaded comments, keyed by user id.
+AUTHORS_PATH = os.path.join(DATA_ROOT, "authors.json")
+
+# The numbers of the tickets whose comments were downloaded or changed by the last index update.
+CHANGED_TICKETS_PATH = os.path.join(DATA_ROOT, "changed_tickets.json")
+
+# The number and URL of the next page of a full ticket fetch, so an interrupted fetch can resume.
+TICKET_BACKFILL_CHECKPOINT_PATH = os.path.join(DATA_ROOT, "ticket_backfill_checkpoint.json")
+
+# The checkpoints of the shards of a date-sharded ticket fetch, one file per shard.
+TICKET_BACKFILL_SHARDS_DIR = os.path.join(DATA_ROOT, "backfill_shards")
+
+# The journal of ticket changes found by ingestion, and the directory of the journal offsets of the
+# stages that consume it. See change_journal.py.
+CHANGE_JOURNAL_PATH = os.path.join(DATA_ROOT, "change_journal.jsonl")
+CHANGE_JOURNAL_OFFSETS_DIR = os.path.join(DATA_ROOT, "change_journal_offsets")
+
+# The updated_at watermark and incremental export cursor of the server's ticket poller.
+SERVER_POLL_STATE_PATH = os.path.join(DATA_ROOT, "server_poll_state.json")
+
+# The cursor of the last incremental ticket export.
+TICKET_SYNC_CURSOR_PATH = os.path.join(DATA_ROOT, "ticket_sync_cursor.json")
+
 TICKET_INDEX_PATH = os.path.join(DATA_ROOT, "ticket_index.csv")
+TICKET_INDEX_PARQUET_PATH = os.path.join(DATA_ROOT, "ticket_index.parquet")
+# The Parquet ticket index, one file per month of ticket creation dates with a manifest.
+TICKET_INDEX_PARTITIONS_DIR = os.path.join(DATA_ROOT, "ticket_index")
+# The format the ticket index is stored in: "parquet" (needs pyarrow) or "csv".
+INDEX_FORMAT = "parquet"
+# The rows added to the ticket index since it was last saved, one JSON line per row.
+TICKET_INDEX_DELTA_PATH = os.path.join(DATA_ROOT, "ticket_index_delta.jsonl")
+# The number of rows in TICKET_INDEX_DELTA_PATH at which loading the index compacts it.
+INDEX_DELTA_MAX_ROWS = 10_000
 TICKET_ALIASES_PATH = os.path.join(DATA_ROOT, "ticket_aliases.json")
+# Groups of tickets with near-duplicate comments, in the same format as TICKET_ALIASES_PATH.
+TICKET_NEAR_ALIASES_PATH = os.path.join(DATA_ROOT, "ticket_near_aliases.json")
+# The MinHash signatures and LSH buckets used to find near-duplicate tickets.
+NEAR_DUPLICATES_INDEX_PATH = os.path.join(DATA_ROOT, "near_duplicates.sqlite")
 TAGS_JSON_PATH = os.path.join(DATA_ROOT, "tags.json")
 TAGS_CSV_PATH = os.path.join(DATA_ROOT, "tags.csv")
 
@@ -31,6 +85,23 @@ MODEL_ROOT = os.path.join(FILE_ROOT, "reranker.models")
 # The directory where the reranker results are stored.
 SIMILARITIES_ROOT = os.path.join(FILE_ROOT, "similarities")
 
+# The Zendesk API requests per minute allowed by your Zendesk plan. All API calls share this budget.
+# https://developer.zendesk.com/api-reference/introduction/rate-limits/
+# TODO: Update this with your own plan's limit. e.g. Team 200, Professional 400, Enterprise 700.
+ZENDESK_REQUESTS_PER_MINUTE = int(os.environ.get("ZENDESK_REQUESTS_PER_MINUTE", 400))
+
+# The number of ticket updates that server.py handles at the same time, and the number of tickets
+# with queued updates at which the webhook and poller wait for room in the queue.
+NUM_UPDATE_WORKERS = int(os.environ.get("ZENDESK_UPDATE_WORKERS", 4))
+MAX_PENDING_UPDATES = int(os.environ.get("ZENDESK_MAX_PENDING_UPDATES", 1000))
+
+# The Jina API used to embed and rerank tickets, e.g. http://localhost:8001/v1 for fake_jina.py.
+# None for https://api.jina.ai/v1.
+JINA_API_URL = os.environ.get("JINA_API_URL")
+
+# Seconds between the similarity service's refreshes of its index and Chroma document store.
+SIMILARITY_REFRESH_SECS = int(os.environ.get("ZENDESK_SIMILARITY_REFRESH_SECS", 300))
+
 # The name of the company that the tickets are for.
 # TODO: Update this with your company names.
 COMPANY = "PaperCut"
@@ -4,9 +4,10 @@
 """
 import datetime
 from argparse import ArgumentParser
-from config import TICKET_INDEX_PATH, TICKET_ALIASES_PATH
+from config import TICKET_INDEX_PATH, TICKET_ALIASES_PATH, TICKET_BATCHES_DIR
+from ticket_batches import partition_legacy_batches
 from utils import save_json
-from zendesk_wrapper import load_create_index, update_index
+from zendesk_wrapper import load_create_index, update_index, compact_index, NUM_DOWNLOAD_WORKERS
 
 MIN_DATE = None
 MAX_DATE = None
@@ -22,16 +23,38 @@ def main():
     parser = ArgumentParser(description=("Download ticket from Zendesk."))
     parser.add_argument("--no-fetch", action="store_true", help="Don't fetch the tickets.")
     parser.add_argument("--clean", action="store_true", help="Delete current downloaded tickets.")
+    parser.add_argument("--incremental", action="store_true",
+        help="Only fetch the tickets created or updated since the last sync.")
+    parser.add_argument("--resume", action="store_true",
+        help="Continue an interrupted fetch from the last saved page.")
+    parser.add_argument("--shards", type=int, default=0,
+        help="Fetch the tickets in this many date ranges at the same time.")
+    parser.add_argument("--compact", action="store_true",
+        help="Fold the index delta log into the index, partition old ticket batches and exit.")
+    parser.add_argument("--workers", type=int, default=NUM_DOWNLOAD_WORKERS,
+        help="Number of threads used to download comments.")
     args = parser.parse_args()
 
+    if args.compact:
+        num_moved = partition_legacy_batches(TICKET_BATCHES_DIR)
+        if num_moved:
+            print(f"Moved {num_moved} ticket batches into month partitions")
+        compact_index()
+        return
+
     print("loading the index...")
-    df = load_create_index(add_custom_fields=True)
+    # Only the index partitions of the months in MIN_DATE to MAX_DATE are read and written.
+    df = load_create_index(add_custom_fields=True, min_date=MIN_DATE, max_date=MAX_DATE)
 
     print("Updating the index...")
     update_index(df,
                 min_date=MIN_DATE, max_date=MAX_DATE,
                 do_fetch=not args.no_fetch,
-                clean_fetch=args.clean)
+                clean_fetch=args.clean,
+                num_workers=args.workers,
+                incremental=args.incremental,
+                resume=args.resume,
+                num_shards=args.shards)
 
     print("Index created!")
 
@@ -4,8 +4,8 @@ import time
 import datetime
 from collections import defaultdict
 from config import METADATA_KEYS, DIVIDER
-from utils import list_index, load_text, text_lines, RE_DATE, RE_TIME, RE_YEAR
-from zendesk_wrapper import comment_paths
+from utils import list_index, text_lines, RE_DATE, RE_TIME, RE_YEAR
+from zendesk_wrapper import ticket_comments
 from logs_parser import standard_date, extract_dates, extract_log_entries
 
 DAYS_BEFORE = 50 # Number of days before the ticket creation date to consider.
@@ -49,12 +49,10 @@ def extract_ticket_logs(ticket_number):
         ticket_number (str): The ticket number to extract logs for.
 
     Returns:
-        list: A list of tuples containing the path of the log file and the extracted log entries.
+        list: A list of tuples containing the name of the comment and the extracted log entries.
     """
-    paths = comment_paths(ticket_number)
     path_logs = []
-    for path in paths:
-        text = load_text(path)
+    for path, text in ticket_comments(ticket_number):
         line_matches = extract_log_entries(text)
         if line_matches:
             path_logs.append((path, line_matches))
@@ -131,14 +129,14 @@ def summarise_ticket(summariser, ticket_number, metadata):
     Returns: A dict of text containing the answers to each of the questions based on the
             comments in the ticket, and an error string.
     """
-    input_files = comment_paths(ticket_number)
-    if not input_files:
+    texts = [text for _, text in ticket_comments(ticket_number)]
+    if not texts:
         return None, "[No comments for ticket]"
     status = metadata["status"]
     if not status:
         return None, "[Unknown status]"
 
-    full_answer = summariser.summarise_ticket(ticket_number, input_files, status)
+    full_answer = summariser.summarise_ticket(ticket_number, texts, status)
     if not full_answer:
         return None, "[Response not generated]"
 
@@ -0,0 +1,149 @@
+"""
+    A local stand-in for the Jina embeddings and rerank APIs that reranker.py uses, for measuring
+    similarity lookups without a Jina API key.
+
+    It serves
+    - embeddings: hashed bag of words vectors of each input text, and
+    - rerank: the cosine similarity of the query's and each document's hashed word pair vectors,
+    in the response formats of https://api.jina.ai/v1. The scores are deterministic, so results
+    can be compared between runs, but they are not semantic.
+    Each response is delayed by a fixed latency plus a latency per text, to simulate the network
+    round trip and the model's work.
+
+    Point reranker.py at it with the JINA_API_URL environment variable. See benchmark_similarity.py.
+
+    Usage:
+        python fake_jina.py [--port 8766] [--latency 0.05] [--text_latency 0.002]
+"""
+import json
+import re
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+EMBEDDING_DIM = 256
+RE_WORD = re.compile(r"\w+")
+
+def _hashed_vector(features):
+    "Returns the L2 normalised count vector of the string `features` hashed to EMBEDDING_DIM buckets."
+    vector = np.zeros(EMBEDDING_DIM)
+    for feature in features:
+        vector[zlib.crc32(feature.encode("utf-8")) % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def embed(text):
+    "Returns the fake embedding of `text`."
+    return _hashed_vector(RE_WORD.findall(text.lower()))
+
+def rerank_score(query, document):
+    "Returns the fake relevance score of `document` to `query`."
+    def pairs(text):
+        words = RE_WORD.findall(text.lower())
+        return [f"{a} {b}" for a, b in zip(words, words[1:])] or words
+    return float(np.dot(_hashed_vector(pairs(query)), _hashed_vector(pairs(document))))
+
+class FakeJinaServer(ThreadingHTTPServer):
+    """
+    An HTTP server for the fake Jina API. Each request is delayed by `latency` seconds plus
+    `text_latency` seconds per text embedded or document reranked.
+    `request_counts` counts the requests to each endpoint.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, text_latency=0.0):
+        super().__init__(("127.0.0.1", port), FakeJinaHandler)
+        self.latency = latency
+        self.text_latency = text_latency
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+
+    def api_url(self):
+        "Returns the URL to use for JINA_API_URL."
+        host, port = self.server_address
+        return f"http://{host}:{port}/v1"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] += 1
+
+    def start(self):
+        "Serves requests in a background thread."
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+class FakeJinaHandler(BaseHTTPRequestHandler):
+    "Handles the POST requests to a FakeJinaServer."
+    protocol_version = "HTTP/1.1"
+    # See FakeZendeskHandler.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay(self, num_texts):
+        delay = self.server.latency + self.server.text_latency * num_texts
+        if delay:
+            time.sleep(delay)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        model = body.get("model", "")
+        if self.path.endswith("/embeddings"):
+            self.server.count("embeddings")
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            self._delay(len(texts))
+            num_tokens = sum(len(RE_WORD.findall(text)) for text in texts)
+            self._send(200, {
+                "model": model,
+                "object": "list",
+                "usage": {"total_tokens": num_tokens, "prompt_tokens": num_tokens},
+                "data": [{"object": "embedding", "index": i, "embedding": embed(text).tolist()}
+                         for i, text in enumerate(texts)],
+            })
+        elif self.path.endswith("/rerank"):
+            self.server.count("rerank")
+            documents = body["documents"]
+            self._delay(len(documents))
+            scores = [rerank_score(body["query"], document) for document in documents]
+            order = sorted(range(len(documents)), key=lambda i: -scores[i])[:body.get("top_n")]
+            num_tokens = sum(len(RE_WORD.findall(document)) for document in documents)
+            self._send(200, {
+                "model": model,
+                "usage": {"total_tokens": num_tokens},
+                "results": [{"index": i, "relevance_score": scores[i]} for i in order],
+            })
+        else:
+            self._send(404, {"detail": f"Unknown endpoint {self.path}"})
+
+def main():
+    parser = ArgumentParser(description="Serve a fake Jina embeddings and rerank API.")
+    parser.add_argument("--port", type=int, default=8766, help="Port to listen on.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds to delay each response.")
+    parser.add_argument("--text_latency", type=float, default=0.002,
+        help="Seconds to delay each response per text embedded or document reranked.")
+    args = parser.parse_args()
+
+    server = FakeJinaServer(args.port, args.latency, args.text_latency)
+    print(f"Serving a fake Jina API at {server.api_url()}")
+    print(f"  export JINA_API_URL={server.api_url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+    A local stand-in for the parts of the Zendesk API that zendesk_wrapper.py uses, for measuring
+    ingestion speed without calling a real Zendesk account.
+
+    It serves a synthetic corpus of tickets from:
+    - tickets.json with cursor pagination,
+    - tickets/{id} and tickets/show_many.json,
+    - tickets/{id}/comments with cursor or next_page pagination,
+    - users/{id} and users/show_many.json,
+    - incremental/tickets/cursor.json,
+    - search/export.json for `type:ticket created>=... created<...` queries with cursor pagination.
+    Each response can be delayed to simulate network latency, and requests above a requests/minute
+    limit get 429 responses with a Retry-After header, like Zendesk's rate limits.
+    Responses have ETags and requests with a matching If-None-Match get 304 Not Modified.
+    The comment_count sideload of tickets and the users sideload of comments are supported.
+
+    Point zendesk_wrapper.py at it with the ZENDESK_API_URL environment variable. See benchmark_ingest.py.
+
+    Usage:
+        python fake_zendesk.py [--port 8765] [--tickets 10000] [--latency 0.05] [--rate_limit 700]
+"""
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+# The number of the first ticket in the corpus.
+FIRST_TICKET = 1_000_000
+# The number of comments per page of tickets/{id}/comments, as in Zendesk.
+COMMENTS_PAGE_SIZE = 100
+# The maximum page[size] of tickets.json, as in Zendesk.
+MAX_PAGE_SIZE = 100
+# The number of tickets per page of the incremental export.
+INCREMENTAL_PAGE_SIZE = 1000
+# The maximum page[size] of search/export.json, as in Zendesk.
+MAX_EXPORT_PAGE_SIZE = 1000
+START_DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+STATUSES = ["new", "open", "pending", "hold", "solved", "closed"]
+PRIORITIES = ["low", "normal", "high", "urgent"]
+PRODUCTS = ["Mobility Print", "Print Deploy", "MF", "NG", "Hive"]
+WORDS = ("printer queue driver server client job failed error release secure card swipe user " +
+         "install upgrade license network timeout log windows mac linux scan email restart").split()
+
+def _iso(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class FakeZendesk:
+    """
+    A synthetic, deterministic Zendesk corpus of `num_tickets` listed tickets plus `num_unlisted`
+    tickets that are only available from tickets/{id}, like tickets created after a fetch.
+    Ticket i has between 1 and 2 * `comments_per_ticket` comments.
+    """
+    def __init__(self, num_tickets, num_unlisted=0, comments_per_ticket=10, comment_words=150, seed=1):
+        self.num_tickets = num_tickets
+        self.num_unlisted = num_unlisted
+        self.comments_per_ticket = comments_per_ticket
+        self.comment_words = comment_words
+        self.seed = seed
+
+    def ticket_numbers(self, unlisted=False):
+        "Returns the listed ticket numbers, or the unlisted ones if `unlisted` is True."
+        if unlisted:
+            return range(FIRST_TICKET + self.num_tickets, FIRST_TICKET + self.num_tickets + self.num_unlisted)
+        return range(FIRST_TICKET, FIRST_TICKET + self.num_tickets)
+
+    def has_ticket(self, ticket_number):
+        return FIRST_TICKET <= ticket_number < FIRST_TICKET + self.num_tickets + self.num_unlisted
+
+    def _rng(self, *keys):
+        # A str seed, unlike hash(), gives the same numbers in every process.
+        return random.Random(":".join(map(str, (self.seed,) + keys)))
+
+    def ticket(self, ticket_number):
+        "Returns ticket `ticket_number` in the format of the Zendesk tickets API."
+        rng = self._rng("ticket", ticket_number)
+        created_at = self.created_at(ticket_number)
+        updated_at = created_at + datetime.timedelta(hours=rng.randint(1, 1_000))
+        subject = " ".join(rng.choice(WORDS) for _ in range(6))
+        return {
+            "id": ticket_number,
+            "url": f"https://example.zendesk.com/api/v2/tickets/{ticket_number}.json",
+            "created_at": _iso(created_at),
+            "updated_at": _iso(updated_at),
+            "generated_timestamp": int(updated_at.timestamp()),
+            "status": rng.choice(STATUSES),
+            "priority": rng.choice(PRIORITIES),
+            "subject": subject,
+            "raw_subject": subject,
+            "description": " ".join(rng.choice(WORDS) for _ in range(20)),
+            "recipient": "support@example.com",
+            "requester_id": 1 + rng.randrange(1_000),
+            "custom_fields": [{"id": 25019086, "value": rng.choice(PRODUCTS)}],
+        }
+
+    def created_at(self, ticket_number):
+        return START_DATE + datetime.timedelta(minutes=10 * (ticket_number - FIRST_TICKET))
+
+    def first_created(self, date):
+        "Returns the index in ticket_numbers() of the first ticket created at or after `date`."
+        minutes = (date - START_DATE).total_seconds() / 60
+        return min(max(0, -int(-minutes // 10)), self.num_tickets)
+
+    def num_comments(self, ticket_number):
+        return self._rng("comments", ticket_number).randint(1, 2 * self.comments_per_ticket)
+
+    def comment(self, ticket_number, i):
+        "Returns comment `i` of ticket `ticket_number` in the format of the Zendesk comments API."
+        rng = self._rng("comment", ticket_number, i)
+        created_at = START_DATE + datetime.timedelta(minutes=10 * (ticket_number - FIRST_TICKET) + i)
+        body = " ".join(rng.choice(WORDS) for _ in range(self.comment_words))
+        return {
+            "id": ticket_number * 1_000 + i,
+            "author_id": 1 + rng.randrange(1_000),
+            "body": body,
+            "public": True,
+            "created_at": _iso(created_at),
+        }
+
+    def user(self, user_id):
+        "Returns user `user_id` in the format of the Zendesk users API."
+        return {"id": user_id, "name": f"User {user_id}", "email": f"user{user_id}@example.com",
+                "role": "agent" if user_id % 10 == 0 else "end-user"}
+
+class RateLimiter:
+    "Counts requests in fixed one minute windows and reports when `rate_per_min` is exceeded."
+    def __init__(self, rate_per_min):
+        self.rate_per_min = rate_per_min
+        self.lock = threading.Lock()
+        self.window = 0
+        self.count = 0
+
+    def retry_after(self):
+        "Returns 0 if a request is allowed, otherwise the seconds until the next window."
+        if not self.rate_per_min:
+            return 0
+        now = time.time()
+        with self.lock:
+            window = int(now // 60)
+            if window != self.window:
+                self.window, self.count = window, 0
+            self.count += 1
+            if self.count <= self.rate_per_min:
+                return 0
+        return max(1, int(60 * (window + 1) - now))
+
+class FakeZendeskServer(ThreadingHTTPServer):
+    """
+    An HTTP server for a FakeZendesk `corpus`. Each request is delayed by `latency` seconds and
+    requests above `rate_limit` per minute get 429 responses.
+    `request_counts` counts the requests to each endpoint.
+    """
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0, latency=0.0, rate_limit=0):
+        super().__init__(("127.0.0.1", port), FakeZendeskHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+
+    def api_url(self):
+        "Returns the URL to use for ZENDESK_API_URL."
+        host, port = self.server_address
+        return f"http://{host}:{port}/api/v2/"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] += 1
+
+    def num_requests(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    def start(self):
+        "Serves requests in a background thread."
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+RE_TICKET = re.compile(r"^tickets/(\d+)(?:\.json)?$")
+RE_COMMENTS = re.compile(r"^tickets/(\d+)/comments(?:\.json)?$")
+RE_USER = re.compile(r"^users/(\d+)(?:\.json)?$")
+RE_CREATED = re.compile(r"created(>=|<)(\S+)")
+
+class FakeZendeskHandler(BaseHTTPRequestHandler):
+    "Handles the GET requests to a FakeZendeskServer."
+    # Keep connections alive, as Zendesk does, so clients can reuse pooled connections.
+    protocol_version = "HTTP/1.1"
+    # The headers and body are sent in separate writes. With Nagle's algorithm on, each response
+    # would wait about 40 ms for the client's delayed ACK, which would swamp the times measured.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, obj, headers=None):
+        data = json.dumps(obj).encode("utf-8")
+        if status == 200:
+            etag = f'W/"{hashlib.md5(data).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.server.count("304")
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            headers = dict(headers or {}, ETag=etag)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sideload(self, corpus, obj, params):
+        "Adds the sideloads in the `include` parameter of `params` to response `obj`."
+        includes = set(params.get("include", "").split(","))
+        if "comment_count" in includes:
+            tickets = obj.get("tickets", []) + ([obj["ticket"]] if "ticket" in obj else [])
+            for ticket in tickets:
+                ticket["comment_count"] = corpus.num_comments(ticket["id"])
+        if "users" in includes and "comments" in obj:
+            author_ids = sorted({comment["author_id"] for comment in obj["comments"]})
+            obj["users"] = [corpus.user(a) for a in author_ids]
+        return obj
+
+    def _url(self, path, params):
+        return f"{self.server.api_url()}{path}?{urlencode(params)}"
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = re.sub(r"^/+api/v2/+", "", parsed.path)
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        retry_after = self.server.rate_limiter.retry_after()
+        if retry_after:
+            self.server.count("429")
+            self._send(429, {"error": "APIRateLimitExceeded"}, {"Retry-After": str(retry_after)})
+            return
+
+        corpus = self.server.corpus
+        if path in ("tickets.json", "tickets"):
+            self.server.count("tickets")
+            self._send(200, self._sideload(corpus, self.tickets_page(corpus, params), params))
+        elif path == "tickets/show_many.json":
+            self.server.count("tickets_many")
+            ids = [int(i) for i in params.get("ids", "").split(",") if i]
+            tickets = [corpus.ticket(t) for t in ids[:MAX_PAGE_SIZE] if corpus.has_ticket(t)]
+            self._send(200, self._sideload(corpus, {"tickets": tickets}, params))
+        elif path == "search/export.json":
+            self.server.count("export")
+            self._send(200, self.export_page(corpus, params))
+        elif path == "incremental/tickets/cursor.json":
+            self.server.count("incremental")
+            self._send(200, self.incremental_page(corpus, params))
+        elif match := RE_TICKET.match(path):
+            self.server.count("ticket")
+            ticket_number = int(match.group(1))
+            if not corpus.has_ticket(ticket_number):
+                self._send(404, {"error": "RecordNotFound", "description": "Not found"})
+                return
+            self._send(200, self._sideload(corpus, {"ticket": corpus.ticket(ticket_number)}, params))
+        elif match := RE_COMMENTS.match(path):
+            self.server.count("comments")
+            ticket_number = int(match.group(1))
+            if not corpus.has_ticket(ticket_number):
+                self._send(404, {"error": "RecordNotFound", "description": "Not found"})
+                return
+            page = self.comments_page(corpus, ticket_number, path, params)
+            self._send(200, self._sideload(corpus, page, params))
+        elif path == "users/show_many.json":
+            self.server.count("users")
+            ids = [int(i) for i in params.get("ids", "").split(",") if i]
+            self._send(200, {"users": [corpus.user(i) for i in ids[:MAX_PAGE_SIZE]]})
+        elif match := RE_USER.match(path):
+            self.server.count("user")
+            self._send(200, {"user": corpus.user(int(match.group(1)))})
+        else:
+            self.server.count("unknown")
+            self._send(404, {"error": "InvalidEndpoint", "description": f"Not found: {path}"})
+
+    def tickets_page(self, corpus, params):
+        "Returns a page of tickets.json with Zendesk cursor pagination."
+        size = min(int(params.get("page[size]", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        start = int(params.get("page[after]", 0))
+        numbers = corpus.ticket_numbers()[start:start + size]
+        end = start + len(numbers)
+        has_more = end < corpus.num_tickets
+        next_url = self._url("tickets.json", {"page[size]": size, "page[after]": end}) if has_more else None
+        return {
+            "tickets": [corpus.ticket(t) for t in numbers],
+            "meta": {"has_more": has_more, "after_cursor": str(end)},
+            "links": {"next": next_url},
+        }
+
+    def incremental_page(self, corpus, params):
+        """ Returns a page of the incremental ticket export. The fake corpus doesn't change, so the
+            export is every listed ticket updated at or after `start_time`.
+        """
+        if "cursor" in params:
+            start = int(params["cursor"])
+        else:
+            start_time = int(params.get("start_time", 0))
+            start = 0
+            for t in corpus.ticket_numbers():
+                if corpus.ticket(t)["generated_timestamp"] >= start_time:
+                    break
+                start += 1
+        numbers = corpus.ticket_numbers()[start:start + INCREMENTAL_PAGE_SIZE]
+        end = start + len(numbers)
+        end_of_stream = end >= corpus.num_tickets
+        return {
+            "tickets": [corpus.ticket(t) for t in numbers],
+            "after_cursor": str(end),
+            "after_url": None if end_of_stream else self._url("incremental/tickets/cursor.json",
+                                                              {"cursor": end}),
+            "end_of_stream": end_of_stream,
+        }
+
+    def export_page(self, corpus, params):
+        "Returns a page of a search export of the tickets created in a date range."
+        begin, end = 0, corpus.num_tickets
+        for op, value in RE_CREATED.findall(params.get("query", "")):
+            date = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+            if op == ">=":
+                begin = max(begin, corpus.first_created(date))
+            else:
+                end = min(end, corpus.first_created(date))
+        size = min(int(params.get("page[size]", MAX_EXPORT_PAGE_SIZE)), MAX_EXPORT_PAGE_SIZE)
+        start = max(begin, int(params.get("page[after]", begin)))
+        numbers = corpus.ticket_numbers()[start:min(start + size, end)]
+        after = start + len(numbers)
+        has_more = after < end
+        next_params = {"query": params.get("query", ""), "filter[type]": "ticket",
+                       "page[size]": size, "page[after]": after}
+        return {
+            "results": [corpus.ticket(t) for t in numbers],
+            "meta": {"has_more": has_more, "after_cursor": str(after)},
+            "links": {"next": self._url("search/export.json", next_params) if has_more else None},
+        }
+
+    def comments_page(self, corpus, ticket_number, path, params):
+        """ Returns a page of the comments of ticket `ticket_number` with cursor pagination if
+            page[size] is given, and with next_page pagination otherwise.
+        """
+        num_comments = corpus.num_comments(ticket_number)
+        if "page[size]" in params:
+            size = min(int(params["page[size]"]), COMMENTS_PAGE_SIZE)
+            start = int(params.get("page[after]", 0))
+            end = min(start + size, num_comments)
+            has_more = end < num_comments
+            next_url = self._url(path, {"page[size]": size, "page[after]": end}) if has_more else None
+            return {
+                "comments": [corpus.comment(ticket_number, i) for i in range(start, end)],
+                "meta": {"has_more": has_more, "after_cursor": str(end)},
+                "links": {"next": next_url},
+            }
+        page = int(params.get("page", 1))
+        start = (page - 1) * COMMENTS_PAGE_SIZE
+        end = min(start + COMMENTS_PAGE_SIZE, num_comments)
+        next_page = self._url(path, {"page": page + 1}) if end < num_comments else None
+        return {
+            "comments": [corpus.comment(ticket_number, i) for i in range(start, end)],
+            "next_page": next_page,
+            "count": num_comments,
+        }
+
+def main():
+    parser = ArgumentParser(description="Serve a fake Zendesk API.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--tickets", type=int, default=10_000, help="Number of tickets listed.")
+    parser.add_argument("--unlisted", type=int, default=1_000,
+        help="Number of tickets only available from tickets/{id}.")
+    parser.add_argument("--comments", type=int, default=10, help="Mean number of comments per ticket.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay each response.")
+    parser.add_argument("--rate_limit", type=int, default=0,
+        help="Requests per minute before responding 429. 0 for no limit.")
+    args = parser.parse_args()
+
+    corpus = FakeZendesk(args.tickets, args.unlisted, args.comments)
+    server = FakeZendeskServer(corpus, args.port, args.latency, args.rate_limit)
+    print(f"Serving {args.tickets} fake Zendesk tickets at {server.api_url()}")
+    print(f"  export ZENDESK_API_URL={server.api_url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -35,54 +35,31 @@ from models import LLM_MODELS, sub_models
 from reranker import QueryEngine
 from cluster_tickets import find_clusters
 from typing import List, Any
-from zendesk_wrapper import load_create_index, update_index, fetch_ticket
+from zendesk_wrapper import fetch_ticket
+from similarity_service import SimilarityService
 
 RE_SUMMARY = regex_compile("SUMMARY:\s*(.*)\s*\n\n")
 
-MIN_DATE = None
-MAX_DATE = None
+# The similarity service used by get_k_nearest(). It is loaded by the first call and reused.
+similarity_service = None
 
 def get_k_nearest(ticket_id: int, k: int) -> List[Any]:
-    # Initialize ZendeskData
-    zd = ZendeskData()
+    """
+    Returns the Zendesk tickets of the `k` tickets most similar to ticket `ticket_id`.
+    The index and query pipeline are loaded once per process. Call similarity_service.refresh() to
+    pick up the tickets changed since then. server.py keeps its own service up to date.
+    """
+    global similarity_service
+    if similarity_service is None:
+        similarity_service = SimilarityService()
+        similarity_service.load()
 
     # Check if the ticket exists
-    if ticket_id not in zd.existing_tickets([ticket_id]):
+    if ticket_id not in similarity_service.zd.existing_tickets([ticket_id]):
         raise ValueError(f"Ticket {ticket_id} not found")
 
-    # Initialize the model (using a default model, you can modify this as needed)
-    model_name = next(iter(LLM_MODELS.keys()))
-    model_type = LLM_MODELS[model_name]
-    model_instance = model_type()
-    llm, model = model_instance.load()
-
-    df = load_create_index(add_custom_fields=True)
-
-    print("Updating the index...")
-    update_index(df,
-                min_date=MIN_DATE, max_date=MAX_DATE,
-                do_fetch=True,
-                clean_fetch=False)
-
-    # Initialize QueryEngine
-    query_engine = QueryEngine(df, llm, model)
-
-    # Find the closest tickets
-    results = query_engine.find_closest_tickets([ticket_id], top_k=k)
-
-    # Extract and return the list of nearest neighbors
-    if results:
-        nearest_neighbors = results[0][1]  # Get the list of (ticket_number, score) tuples
-        ticket_numbers = [ticket for ticket, _ in nearest_neighbors]  # Return only the ticket numbers
-
-        res = []
-        for ticket_id in ticket_numbers:
-            ticket = fetch_ticket(ticket_id)
-            res.append(ticket)
-        return res
-
-    else:
-        return []
+    similar = similarity_service.get_similar_tickets(ticket_id, k)
+    return [fetch_ticket(ticket["ticket_number"]) for ticket in similar]
 
 def main():
     model_names = f"({' | '.join(LLM_MODELS.keys())})"
@@ -0,0 +1,145 @@
+"""
+    A persistent full-text index over ticket comments, used to answer --pattern ticket filters
+    without reading every comment of every ticket.
+
+    The index is an SQLite FTS5 table with the trigram tokenizer, which matches any substring of
+    three or more characters case-insensitively. A regular expression is answered by finding the
+    tickets whose comments contain all the literal strings that every match of the regex must
+    contain. Those candidate tickets are then checked with the regex itself.
+    https://www.sqlite.org/fts5.html#the_trigram_tokenizer
+"""
+import threading
+try:
+    # requirements.txt installs pysqlite3 because the trigram tokenizer needs SQLite >= 3.34.
+    import pysqlite3 as sqlite3
+except ImportError:
+    import sqlite3
+
+# Each comment's rowid is ticket_number * ROWS_PER_TICKET + comment number, so the comments of a
+# ticket are a contiguous range of rowids.
+ROWS_PER_TICKET = 100_000
+# Trigram FTS5 can only search for strings of at least this length.
+MIN_LITERAL_LEN = 3
+# The alphanumeric escapes that are character classes or assertions, and so match no literal text.
+# Other alphanumeric escapes, such as \x41, \u0041, \N{...}, \101 and \t, are characters.
+CLASS_ESCAPES = set("dDsSwWbBAZ")
+
+def _skip_to(pattern, i, close):
+    "Returns the index after the `close` character that ends the construct starting at `pattern[i]`."
+    while i < len(pattern) and pattern[i] != close:
+        i += 2 if pattern[i] == "\\" else 1
+    return i + 1
+
+def required_literals(pattern):
+    """ Returns the literal strings of at least MIN_LITERAL_LEN characters that every match of the
+        regular expression `pattern` must contain.
+        Returns None if `pattern` has alternations, groups or character escapes such as \\x41,
+        which this doesn't reason about.
+    """
+    if "|" in pattern or "(" in pattern:
+        return None
+    literals = []
+    current = []
+
+    def flush():
+        if len(current) >= MIN_LITERAL_LEN:
+            literals.append("".join(current))
+        current.clear()
+
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():
+                current.append(escaped)
+            elif escaped in CLASS_ESCAPES:
+                flush()   # A character class such as \s or an assertion such as \b.
+            else:
+                return None
+            i += 2
+        elif c == "[":
+            flush()
+            i = _skip_to(pattern, i + 1, "]")
+        elif c in "*?{":
+            # The previous character is optional or repeated, so it isn't part of a required literal.
+            if current:
+                current.pop()
+            flush()
+            i = _skip_to(pattern, i + 1, "}") if c == "{" else i + 1
+        elif c in "+.^$":
+            flush()
+            i += 1
+        else:
+            current.append(c)
+            i += 1
+    flush()
+    return literals
+
+def fts_query(literals):
+    "Returns an FTS5 query that matches text containing all of `literals`."
+    quoted = ['"' + literal.replace('"', '""') + '"' for literal in literals]
+    return " AND ".join(quoted)
+
+class CommentSearchIndex:
+    """
+    A full-text index over the comments of each ticket, stored in the SQLite database `path`.
+    If this SQLite doesn't support the FTS5 trigram tokenizer the index is disabled and every
+    pattern is answered by a full scan.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self.db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS comments
+                    USING fts5(body, tokenize='trigram')""")
+        except sqlite3.OperationalError as e:
+            print(f"Full-text comment index disabled: {e}. Install pysqlite3.")
+            self.db = None
+            return
+        self.db.execute("""CREATE TABLE IF NOT EXISTS indexed_tickets (
+                ticket_number INTEGER PRIMARY KEY, num_comments INTEGER)""")
+        self.db.commit()
+
+    def enabled(self):
+        return self.db is not None
+
+    def indexed_tickets(self):
+        "Returns the set of numbers of the tickets in the index."
+        if not self.enabled():
+            return set()
+        with self.lock:
+            rows = self.db.execute("SELECT ticket_number FROM indexed_tickets").fetchall()
+        return {row[0] for row in rows}
+
+    def update_tickets(self, ticket_comments):
+        """ Replaces the indexed comments of tickets.
+            `ticket_comments` is an iterable of (ticket_number, texts) pairs.
+        """
+        if not self.enabled():
+            return
+        with self.lock:
+            for ticket_number, texts in ticket_comments:
+                assert len(texts) < ROWS_PER_TICKET, (ticket_number, len(texts))
+                row0 = ticket_number * ROWS_PER_TICKET
+                self.db.execute("DELETE FROM comments WHERE rowid BETWEEN ? AND ?",
+                                (row0, row0 + ROWS_PER_TICKET - 1))
+                self.db.executemany("INSERT INTO comments (rowid, body) VALUES (?, ?)",
+                                    [(row0 + i, text) for i, text in enumerate(texts)])
+                self.db.execute("INSERT OR REPLACE INTO indexed_tickets VALUES (?, ?)",
+                                (ticket_number, len(texts)))
+            self.db.commit()
+
+    def candidates(self, pattern):
+        """ Returns the set of numbers of indexed tickets that may have a comment matching regex
+            `pattern`, or None if the index can't narrow down the tickets for `pattern`.
+        """
+        if not self.enabled():
+            return None
+        literals = required_literals(pattern)
+        if not literals:
+            return None
+        with self.lock:
+            rows = self.db.execute("SELECT rowid FROM comments WHERE comments MATCH ?",
+                                   (fts_query(literals),)).fetchall()
+        return {row[0] // ROWS_PER_TICKET for row in rows}
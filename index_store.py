@@ -0,0 +1,271 @@
+"""
+    Storage for the ticket index DataFrame.
+
+    The index is stored as Parquet when pyarrow is installed and INDEX_FORMAT is "parquet", and as
+    CSV otherwise. Parquet keeps the column types, so loading it doesn't re-parse dates:
+    - `created_at` and `updated_at` are datetime columns,
+    - `status` and `priority` are categorical columns,
+    - each Zendesk custom field is a typed column named by custom_field_column().
+    A CSV index from before Parquet was used is converted the first time it is loaded.
+
+    The Parquet index is partitioned by the month tickets were created, one YYYY-MM.parquet file
+    per month in TICKET_INDEX_PARTITIONS_DIR. The manifest.json there records the index columns and
+    the number of tickets and range of creation dates in each partition, so loading the tickets
+    created in a date range only reads the partitions that overlap it, and saving the index for a
+    date range only rewrites those partitions. A single-file Parquet index from before partitioning
+    is converted the first time it is loaded.
+
+    Rows added to the index between full saves are appended to the delta log
+    TICKET_INDEX_DELTA_PATH, so adding a few tickets doesn't rewrite the whole index. The delta rows
+    are merged into the index when it is loaded, and save_index() folds them into the index file.
+"""
+import ast
+import datetime
+import json
+import os
+import pandas as pd
+from config import (TICKET_INDEX_PATH, TICKET_INDEX_PARQUET_PATH, INDEX_FORMAT, METADATA_KEYS,
+                    CUSTOM_FIELDS_KEY, FIELD_KEY_NAMES, TICKET_INDEX_DELTA_PATH,
+                    TICKET_INDEX_PARTITIONS_DIR)
+from utils import load_json, save_json, month_in_range
+
+# Columns with few distinct values that are stored as categoricals.
+CATEGORY_COLUMNS = ["status", "priority"]
+
+def custom_field_column(field_id):
+    """ Returns the index column name for the Zendesk custom field `field_id`.
+        This is the FIELD_KEY_NAMES name of the field if there is one, otherwise "field_<field_id>".
+    """
+    name = FIELD_KEY_NAMES.get(str(field_id))
+    if not name:
+        return f"field_{field_id}"
+    return name.strip().replace(" ", "_")
+
+def custom_field_value(metadata, field_id):
+    "Returns the value of custom field `field_id` in index row `metadata`, or None if it is not set."
+    value = metadata.get(custom_field_column(field_id))
+    return None if pd.isna(value) else value
+
+def _typed_column(series):
+    """ Returns `series` of custom field values converted to a single type so that it can be stored
+        in a columnar file. Multi-select values (lists) are joined into comma separated strings.
+    """
+    values = series.dropna()
+    if values.empty:
+        return series.astype("string")
+    if values.map(lambda v: isinstance(v, list)).any():
+        series = series.map(lambda v: ", ".join(map(str, v)) if isinstance(v, list) else v)
+        values = series.dropna()
+    if values.map(lambda v: isinstance(v, bool)).all():
+        return series.astype("boolean")
+    if values.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)).all():
+        return pd.to_numeric(series)
+    series = series.map(lambda v: v if pd.isna(v) else str(v))
+    if values.nunique() <= len(values) // 2:
+        return series.astype("category")
+    return series.astype("string")
+
+def expand_custom_fields(df):
+    """ Returns `df` with its `CUSTOM_FIELDS_KEY` column of {field_id: value} dicts replaced by one
+        typed column per custom field. The dicts may be in their Python repr form, as written to CSV.
+    """
+    if CUSTOM_FIELDS_KEY not in df.columns:
+        return df
+    def to_dict(value):
+        if isinstance(value, dict):
+            return value
+        if isinstance(value, str) and value:
+            return ast.literal_eval(value)
+        return {}
+    dicts = [to_dict(v) for v in df[CUSTOM_FIELDS_KEY]]
+    fields_df = pd.DataFrame.from_records(dicts, index=df.index)
+    fields_df = fields_df.rename(columns=custom_field_column)
+    for column in fields_df.columns:
+        fields_df[column] = _typed_column(fields_df[column])
+    df = df.drop(columns=[CUSTOM_FIELDS_KEY])
+    fields_df = fields_df.drop(columns=[c for c in fields_df.columns if c in df.columns])
+    return pd.concat([df, fields_df], axis=1)
+
+def categorise(df):
+    "Returns `df` with its `CATEGORY_COLUMNS` converted to categoricals."
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    return df
+
+def use_parquet():
+    "Returns True if the index is stored as Parquet."
+    if INDEX_FORMAT != "parquet":
+        return False
+    try:
+        import pyarrow
+    except ImportError:
+        print("pyarrow is not installed. Storing the ticket index as CSV.")
+        return False
+    return True
+
+MANIFEST_PATH = os.path.join(TICKET_INDEX_PARTITIONS_DIR, "manifest.json")
+
+def index_path():
+    "Returns the path the ticket index is saved to."
+    return TICKET_INDEX_PARTITIONS_DIR if use_parquet() else TICKET_INDEX_PATH
+
+def stored_index_path():
+    """ Returns the path of the stored ticket index that load_index() reads, which is an older
+        format than index_path() if the index hasn't been converted yet.
+    """
+    if use_parquet():
+        if os.path.exists(MANIFEST_PATH):
+            return TICKET_INDEX_PARTITIONS_DIR
+        if os.path.exists(TICKET_INDEX_PARQUET_PATH):
+            return TICKET_INDEX_PARQUET_PATH
+    return TICKET_INDEX_PATH
+
+def index_exists():
+    "Returns True if there is a stored ticket index in any format."
+    return any(os.path.exists(path) for path in [MANIFEST_PATH, TICKET_INDEX_PARQUET_PATH, TICKET_INDEX_PATH])
+
+def _partition_path(month):
+    return os.path.join(TICKET_INDEX_PARTITIONS_DIR, f"{month}.parquet")
+
+def _load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {"columns": [], "partitions": {}}
+    return load_json(MANIFEST_PATH)
+
+def _created_months(created_at):
+    "Returns the 'YYYY-MM' creation month of each ticket with creation dates `created_at`."
+    return pd.to_datetime(created_at).dt.strftime("%Y-%m")
+
+def save_index(df, min_date=None, max_date=None):
+    """ Saves the ticket index `df` to index_path().
+        If `min_date` or `max_date` is given, only the partitions of the months that overlap the
+        range are written, and the other partitions are left as they are. `df` must then hold every
+        ticket of those months, as loaded by load_existing_index(min_date, max_date).
+        `df` must include the delta rows of the months saved, as loaded by load_existing_index(),
+        since they are removed from the delta log.
+    """
+    if not use_parquet():
+        # A CSV index is always loaded and saved whole.
+        df.to_csv(TICKET_INDEX_PATH)
+        clear_index_delta()
+        return
+
+    # Parquet needs each object column to hold a single type. Custom field columns become
+    # object columns when index rows with different custom field types are concatenated.
+    # The columns are typed over the whole index so that every partition has the same types.
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        if column in METADATA_KEYS:
+            df[column] = df[column].astype("string")
+        else:
+            df[column] = _typed_column(df[column])
+
+    os.makedirs(TICKET_INDEX_PARTITIONS_DIR, exist_ok=True)
+    manifest = _load_manifest()
+    partitions = manifest["partitions"]
+    months = _created_months(df["created_at"])
+    for month, month_df in df.groupby(months.values, sort=True):
+        if not month_in_range(month, min_date, max_date):
+            continue
+        month_df.to_parquet(_partition_path(month))
+        created_at = pd.to_datetime(month_df["created_at"])
+        partitions[month] = {
+            "num_tickets": len(month_df),
+            "min_created": created_at.min().isoformat(),
+            "max_created": created_at.max().isoformat(),
+        }
+    # Partitions in the range saved whose tickets have all been deleted.
+    for month in sorted(set(partitions) - set(months)):
+        if month_in_range(month, min_date, max_date):
+            os.remove(_partition_path(month))
+            del partitions[month]
+    columns = list(df.columns)
+    if min_date or max_date:
+        columns += [column for column in manifest["columns"] if column not in columns]
+    manifest["columns"] = columns
+    save_json(MANIFEST_PATH, manifest)
+
+    if min_date or max_date:
+        _save_index_delta([(t, metadata) for t, metadata in load_index_delta()
+                           if not _delta_in_range(metadata, min_date, max_date)])
+    else:
+        clear_index_delta()
+        if os.path.exists(TICKET_INDEX_PARQUET_PATH):
+            os.remove(TICKET_INDEX_PARQUET_PATH)
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, pd.Timestamp)):
+        return value.isoformat()
+    return value
+
+def _write_index_delta(path, mode, rows):
+    with open(path, mode) as f:
+        for ticket_number, metadata in rows:
+            metadata = {k: _json_value(v) for k, v in metadata.items()}
+            f.write(json.dumps({"ticket_number": int(ticket_number), "metadata": metadata}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def append_index_delta(rows):
+    """ Appends `rows`, a list of (ticket_number, metadata) pairs as added to an IndexBuilder, to the
+        delta log. This costs O(len(rows)), however big the index is.
+    """
+    _write_index_delta(TICKET_INDEX_DELTA_PATH, "a", rows)
+
+def _save_index_delta(rows):
+    "Replaces the rows in the delta log with `rows`."
+    if not rows:
+        clear_index_delta()
+        return
+    temp_path = f"{TICKET_INDEX_DELTA_PATH}.tmp"
+    _write_index_delta(temp_path, "w", rows)
+    os.replace(temp_path, TICKET_INDEX_DELTA_PATH)
+
+def _delta_in_range(metadata, min_date, max_date):
+    return month_in_range(str(metadata["created_at"])[:7], min_date, max_date)
+
+def load_index_delta(min_date=None, max_date=None):
+    """ Returns the (ticket_number, metadata) pairs in the delta log in the order they were added.
+        Only the rows of tickets created in the months that overlap `min_date` to `max_date` are
+        returned.
+        A partly written last line, from a crash while appending, is ignored.
+    """
+    if not os.path.exists(TICKET_INDEX_DELTA_PATH):
+        return []
+    rows = []
+    with open(TICKET_INDEX_DELTA_PATH) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Ignoring a partly written row in {TICKET_INDEX_DELTA_PATH}")
+                continue
+            if _delta_in_range(record["metadata"], min_date, max_date):
+                rows.append((record["ticket_number"], record["metadata"]))
+    return rows
+
+def clear_index_delta():
+    if os.path.exists(TICKET_INDEX_DELTA_PATH):
+        os.remove(TICKET_INDEX_DELTA_PATH)
+
+def load_index(min_date=None, max_date=None):
+    """ Returns the stored ticket index as it was saved, without formatting.
+        Only the partitions of the months that overlap `min_date` to `max_date` are read, so the
+        index holds every ticket created in those months. An index that isn't partitioned is read
+        whole.
+        Reads the CSV index if there is no Parquet index.
+    """
+    path = stored_index_path()
+    if path == TICKET_INDEX_PARTITIONS_DIR:
+        manifest = _load_manifest()
+        months = [month for month in sorted(manifest["partitions"])
+                  if month_in_range(month, min_date, max_date)]
+        if not months:
+            df = pd.DataFrame(columns=manifest["columns"])
+            df.index.name = "ticket_number"
+            return df
+        return pd.concat([pd.read_parquet(_partition_path(month)) for month in months])
+    if path == TICKET_INDEX_PARQUET_PATH:
+        return pd.read_parquet(TICKET_INDEX_PARQUET_PATH)
+    return pd.read_csv(TICKET_INDEX_PATH, index_col="ticket_number")
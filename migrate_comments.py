@@ -0,0 +1,53 @@
+"""
+    Copy the downloaded comments from one text file per comment in COMMENTS_DIR to the packed comment
+    store in COMMENT_STORE_DIR.
+
+    Set COMMENT_STORAGE = "packed" in config.py after running this.
+
+    Usage:
+        python migrate_comments.py [--no-compress] [--delete]
+"""
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+from config import COMMENTS_DIR, COMMENT_STORE_DIR, COMMENT_STORE_COMPRESS
+from comment_store import FileCommentStore, PackedCommentStore
+from utils import since
+
+def main():
+    parser = ArgumentParser(description="Copy comment files to the packed comment store.")
+    parser.add_argument("--no-compress", action="store_true",
+        help="Don't compress the comments in the packed store.")
+    parser.add_argument("--delete", action="store_true",
+        help="Delete each ticket's comment files once they are in the packed store.")
+    args = parser.parse_args()
+
+    file_store = FileCommentStore(COMMENTS_DIR)
+    packed_store = PackedCommentStore(COMMENT_STORE_DIR,
+                                      compress=COMMENT_STORE_COMPRESS and not args.no_compress)
+
+    ticket_numbers = file_store.ticket_numbers()
+    print(f"Migrating the comments of {len(ticket_numbers)} tickets from {COMMENTS_DIR} to " +
+          f"{COMMENT_STORE_DIR}")
+    t0 = time.time()
+    num_comments = 0
+    for i, ticket_number in enumerate(ticket_numbers):
+        if packed_store.has_ticket(ticket_number):
+            continue
+        numbered_texts = []
+        for path, text in file_store.comments(ticket_number):
+            name = os.path.basename(path)
+            numbered_texts.append((int(name[len("comment_"):-len(".txt")]), text))
+        packed_store.save_comments(ticket_number, numbered_texts)
+        assert packed_store.comment_sizes(ticket_number) == file_store.comment_sizes(ticket_number), \
+            f"ticket {ticket_number}: packed comments don't match {file_store.ticket_dir(ticket_number)}"
+        num_comments += len(numbered_texts)
+        if args.delete:
+            shutil.rmtree(file_store.ticket_dir(ticket_number))
+        if i % 10_000 == 1_000:
+            print(f"  {i:7} tickets {num_comments:8} comments in {since(t0):.1f} secs")
+    print(f"Migrated {num_comments} comments in {since(t0):.1f} secs")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+    Near-duplicate ticket detection with MinHash and locality sensitive hashing (LSH).
+
+    Each ticket's comment text is reduced to a set of word shingles and the set to a MinHash
+    signature of NUM_PERMUTATIONS values. The fraction of equal values in two signatures estimates
+    the Jaccard similarity of the tickets' shingle sets.
+
+    The signature is split into NUM_BANDS bands and each band is hashed to a bucket. Tickets that
+    share a bucket in any band are candidate duplicates, so a new ticket is only compared with the
+    few tickets in its buckets, not with every ticket. The signatures and buckets are kept in an
+    SQLite database so that each index update only hashes the new and changed tickets.
+    https://en.wikipedia.org/wiki/MinHash
+    http://infolab.stanford.edu/~ullman/mmds/ch3.pdf
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import zlib
+from collections import defaultdict
+import numpy as np
+
+NUM_PERMUTATIONS = 128
+NUM_BANDS = 16          # Bands of NUM_PERMUTATIONS // NUM_BANDS rows. Candidates are ~70% similar.
+SHINGLE_WORDS = 5       # Number of words in each shingle.
+# Shingles permuted at a time by minhash(). Its arrays are then 4 MB (4096 x 128 uint64s), whatever the
+# size of the ticket.
+MINHASH_CHUNK = 4096
+MIN_SIMILARITY = 0.8    # Estimated Jaccard similarity of tickets that are near-duplicates.
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# The permutations must be the same in every run, because signatures are stored.
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+RE_WORD = re.compile(r"\w+")
+
+def shingle_hashes(text):
+    "Returns the 32-bit hashes of the SHINGLE_WORDS word shingles in `text`."
+    words = RE_WORD.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        words = words + [""] * (SHINGLE_WORDS - len(words))
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    return np.array([zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64)
+
+def minhash(text):
+    "Returns the MinHash signature of `text` as an array of NUM_PERMUTATIONS uint32s."
+    hashes = shingle_hashes(text)
+    signature = np.full(NUM_PERMUTATIONS, _MAX_HASH, dtype=np.uint64)
+    for i in range(0, len(hashes), MINHASH_CHUNK):
+        # The products wrap around in 64 bits, which keeps them well mixed. See datasketch.MinHash.
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes[i:i + MINHASH_CHUNK], _PERM_A) + _PERM_B) % _MERSENNE_PRIME
+        np.minimum(signature, np.bitwise_and(permuted, _MAX_HASH).min(axis=0), out=signature)
+    return signature.astype(np.uint32)
+
+def band_buckets(signature):
+    "Returns the bucket of each of the NUM_BANDS bands of `signature`."
+    bands = signature.reshape(NUM_BANDS, -1)
+    return [int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), "little", signed=True)
+            for band in bands]
+
+def similarity(signature1, signature2):
+    "Returns the Jaccard similarity estimated from two MinHash signatures."
+    return float(np.mean(signature1 == signature2))
+
+class NearDuplicateIndex:
+    """
+    The MinHash signatures, LSH buckets and near-duplicate pairs of tickets, stored in the SQLite
+    database `path`.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS signatures (ticket_number INTEGER PRIMARY KEY, signature BLOB);
+            CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, ticket_number INTEGER,
+                PRIMARY KEY (band, bucket, ticket_number));
+            CREATE INDEX IF NOT EXISTS buckets_ticket ON buckets (ticket_number);
+            CREATE TABLE IF NOT EXISTS pairs (ticket1 INTEGER, ticket2 INTEGER, similarity REAL,
+                PRIMARY KEY (ticket1, ticket2));
+            CREATE INDEX IF NOT EXISTS pairs_ticket2 ON pairs (ticket2);
+        """)
+        self.db.commit()
+
+    def indexed_tickets(self):
+        "Returns the set of numbers of the tickets with signatures."
+        with self.lock:
+            rows = self.db.execute("SELECT ticket_number FROM signatures").fetchall()
+        return {row[0] for row in rows}
+
+    def _signature(self, ticket_number):
+        row = self.db.execute("SELECT signature FROM signatures WHERE ticket_number = ?",
+                              (ticket_number,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.uint32) if row else None
+
+    def _remove(self, ticket_number):
+        self.db.execute("DELETE FROM signatures WHERE ticket_number = ?", (ticket_number,))
+        self.db.execute("DELETE FROM buckets WHERE ticket_number = ?", (ticket_number,))
+        self.db.execute("DELETE FROM pairs WHERE ticket1 = ? OR ticket2 = ?", (ticket_number, ticket_number))
+
+    def update_tickets(self, ticket_texts):
+        """ Replaces the signatures of tickets and finds their near-duplicates among the indexed
+            tickets.
+            `ticket_texts` is an iterable of (ticket_number, text) pairs.
+            Returns the number of near-duplicate pairs found.
+        """
+        num_pairs = 0
+        with self.lock:
+            for ticket_number, text in ticket_texts:
+                self._remove(ticket_number)
+                if not text.strip():
+                    continue
+                signature = minhash(text)
+                buckets = band_buckets(signature)
+                candidates = set()
+                for band, bucket in enumerate(buckets):
+                    rows = self.db.execute("SELECT ticket_number FROM buckets WHERE band = ? AND bucket = ?",
+                                           (band, bucket)).fetchall()
+                    candidates.update(row[0] for row in rows)
+                for other in candidates:
+                    score = similarity(signature, self._signature(other))
+                    if score >= MIN_SIMILARITY:
+                        pair = (min(ticket_number, other), max(ticket_number, other))
+                        self.db.execute("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?)", (*pair, score))
+                        num_pairs += 1
+                self.db.execute("INSERT INTO signatures VALUES (?, ?)", (ticket_number, signature.tobytes()))
+                self.db.executemany("INSERT INTO buckets VALUES (?, ?, ?)",
+                                    [(band, bucket, ticket_number) for band, bucket in enumerate(buckets)])
+            self.db.commit()
+        return num_pairs
+
+    def aliases(self, ticket_numbers):
+        """ Returns the near-duplicate groups of the tickets in `ticket_numbers` as a dict of
+            {representative: [other tickets in the group]}. The representative of a group is its
+            lowest ticket number. Tickets without near-duplicates are not in the dict.
+        """
+        ticket_set = set(ticket_numbers)
+        with self.lock:
+            pairs = self.db.execute("SELECT ticket1, ticket2 FROM pairs").fetchall()
+        parent = {}
+
+        def find(t):
+            root = t
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while t != root:
+                parent[t], t = root, parent[t]
+            return root
+
+        for t1, t2 in pairs:
+            if t1 in ticket_set and t2 in ticket_set:
+                r1, r2 = find(t1), find(t2)
+                if r1 != r2:
+                    parent[max(r1, r2)] = min(r1, r2)
+        groups = defaultdict(list)
+        for t in parent:
+            root = find(t)
+            if t != root:
+                groups[root].append(t)
+        return {root: sorted(others) for root, others in sorted(groups.items())}
@@ -0,0 +1,59 @@
+"""
+    Post recorded Zendesk webhook payloads to a running server.py, for testing the webhook endpoint
+    locally without Zendesk.
+
+    The payloads are signed as Zendesk signs them if --secret or ZENDESK_WEBHOOK_SECRET is set.
+    Each post is timed and the median response time is reported.
+
+    Usage:
+        python server.py &
+        python post_webhook.py webhook_payloads/*.json [--url http://localhost:8000/webhooks/zendesk]
+                                                       [--repeat 10]
+"""
+import base64
+import hashlib
+import hmac
+import os
+import statistics
+import time
+from argparse import ArgumentParser
+import requests
+from utils import load_text
+
+WEBHOOK_URL = "http://localhost:8000/webhooks/zendesk"
+
+def post_payload(url, body, secret=None):
+    """ Posts webhook `body` (bytes) to `url`, signed with `secret` if it is given.
+        Returns: (status code, response text, secs)
+    """
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        # As server.webhook_signature(). server.py isn't imported, since it loads the whole pipeline.
+        timestamp = str(int(time.time()))
+        digest = hmac.new(secret.encode(), timestamp.encode() + body, hashlib.sha256).digest()
+        headers["X-Zendesk-Webhook-Signature-Timestamp"] = timestamp
+        headers["X-Zendesk-Webhook-Signature"] = base64.b64encode(digest).decode()
+    t0 = time.time()
+    response = requests.post(url, data=body, headers=headers, timeout=30)
+    return response.status_code, response.text, time.time() - t0
+
+def main():
+    parser = ArgumentParser(description="Post recorded Zendesk webhook payloads to server.py.")
+    parser.add_argument("paths", nargs="+", help="JSON webhook payload files.")
+    parser.add_argument("--url", default=WEBHOOK_URL, help="The webhook endpoint.")
+    parser.add_argument("--secret", default=os.environ.get("ZENDESK_WEBHOOK_SECRET"),
+        help="The webhook signing secret. Defaults to ZENDESK_WEBHOOK_SECRET.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to post each payload.")
+    args = parser.parse_args()
+
+    secs = []
+    for path in args.paths:
+        body = load_text(path).encode("utf-8")
+        for _ in range(args.repeat):
+            status, text, dt = post_payload(args.url, body, args.secret)
+            secs.append(dt)
+            print(f"{path}: {status} {text} in {dt * 1000:.1f} ms")
+    print(f"Posted {len(secs)} payloads. Median response time {statistics.median(secs) * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
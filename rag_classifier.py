@@ -10,7 +10,6 @@
 import os
 import sys
 import time
-from llama_index.core import SimpleDirectoryReader
 from llama_index.core.response_synthesizers import TreeSummarize
 from llama_index.core.types import BaseModel, Enum
 from typing import List
@@ -271,7 +270,7 @@ class PydanticFeatureGenerator():
 
     Methods:
         summary_path(ticket_number): Returns the path to the summary file for a given ticket number.
-        summarise_ticket(ticket_number, input_files, status): Summarizes the comments for a ticket.
+        summarise_ticket(ticket_number, texts, status): Summarizes the comments for a ticket.
     """
 
     def __init__(self, llm, model,  verbose=False):
@@ -284,13 +283,13 @@ class PydanticFeatureGenerator():
         "Returns the path to the summary file the ticket with number `ticket_number`."
         return os.path.join(self.summary_dir, f"{ticket_number}.txt")
 
-    def summarise_ticket(self, ticket_number, input_files, status):
+    def summarise_ticket(self, ticket_number, texts, status):
         """
         Summarizes the comments for a ticket.
 
         Args:
             ticket_number (int): The ticket number.
-            input_files (list): The list of input files.
+            texts (list[str]): The texts of the ticket's comments.
             status (str): The status of the ticket.
 
         Returns:
@@ -298,12 +297,6 @@ class PydanticFeatureGenerator():
         """
         print("  summariseTicket: -----------------------")
 
-        t0 = time.time()
-        reader = SimpleDirectoryReader(input_files=input_files)
-        docs = reader.load_data()
-
-        texts = [doc.text for doc in docs]
-        print(f"   Loaded {len(texts)} comments in {since(t0):.1f} seconds")
         assert texts, f"No comments for ticket {ticket_number}"
 
         t0 = time.time()
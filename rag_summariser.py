@@ -33,7 +33,6 @@ EVENTS: -------------------------------------------------------------*
 import os
 import sys
 import time
-from llama_index.core import SimpleDirectoryReader
 from llama_index.core.response_synthesizers import TreeSummarize
 from llama_index.core.types import BaseModel
 from typing import List
@@ -150,7 +149,7 @@ class PydanticSummariser():
 
     Methods:
         summary_path(ticket_number): Returns the path to the summary file for a given ticket number.
-        summarise_ticket(ticket_number, input_files, status): Summarizes the comments for a ticket.
+        summarise_ticket(ticket_number, texts, status): Summarizes the comments for a ticket.
     """
 
     def __init__(self, llm, model, verbose=False):
@@ -163,13 +162,13 @@ class PydanticSummariser():
         "Returns the path to the summary file the ticket with number `ticket_number`."
         return os.path.join(self.summary_dir, f"{ticket_number}.txt")
 
-    def summarise_ticket(self, ticket_number, input_files, status):
+    def summarise_ticket(self, ticket_number, texts, status):
         """
         Summarizes the comments for a ticket.
 
         Args:
             ticket_number (int): The ticket number.
-            input_files (list): The list of input files.
+            texts (list[str]): The texts of the ticket's comments.
             status (str): The status of the ticket.
 
         Returns:
@@ -177,12 +176,6 @@ class PydanticSummariser():
         """
         print("  summariseTicket: -----------------------")
 
-        t0 = time.time()
-        reader = SimpleDirectoryReader(input_files=input_files)
-        docs = reader.load_data()
-
-        texts = [doc.text for doc in docs]
-        print(f"   Loaded {len(texts)} comments in {since(t0):.1f} seconds")
         assert texts, f"No comments for ticket {ticket_number}"
 
         t0 = time.time()
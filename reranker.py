@@ -5,11 +5,14 @@
     This has some outrageous global variables that are used to avoid putting @component functions
     inside functions and using closures to pass arguments.
 """
+import asyncio
 import json
 import os
 import sys
+import threading
 import time
 from typing import List
+import httpx
 from haystack import Document, component
 from haystack_integrations.document_stores.chroma import ChromaDocumentStore
 from haystack.components.writers import DocumentWriter
@@ -23,12 +26,23 @@ from llama_index.core.utils import get_tokenizer
 from llama_index.core.text_splitter import SentenceSplitter
 from utils import (load_text, deduplicate, save_json, load_json, since, text_lines, round_score,
                    SummaryReader)
-from config import MODEL_ROOT, SIMILARITIES_ROOT, DIVIDER, FILE_ROOT
-from zendesk_wrapper import comment_paths, make_empty_index
+from config import (MODEL_ROOT, SIMILARITIES_ROOT, DIVIDER, FILE_ROOT, CHANGE_JOURNAL_PATH,
+                    CHANGE_JOURNAL_OFFSETS_DIR, JINA_API_URL)
 from rag_classifier import PydanticFeatureGenerator
+from change_journal import ChangeJournal
+
+# The tickets changed since the Chroma index was last updated are indexed again.
+change_journal = ChangeJournal(CHANGE_JOURNAL_PATH, CHANGE_JOURNAL_OFFSETS_DIR)
 
 TOP_K = 10
 RECURSIVE_THRESHOLD = 0.8
+# The number of rerank requests of a batch that are in flight at the same time.
+NUM_RERANK_WORKERS = 8
+JINA_EMBEDDING_MODEL = "jina-embeddings-v2-base-en"
+
+def jina_url(endpoint):
+    "Returns the keyword arguments that point a Jina component at `endpoint` of JINA_API_URL, if it is set."
+    return {"base_url": f"{JINA_API_URL}/{endpoint}"} if JINA_API_URL else {}
 
 HAYSTACK_SUB_ROOT = os.path.join(SIMILARITIES_ROOT, "summaries.haystack")
 SIMILARITIES_PATH = os.path.join(HAYSTACK_SUB_ROOT, "similarities.json")
@@ -89,11 +103,8 @@ class ZendeskWrapper:
 
         """
         self.summariser = summariser
-        filter_df = make_empty_index(add_custom_fields=True)
-        for ticket_number in df.index:
-            summary_path = self.summariser.summary_path(ticket_number)
-            if os.path.exists(summary_path):
-                filter_df.loc[ticket_number] = df.loc[ticket_number]
+        has_summary = [os.path.exists(self.summariser.summary_path(t)) for t in df.index]
+        filter_df = df.loc[has_summary]
         print(f"ZendeskWrapper: {len(filter_df)} tickets of {len(df.index)} with summaries")
         self.df = filter_df
         self.columns = [col for col in self.df.columns if not col.startswith("comments_")]
@@ -113,6 +124,22 @@ class ZendeskWrapper:
         ticket_dict["updated_at"] = ticket_dict["updated_at"].isoformat()
         return ticket_dict
 
+    def updated(self, df, ticket_numbers):
+        """
+        Returns a ZendeskWrapper for the ticket index `df`, which differs from this one's index only
+        in the tickets `ticket_numbers`. Only the summaries of those tickets are checked, instead of
+        every ticket's.
+        """
+        changed = df.index.isin(list(ticket_numbers))
+        has_summary = [os.path.exists(self.summariser.summary_path(t)) for t in df.index[changed]]
+        keep = df.index.isin(self.df.index) & ~changed
+        keep[changed] = has_summary
+        wrapper = ZendeskWrapper.__new__(ZendeskWrapper)
+        wrapper.summariser = self.summariser
+        wrapper.df = df.loc[keep]
+        wrapper.columns = [col for col in wrapper.df.columns if not col.startswith("comments_")]
+        return wrapper
+
 hsqe = None
 
 @component
@@ -171,7 +198,8 @@ def build_indexing_pipeline(document_store):
     pipeline = Pipeline()
     pipeline.add_component("loader", LoadTickets())
     pipeline.add_component("converter", TicketToText())
-    pipeline.add_component("embedder", JinaDocumentEmbedder(model="jina-embeddings-v2-base-en"))
+    pipeline.add_component("embedder", JinaDocumentEmbedder(model=JINA_EMBEDDING_MODEL,
+                                                             **jina_url("embeddings")))
     pipeline.add_component("writer", DocumentWriter(document_store=document_store, policy=DuplicatePolicy.SKIP))
 
     pipeline.connect("loader", "converter")
@@ -191,10 +219,11 @@ def build_query_pipeline(document_store):
     """
     retriever = ChromaEmbeddingRetriever(document_store=document_store)
     pipeline = Pipeline()
-    pipeline.add_component("query_embedder", JinaTextEmbedder(model="jina-embeddings-v2-base-en"))
+    pipeline.add_component("query_embedder", JinaTextEmbedder(model=JINA_EMBEDDING_MODEL,
+                                                                   **jina_url("embeddings")))
     pipeline.add_component("query_retriever", retriever)
     pipeline.add_component("query_cleaner", RemoveRelated())
-    pipeline.add_component("query_ranker", JinaRanker())
+    pipeline.add_component("query_ranker", JinaRanker(**jina_url("rerank")))
 
     pipeline.connect("query_embedder.embedding", "query_retriever.query_embedding")
     pipeline.connect("query_retriever", "query_cleaner")
@@ -224,6 +253,8 @@ class HaystackQueryEngine:
         self.query_pipeline = None #  build_query_pipeline(document_store)
         uploaded = load_json(CHROMA_UPLOADED_PATH) if os.path.exists(CHROMA_UPLOADED_PATH) else []
         self.uploaded = set(uploaded)
+        # The tickets whose documents were removed by remove_tickets() to be indexed again.
+        self.reindexed = set()
 
         self.zd = ZendeskWrapper(df, summariser)
 
@@ -231,6 +262,22 @@ class HaystackQueryEngine:
         "Saves the uploaded ticket numbers to a file."
         save_json(CHROMA_UPLOADED_PATH, list(self.uploaded))
 
+    def remove_tickets(self, ticket_numbers):
+        """ Removes the documents of the tickets in `ticket_numbers` from the document store, so that
+            the indexing pipeline indexes them again.
+        """
+        ticket_numbers = [int(t) for t in ticket_numbers]
+        if not ticket_numbers:
+            return
+        filters = {"field": "meta.ticket_number", "operator": "in", "value": ticket_numbers}
+        docs = self.document_store.filter_documents(filters=filters)
+        if docs:
+            self.document_store.delete_documents([doc.id for doc in docs])
+        self.uploaded -= set(ticket_numbers)
+        self.reindexed |= set(ticket_numbers)
+        self.save_uploaded()
+        print(f"Removed {len(docs)} documents of {len(ticket_numbers)} changed tickets")
+
     def make_ticket(self, ticket_number):
         "Creates a Zendesk ticket object based on the ticket number."
         return self.zd.make_ticket(ticket_number)
@@ -278,10 +325,81 @@ class HaystackQueryEngine:
                   file=sys.stderr)
             raise
             return None
-        docs = result["query_ranker"]["documents"]
-        results = [(doc.meta["ticket_number"], doc.score) for doc in docs]
-        results.sort(key=lambda x: (-round_score(x[1]), x[0]))
-        return results
+        return ranked_results(result["query_ranker"]["documents"])
+
+    def find_closest_batch(self, queries, top_k, num_workers=NUM_RERANK_WORKERS):
+        """
+        Finds the closest `top_k` tickets to each of `queries` as one batch. This gives the same
+        results as find_closest_tickets() for each query, with far fewer API round trips:
+        - The query contents are embedded in batched Jina requests.
+        - The document store is searched for all the embeddings in one call.
+        - The queries are reranked with rerank_batch().
+
+        Args:
+            queries (list): A list of (query_id, content) tuples. `query_id` is the number of the
+                query's ticket, which is left out of its results, or None for a raw text query.
+            top_k (int): The maximum number of closest tickets to retrieve for each query.
+
+        Returns:
+            list: A list of the results of each query, as returned by find_closest_tickets().
+        """
+        if not queries:
+            return []
+        docs = [Document(content=content) for _, content in queries]
+        docs = self.batch_embedder.run(documents=docs)["documents"]
+        retrieved = self.document_store.search_embeddings([doc.embedding for doc in docs],
+                                                          top_k=max(20, 4 * top_k))
+
+        requests = []
+        for (query_id, content), docs in zip(queries, retrieved):
+            candidates = [doc for doc in docs if doc.meta["ticket_number"] != query_id]
+            requests.append((content, candidates))
+        # This runs in a worker thread in server.py, so it has no event loop of its own.
+        return asyncio.run(self.rerank_batch(requests, top_k, num_workers))
+
+    async def rerank_batch(self, requests, top_k, num_workers=NUM_RERANK_WORKERS):
+        """
+        Reranks the candidates for many queries with the same Jina model and API as the query
+        pipeline's JinaRanker. Jina's rerank API scores one query per request, so the requests are
+        sent together, `num_workers` at a time, over one pooled HTTP client. JinaRanker creates a
+        client, with its TLS setup, for every request.
+
+        Args:
+            requests (list): A list of (query content, candidate documents) tuples.
+            top_k (int): The maximum number of tickets to return for each query.
+
+        Returns:
+            list: A list of the results of each query, as returned by find_closest_tickets().
+        """
+        ranker = self.ranker
+        headers = {"Authorization": f"Bearer {ranker.api_key.resolve_value()}",
+                   "Content-Type": "application/json"}
+        semaphore = asyncio.Semaphore(max(1, num_workers))
+        limits = httpx.Limits(max_connections=max(1, num_workers))
+
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+            async def rerank(content, candidates):
+                if not candidates:
+                    return []
+                data = {"query": content, "documents": [doc.content or "" for doc in candidates],
+                        "model": ranker.model, "top_n": top_k}
+                async with semaphore:
+                    response = await client.post(ranker.base_url, json=data)
+                result = response.json()
+                assert "results" in result, f"Jina rerank failed: {result.get('detail', result)}"
+                return sort_results([(candidates[r["index"]].meta["ticket_number"], r["relevance_score"])
+                                     for r in result["results"][:top_k]])
+
+            return await asyncio.gather(*[rerank(content, candidates)
+                                          for content, candidates in requests])
+
+def sort_results(results):
+    "Returns the (ticket_number, score) `results` sorted by score, highest first."
+    return sorted(results, key=lambda x: (-round_score(x[1]), x[0]))
+
+def ranked_results(docs):
+    "Returns the (ticket_number, score) of the ranked `docs`, highest score first."
+    return sort_results([(doc.meta["ticket_number"], doc.score) for doc in docs])
 
 def load_hsqe(df, llm, model_name):
     """
@@ -306,18 +424,37 @@ def load_hsqe(df, llm, model_name):
         return hsqe
 
     hsqe = HaystackQueryEngine(df, summariser)
+    hsqe.indexing_pipeline = build_indexing_pipeline(hsqe.document_store)
+    index_tickets(hsqe, model_name)
+    hsqe.query_pipeline = build_query_pipeline(hsqe.document_store)
+    # The components of find_closest_batch(), which embeds many texts per request.
+    hsqe.batch_embedder = JinaDocumentEmbedder(model=JINA_EMBEDDING_MODEL, progress_bar=False,
+                                               **jina_url("embeddings"))
+    hsqe.ranker = JinaRanker(**jina_url("rerank"))
+
+    return hsqe
+
+def index_tickets(hsqe, model_name):
+    """
+    Indexes the tickets with summaries in `hsqe` that aren't in its document store yet.
+    The tickets changed since this model's index was last updated are indexed again. Run this after
+    summarise_tickets.py --changed, so that they are indexed with their new summaries.
+
+    Returns:
+        list: The numbers of the changed tickets.
+    """
+    journal_consumer = f"chroma.{model_name}"
+    changed, journal_offset = change_journal.pending_tickets(journal_consumer, include_deleted=True)
+    hsqe.remove_tickets(changed)
 
     ticket_numbers = hsqe.zd.df.index
     store_count = hsqe.document_store.count_documents()
     print(f"document_store has {store_count} documents")
     print(f"Indexing {len(ticket_numbers)} tickets")
 
-    hsqe.indexing_pipeline = build_indexing_pipeline(hsqe.document_store)
     hsqe.indexing_pipeline.run({"loader": {"ticket_numbers": ticket_numbers}})
-
-    hsqe.query_pipeline = build_query_pipeline(hsqe.document_store)
-
-    return hsqe
+    change_journal.commit(journal_consumer, journal_offset)
+    return changed
 
 class QueryEngine:
     """
@@ -325,10 +462,50 @@ class QueryEngine:
     """
 
     def __init__(self, df, llm, model_name):
+        self.model_name = model_name
         self.hsqe = load_hsqe(df, llm, model_name)
         os.makedirs(HAYSTACK_SUB_ROOT, exist_ok=True)
         similarities = load_json(SIMILARITIES_PATH) if os.path.exists(SIMILARITIES_PATH) else {}
         self.similarities = {int(k): v for k, v in similarities.items()}
+        # Guards `similarities`, so that server.py can look up tickets from several threads. The
+        # query pipeline runs without it.
+        self.lock = threading.Lock()
+        self.drop_similarities(self.hsqe.reindexed)
+
+    def save_similarities(self):
+        "Saves the cached results to SIMILARITIES_PATH."
+        with self.lock:
+            save_json(SIMILARITIES_PATH, self.similarities)
+
+    def cached_result(self, ticket_number, top_k):
+        "Returns the cached result for `ticket_number` if it has at least `top_k` tickets, else None."
+        with self.lock:
+            result = self.similarities.get(ticket_number)
+        return result if result is not None and len(result) >= top_k else None
+
+    def drop_similarities(self, ticket_numbers):
+        "Drops the cached results for or including the re-indexed `ticket_numbers`, which are out of date."
+        ticket_set = set(ticket_numbers)
+        if not ticket_set:
+            return
+        with self.lock:
+            self.similarities = {k: v for k, v in self.similarities.items()
+                                 if k not in ticket_set and not any(t in ticket_set for t, _ in v)}
+        self.save_similarities()
+
+    def refresh(self, df, ticket_numbers=None):
+        """
+        Updates the query engine to the ticket index `df`, indexing only the new and changed tickets.
+        The document store and pipelines are kept, so this is much faster than a new QueryEngine.
+        If `ticket_numbers` is given, `df` differs from the current index only in those tickets, and
+        only their summaries are checked.
+        """
+        if ticket_numbers is None:
+            self.hsqe.zd = ZendeskWrapper(df, self.hsqe.summariser)
+        else:
+            self.hsqe.zd = self.hsqe.zd.updated(df, ticket_numbers)
+        changed = index_tickets(self.hsqe, self.model_name)
+        self.drop_similarities(changed)
 
     def ticket_numbers(self):
         "Returns the ticket numbers in the Zendesk data."
@@ -338,13 +515,15 @@ class QueryEngine:
         "Returns the content string for the given ticket number."
         return self.hsqe.ticket_content(ticket_number, allow_not_exist=allow_not_exist)
 
-    def find_closest_tickets(self, ticket_numbers, top_k=TOP_K):
+    def find_closest_tickets(self, ticket_numbers, top_k=TOP_K, save=True):
         """
         Finds the closest tickets based on the given ticket numbers.
 
         Args:
             ticket_numbers (list): A list of ticket numbers to find the closest tickets for.
             top_k (int, optional): The maximum number of closest tickets to return. Defaults to TOP_K.
+            save (bool, optional): Whether to save the new results to SIMILARITIES_PATH. Defaults to
+                True. server.py saves them with save_similarities() instead of on each lookup.
 
         Returns:
             list: A list of tuples containing the ticket number and its corresponding closest tickets.
@@ -353,24 +532,60 @@ class QueryEngine:
         save_interval = 10
         t0 = time.time()
         for i, ticket_number in enumerate(ticket_numbers):
-            n_similar = len(self.similarities.get(ticket_number, {}))
-            if n_similar < top_k:
+            if self.cached_result(ticket_number, top_k) is None:
                 result = self.hsqe.find_closest_tickets(ticket_number, top_k)
                 if result is None:
                     continue
-                self.similarities[ticket_number] = result
+                with self.lock:
+                    self.similarities[ticket_number] = result
                 num_changes += 1
-                if num_changes >= save_interval:
+                if save and num_changes >= save_interval:
                     print(f"Saving {num_changes:4} changes {len(self.similarities):5} results to " +
                           f"{SIMILARITIES_PATH} {since(t0):4.1f} sec")
-                    save_json(SIMILARITIES_PATH, self.similarities)
+                    self.save_similarities()
                     num_changes = 0
                     t0 = time.time()
                     if save_interval < 1_000:
                         save_interval *= 10
-        if num_changes > 0:
-            save_json(SIMILARITIES_PATH, self.similarities)
-        return [(t, self.similarities[t]) for t in ticket_numbers if t in self.similarities]
+        if save and num_changes > 0:
+            self.save_similarities()
+        with self.lock:
+            return [(t, self.similarities[t]) for t in ticket_numbers if t in self.similarities]
+
+    def find_closest_batch(self, ticket_numbers=(), texts=(), top_k=TOP_K, use_cache=True, save=True):
+        """
+        Finds the closest tickets to many tickets and raw texts in one batch with
+        HaystackQueryEngine.find_closest_batch().
+
+        Args:
+            ticket_numbers (list): The ticket numbers to find the closest tickets for. Tickets
+                without summaries are left out of the results.
+            texts (list): Raw texts, e.g. a new ticket's description, to find the closest tickets for.
+            top_k (int, optional): The maximum number of closest tickets to return for each query.
+            use_cache (bool, optional): Whether to return cached ticket results instead of querying
+                again. Defaults to True.
+            save (bool, optional): Whether to save the new results to SIMILARITIES_PATH. Defaults to True.
+
+        Returns:
+            tuple: (ticket_results, text_results) where `ticket_results` is a list of tuples of a
+                ticket number and its closest tickets, like find_closest_tickets() returns, and
+                `text_results` is a list of the closest tickets for each of `texts`.
+        """
+        index = self.hsqe.zd.df.index
+        queried = [t for t in ticket_numbers if t in index and
+                   (not use_cache or self.cached_result(t, top_k) is None)]
+        queries = [(t, self.hsqe.ticket_content(t)) for t in queried]
+        queries += [(None, text) for text in texts]
+        results = self.hsqe.find_closest_batch(queries, top_k)
+        with self.lock:
+            for t, result in zip(queried, results):
+                self.similarities[t] = result
+        if save and queried:
+            self.save_similarities()
+        with self.lock:
+            ticket_results = [(t, self.similarities[t][:top_k]) for t in ticket_numbers
+                              if t in self.similarities]
+        return ticket_results, results[len(queried):]
 
     def find_closest_tickets_recurse(self, ticket_numbers, top_k=TOP_K, max_results=3*TOP_K,
                                      threshold=RECURSIVE_THRESHOLD):
@@ -1,18 +1,29 @@
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
 from dateutil import parser
 from datetime import timezone
 import uvicorn
 import datetime
-from datetime import datetime, timedelta
+from datetime import datetime
 from dateutil import parser
 from typing import List, Dict, Any
-from time import sleep
-
-from zendesk_wrapper import fetch_all_ticket_batches, fetch_ticket_comments, load_create_index, update_index
-from find_closest_tickets import get_k_nearest
-from customer import cx_issues
-
-from customer import all_comments
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+from time import time
+
+from config import SERVER_POLL_STATE_PATH, NUM_UPDATE_WORKERS, MAX_PENDING_UPDATES
+from utils import load_json, save_json
+from zendesk_wrapper import (fetch_changed_tickets, get_author_cache, fetch_ticket, fetch_tickets,
+                             get_change_journal, make_url)
+from change_journal import TICKET_CREATED, COMMENT_ADDED, TICKET_UPDATED
+from update_queue import UpdateQueue
+from similarity_service import SimilarityService
 
 class Issue:
     def __init__(self, id, subject, body, url, updated_at, raw = None):
@@ -21,12 +32,41 @@ class Issue:
         self.body = body
         self.url = url
         self.updated_at = updated_at
+        self.raw = raw or {}
+        # The Zendesk ticket's priority. customer.py's example issues have text rather than a ticket.
+        self.priority = self.raw.get("priority") if isinstance(self.raw, dict) else None
+
+# customer.py imports Issue from this module, so it is imported after Issue is defined.
+import customer
+
+def handle_if_new(issue: Issue):
+    if is_new(issue):
+        handle_update(issue)
 
-app = FastAPI()
+# Ticket updates waiting for handle_update(), from the webhook, the reconciliation poller and the
+# change journal. Repeated updates to a ticket are handled once, in the ticket's latest state.
+updates = UpdateQueue(handle_if_new, NUM_UPDATE_WORKERS, MAX_PENDING_UPDATES)
+
+# Finds similar tickets with an index and query pipeline that are loaded once and kept up to date.
+similarity_service = SimilarityService()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    updates.start()
+    similarity_service.start()
+    poller = asyncio.create_task(poll_for_issues())
+    yield
+    poller.cancel()
+    await similarity_service.stop()
+    await updates.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 all_issues: Dict[int, Issue] = {}
 
 BOT_AUTHOR_ID=34135425366419
+# Zendesk user roles of the people who resolve tickets.
+RESOLVER_ROLES = {"agent", "admin"}
 
 def resolve_ticket(ticket_id: int):
     """
@@ -34,11 +74,20 @@ def resolve_ticket(ticket_id: int):
     """
     pass
 
+def is_resolver(author_id: int) -> bool:
+    "Returns True if the comment author `author_id` is our bot or a Zendesk agent."
+    if author_id == BOT_AUTHOR_ID:
+        return True
+    author = get_author_cache().get(author_id)
+    return bool(author) and author.get("role") in RESOLVER_ROLES
+
 def construct_comments_str(comments: List[Dict[str, Any]]) -> str:
     comments_str = ""
 
+    # Fetch all the uncached authors in bulk before looking them up one at a time.
+    get_author_cache().resolve(int(comment["author_id"]) for comment in comments)
     for comment in comments:
-        if int(comment["author_id"]) == BOT_AUTHOR_ID:
+        if is_resolver(int(comment["author_id"])):
             comments_str += f"Resolver: {comment['plain_body']}\n"
         else:
             comments_str += f"\nRequestor: {comment['plain_body']}\n"
@@ -51,11 +100,11 @@ def handle_update(new_issue: Issue):
     the ticket.
     """
     # comments = fetch_ticket_comments(new_issue.id)
-    comments = all_comments
+    comments = customer.all_comments
     comments_str = construct_comments_str(comments)
 
     # similar_tickets = get_similar_tickets(new_issue)
-    similar_tickets = [cx_issues[10], cx_issues[11], cx_issues[12]]
+    similar_tickets = [customer.cx_issues[10], customer.cx_issues[11], customer.cx_issues[12]]
 
     resolve_sys_prompt.format(new_issue.body, comments_str, similar_tickets)
     is_done = False # TODO query claude
@@ -74,63 +123,200 @@ def get_similar_tickets(original_ticket: Issue):
     """
     wrapper around returning similar tickets
     """
-    tickets = get_k_nearest(original_ticket.id, 3)
-    return tickets
+    return similarity_service.get_similar_tickets(original_ticket.id, 3)
 
-def get_all_issues():
-    tickets = fetch_all_ticket_batches("/dev/null", 50, True)
-    # print(tickets)
-    tickets_typed: List[Issue] = []
+def ticket_to_issue(ticket: Dict[str, Any]) -> Issue:
+    return Issue(ticket["id"], ticket["raw_subject"], ticket["description"], ticket["url"],
+                 ticket["updated_at"], ticket)
 
-    # convert each ticket to an Issue type
-    for ticket in tickets:
-        issue = Issue(ticket["id"], ticket["raw_subject"], ticket["description"], ticket["url"], ticket["updated_at"], ticket)
-        tickets_typed.append(issue)
+# Seconds between polls. Zendesk allows 10 incremental export requests a minute.
+POLL_SECS = 10
+# Seconds between polls when updates arrive by webhook. These polls only catch the updates whose
+# webhooks failed.
+RECONCILE_SECS = 300
+# Zendesk's incremental export needs a start_time at least a minute in the past.
+MIN_START_AGE_SECS = 60
 
-    return tickets_typed
-
-def is_new(issue: Issue):
-    not_in = issue.id not in all_issues
-    ts = parser.parse(issue.updated_at).replace(tzinfo=timezone.utc) > parser.parse(all_issues[issue.id].updated_at).replace(tzinfo=timezone.utc)
-
-    return not_in or ts
+def load_poll_state() -> Dict[str, Any]:
+    """
+    Returns the poller's state: the `watermark`, the latest `updated_at` handled, and the
+    incremental export `cursor` after the last ticket fetched. The first poll starts from
+    now, so the existing tickets aren't handled.
+    """
+    if os.path.exists(SERVER_POLL_STATE_PATH):
+        return load_json(SERVER_POLL_STATE_PATH)
+    start = datetime.fromtimestamp(time() - MIN_START_AGE_SECS, tz=timezone.utc)
+    return {"watermark": start.strftime('%Y-%m-%dT%H:%M:%SZ'), "cursor": None}
 
-def poll_for_issues():
+def get_changed_issues(state: Dict[str, Any]) -> List[Issue]:
     """
-    Call the zendesk python api. Sleep for 5 sec. Call a 
-    handler for every update.
+    Returns the issues of the tickets changed since the poll `state`, and advances the state.
+    Only the changed tickets are fetched, so the cost of a poll scales with the number of changes,
+    not the number of tickets. The watermark is used to restart the export if there is no cursor.
     """
-    global all_issues
+    start_time = int(parser.parse(state["watermark"]).timestamp())
+    tickets, cursor = fetch_changed_tickets(start_time, state.get("cursor"))
+    issues = [ticket_to_issue(ticket) for ticket in tickets if ticket.get("status") != "deleted"]
 
-    # get all issues for the first time
-    curr_issues = get_all_issues()
+    state["cursor"] = cursor
+    if tickets:
+        state["watermark"] = max([state["watermark"]] + [ticket["updated_at"] for ticket in tickets])
+    save_json(SERVER_POLL_STATE_PATH, state)
+    return issues
 
-    # make the update time current.
-    time_format = '%Y-%m-%dT%H:%M:%SZ'
-    for i in range(len(curr_issues)):
-        dt = datetime.strptime(curr_issues[i].updated_at, time_format)
+# The server's consumer name in the change journal written by ingestion.
+JOURNAL_CONSUMER = "server"
 
-        # Add 5 seconds
-        new_time = dt + timedelta(seconds=5)
+async def handle_journal_updates():
+    """
+    Handle the tickets that ingestion (download_tickets.py) found created or changed since
+    the server last read the change journal.
+    """
+    ticket_numbers, offset = get_change_journal().pending_tickets(
+        JOURNAL_CONSUMER, [TICKET_CREATED, COMMENT_ADDED, TICKET_UPDATED])
+    tickets = await run_in_threadpool(fetch_tickets, ticket_numbers)
+    for ticket_number in ticket_numbers:
+        if ticket_number in tickets:
+            await updates.put(ticket_to_issue(tickets[ticket_number]))
+    get_change_journal().commit(JOURNAL_CONSUMER, offset)
+    print(f"Queued {len(tickets)} tickets from the change journal")
 
-        # Convert back to string
-        new_time_string = new_time.strftime(time_format)
+def is_new(issue: Issue):
+    if issue.id not in all_issues:
+        return True
+    ts = (parser.parse(issue.updated_at).replace(tzinfo=timezone.utc) >
+          parser.parse(all_issues[issue.id].updated_at).replace(tzinfo=timezone.utc))
+
+    return ts
+
+# The poller's state, loaded by the first poll, and a lock so that a triggered poll and the
+# reconciliation loop don't both advance it at once.
+poll_state: Dict[str, Any] = {}
+poll_lock = asyncio.Lock()
+
+async def poll_once() -> int:
+    "Queue the updates to the tickets changed since the last poll. Returns the number queued."
+    async with poll_lock:
+        if not poll_state:
+            poll_state.update(load_poll_state())
+        issues = await run_in_threadpool(get_changed_issues, poll_state)
+    issues = [issue for issue in issues if is_new(issue)]
+    for issue in issues:
+        await updates.put(issue)
+    return len(issues)
+
+async def poll_for_issues(poll_secs: int = RECONCILE_SECS):
+    """
+    Poll Zendesk for the tickets changed since the watermark every `poll_secs`
+    seconds and queue every update for the handler. Updates normally arrive
+    sooner by webhook, so this is a slow reconciliation loop. Use POLL_SECS
+    if there is no webhook. It runs for the life of the server.
+    """
+    while True:
+        try:
+            await poll_once()
+        except Exception as e:
+            print(f"Polling Zendesk failed: {e}")
 
-        curr_issues[i].updated_at = new_time_string
-        all_issues[curr_issues[i].id] = curr_issues[i]
+        await asyncio.sleep(poll_secs)
 
-    while True:
-        new_issues: List[Issue] = get_all_issues()
+# Set ZENDESK_WEBHOOK_SECRET to the webhook's signing secret to reject requests that Zendesk didn't sign.
+WEBHOOK_SECRET = os.environ.get("ZENDESK_WEBHOOK_SECRET")
 
-        for issue in new_issues:
-            if is_new(issue):
-                handle_update(issue)
+def webhook_signature(body: bytes, timestamp: str, secret: str) -> str:
+    """
+    Returns the signature Zendesk sends in X-Zendesk-Webhook-Signature for a request `body`.
+    https://developer.zendesk.com/documentation/webhooks/verifying/
+    """
+    digest = hmac.new(secret.encode(), timestamp.encode() + body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
 
-        sleep(5)
+def webhook_issue(payload: Dict[str, Any]) -> Issue:
+    """
+    Returns the issue of a Zendesk webhook `payload`. This is either a ticket event, with the
+    ticket in "detail", or a trigger payload with a "ticket" object or just a ticket id. The
+    ticket is fetched if the payload doesn't have its subject, description and updated_at.
+    """
+    ticket = payload.get("detail") or payload.get("ticket") or payload
+    ticket_id = ticket.get("id") or ticket.get("ticket_id")
+    if not ticket_id:
+        raise HTTPException(status_code=400, detail="No ticket id in the webhook payload")
+    ticket_id = int(ticket_id)
+    if all(key in ticket for key in ("subject", "description", "updated_at")):
+        return Issue(ticket_id, ticket["subject"], ticket["description"],
+                     make_url(f"tickets/{ticket_id}.json"), ticket["updated_at"], ticket)
+    fetched = fetch_ticket(ticket_id)
+    if not fetched:
+        raise HTTPException(status_code=404, detail=f"Ticket {ticket_id} not found")
+    return ticket_to_issue(fetched)
 
 @app.get("/trigger_poll")
-async def trigger_poll(background_tasks: BackgroundTasks):
-    background_tasks.add_task(poll_for_issues)
+async def trigger_poll():
+    "Poll Zendesk now instead of waiting for the next reconciliation poll."
+    return {"queued": await poll_once()}
+
+@app.get("/update_queue")
+async def update_queue_stats():
+    return updates.stats()
+
+@app.post("/webhooks/zendesk")
+async def zendesk_webhook(request: Request):
+    """
+    Receives Zendesk ticket update webhooks and queues the updates for handle_update().
+    Test it locally with post_webhook.py.
+    """
+    body = await request.body()
+    if WEBHOOK_SECRET:
+        timestamp = request.headers.get("X-Zendesk-Webhook-Signature-Timestamp", "")
+        signature = request.headers.get("X-Zendesk-Webhook-Signature", "")
+        if not hmac.compare_digest(signature, webhook_signature(body, timestamp, WEBHOOK_SECRET)):
+            raise HTTPException(status_code=401, detail="Bad webhook signature")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Webhook body is not JSON")
+    issue = await run_in_threadpool(webhook_issue, payload)
+    await updates.put(issue)
+    return {"queued": issue.id}
+
+@app.get("/similar_tickets/{ticket_id}")
+async def similar_tickets(ticket_id: int, k: int = 3):
+    if not similarity_service.ready:
+        raise HTTPException(status_code=503, detail="Similarity service is loading")
+    return await run_in_threadpool(similarity_service.get_similar_tickets, ticket_id, k)
+
+# The most tickets and texts in one /similar_tickets request.
+MAX_SIMILAR_BATCH = 200
+
+class SimilarTicketsRequest(BaseModel):
+    ticket_ids: List[int] = []
+    texts: List[str] = []
+    k: int = 3
+    use_cache: bool = True
+
+@app.post("/similar_tickets")
+async def similar_tickets_batch(request: SimilarTicketsRequest):
+    """
+    Returns the `k` most similar tickets to each of `ticket_ids` and `texts` in one response.
+    The queries are embedded, retrieved and reranked as one batch. Compare its latency with single
+    lookups with benchmark_similarity.py.
+    """
+    if not similarity_service.ready:
+        raise HTTPException(status_code=503, detail="Similarity service is loading")
+    if len(request.ticket_ids) + len(request.texts) > MAX_SIMILAR_BATCH:
+        raise HTTPException(status_code=400, detail=f"More than {MAX_SIMILAR_BATCH} tickets and texts")
+    if request.k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1")
+    return await run_in_threadpool(similarity_service.get_similar_batch, request.ticket_ids,
+                                   request.texts, request.k, request.use_cache)
+
+@app.get("/similarity_service")
+async def similarity_service_stats():
+    return similarity_service.stats()
+
+@app.get("/journal_updates")
+async def journal_updates():
+    await handle_journal_updates()
 
 if __name__ == "__main__":
     uvicorn.run("server:app", host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -22,4 +22,5 @@ pip3 install hdbscan
 python3 -m pip3 install -U matplotlib
 
 # Everything else
-pip3 install seaborn
\ No newline at end of file
+pip3 install seaborn
+pip3 install pyarrow
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+    A process-lifetime similarity service that keeps the ticket index, the feature summariser and the
+    Haystack query pipeline loaded, so similar tickets are found without reloading them per lookup.
+
+    server.py creates one SimilarityService in its FastAPI lifespan. start() loads it in a thread
+    without holding up the server's startup, and then refreshes it every `refresh_secs` from the
+    change journal. The service never fetches tickets or writes the index. download_tickets.py does
+    that, and appends the changes to the journal. A refresh
+    - reloads the index rows of only the changed tickets, from the index partitions they are in,
+    - summarises the changed tickets again, and
+    - calls QueryEngine.refresh(), which indexes only the new and changed tickets in Chroma and drops
+      their cached results.
+    get_similar_tickets() answers from the cached results or a single query pipeline run.
+    get_similar_batch() answers many tickets and raw texts with one batched query.
+    Lookups run concurrently with each other and with refreshes.
+"""
+import asyncio
+import time
+import pandas as pd
+from config import SIMILARITY_REFRESH_SECS
+from utils import since
+from models import LLM_MODELS
+from ticket_processor import ZendeskData
+from reranker import QueryEngine
+from index_store import categorise
+from zendesk_wrapper import load_existing_index, get_change_journal
+from change_journal import TICKET_DELETED
+
+# The index columns returned with each similar ticket.
+METADATA_COLUMNS = ["subject", "status", "priority", "created_at", "updated_at"]
+
+class SimilarityService:
+    """
+    Finds the tickets most similar to a ticket with a warm QueryEngine for LLM `model_name`, the
+    first of LLM_MODELS by default.
+    """
+    def __init__(self, model_name=None, refresh_secs=SIMILARITY_REFRESH_SECS):
+        self.model_name = model_name or next(iter(LLM_MODELS.keys()))
+        self.refresh_secs = refresh_secs
+        self.zd = None
+        self.summariser = None
+        self.query_engine = None
+        self.ready = False
+        self.task = None
+        self.num_refreshes = 0
+        self.last_refresh = None
+
+    def load(self):
+        "Loads the index, the LLM and the query engine. This takes minutes on a large index."
+        t0 = time.time()
+        self.zd = ZendeskData(read_only=True)
+        llm, model = LLM_MODELS[self.model_name]().load()
+        self.query_engine = QueryEngine(self.zd.df, llm, model)
+        self.summariser = self.query_engine.hsqe.summariser
+        self.journal_consumer = f"similarity_service.{model}"
+        if not get_change_journal().offset(self.journal_consumer):
+            # The first run summarises only the tickets changed from now on. Run
+            # summarise_tickets.py --features --changed to summarise the earlier changes.
+            _, journal_offset = get_change_journal().pending(self.journal_consumer)
+            get_change_journal().commit(self.journal_consumer, journal_offset)
+        self.ready = True
+        print(f"SimilarityService: loaded {len(self.zd.df)} tickets in {since(t0):.1f} secs")
+
+    def changed_rows(self, events):
+        """
+        Returns the stored index rows of the tickets changed by the change journal `events`. Only
+        the index partitions of the months the tickets were created in are read.
+        """
+        last_type = {event["ticket_number"]: event["type"] for event in events}
+        changed = {t for t, event_type in last_type.items() if event_type != TICKET_DELETED}
+        if not changed:
+            return self.zd.df.iloc[:0]
+        df = self.zd.df
+        created = {t: df.at[t, "created_at"].date() for t in changed if t in df.index}
+        for event in events:
+            if event.get("created_at") and event["ticket_number"] in changed:
+                created[event["ticket_number"]] = pd.Timestamp(event["created_at"]).date()
+        if len(created) < len(changed):
+            # Events from before the journal recorded created_at. Read every partition.
+            min_date = max_date = None
+        else:
+            min_date, max_date = min(created.values()), max(created.values())
+        rows = load_existing_index(min_date, max_date, read_only=True)
+        return rows[rows.index.isin(list(changed))]
+
+    def refresh(self):
+        """
+        Brings the service up to date with the tickets changed in the change journal since the last
+        refresh. Only those tickets are reloaded, summarised and indexed.
+        """
+        t0 = time.time()
+        events, journal_offset = get_change_journal().pending(self.journal_consumer)
+        if not events:
+            self.query_engine.save_similarities()
+            return
+        changed = sorted({event["ticket_number"] for event in events})
+        rows = self.changed_rows(events)
+        df = self.zd.df
+        df = pd.concat([df[~df.index.isin(changed)], rows])
+        df.index.name = "ticket_number"
+        # Concatenating categoricals with different categories gives object columns.
+        df = categorise(df)
+        self.zd.df = df
+
+        summarised = list(rows.index)
+        if summarised:
+            self.zd.summarise_tickets(summarised, self.summariser, overwrite=True)
+        self.query_engine.refresh(df, changed)
+        self.query_engine.save_similarities()
+        get_change_journal().commit(self.journal_consumer, journal_offset)
+        self.num_refreshes += 1
+        self.last_refresh = time.time()
+        print(f"SimilarityService: refreshed {len(changed)} changed tickets in {since(t0):.1f} secs")
+
+    async def _run(self):
+        await asyncio.to_thread(self.load)
+        while True:
+            await asyncio.sleep(self.refresh_secs)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"SimilarityService: refresh failed: {e}")
+
+    def start(self):
+        "Starts loading and refreshing the service. Must be called from the event loop."
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        "Stops refreshing the service."
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.ready:
+            self.query_engine.save_similarities()
+
+    def get_similar_tickets(self, ticket_number, k):
+        """
+        Returns the `k` tickets most similar to ticket `ticket_number` as a list of dicts of their
+        ticket_number, score and METADATA_COLUMNS, most similar first. Returns an empty list while
+        the service is loading or if the ticket has no summary. New results are saved by the next
+        refresh.
+        """
+        if not self.ready:
+            return []
+        results = self.query_engine.find_closest_tickets([ticket_number], top_k=k, save=False)
+        if not results:
+            return []
+        return self.describe(results[0][1][:k])
+
+    def get_similar_batch(self, ticket_numbers, texts, k, use_cache=True):
+        """
+        Returns the `k` tickets most similar to each of `ticket_numbers` and `texts`, found with one
+        batched query. See QueryEngine.find_closest_batch().
+
+        Returns:
+            dict: {"tickets": [{"ticket_number", "similar"}], "texts": [{"text", "similar"}],
+                   "not_found": [ticket numbers without summaries]} where each "similar" is a list
+                   like get_similar_tickets() returns.
+        """
+        if not self.ready:
+            return {"tickets": [], "texts": [], "not_found": list(ticket_numbers)}
+        ticket_results, text_results = self.query_engine.find_closest_batch(
+            ticket_numbers, texts, top_k=k, use_cache=use_cache, save=False)
+        found = {t for t, _ in ticket_results}
+        return {
+            "tickets": [{"ticket_number": t, "similar": self.describe(result)}
+                        for t, result in ticket_results],
+            "texts": [{"text": text, "similar": self.describe(result)}
+                      for text, result in zip(texts, text_results)],
+            "not_found": [t for t in ticket_numbers if t not in found],
+        }
+
+    def describe(self, results):
+        "Returns the (ticket_number, score) `results` as dicts with the tickets' METADATA_COLUMNS."
+        df = self.zd.df
+        similar = []
+        for t, score in results:
+            ticket = {"ticket_number": t, "score": score}
+            if t in df.index:
+                row = df.loc[t]
+                ticket.update({col: str(row[col]) for col in METADATA_COLUMNS if col in df.columns})
+            similar.append(ticket)
+        return similar
+
+    def stats(self):
+        "Returns the state of the service."
+        return {
+            "model": self.model_name,
+            "ready": self.ready,
+            "tickets": len(self.zd.df) if self.zd is not None else 0,
+            "refreshes": self.num_refreshes,
+            "last_refresh": self.last_refresh,
+        }
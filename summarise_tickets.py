@@ -16,13 +16,20 @@
     --max_tickets: Maximum number of tickets to process.
     --max_size: Maximum size of ticket comments in kilobytes.
     --pattern: Select tickets with this pattern in the comments.
+    --dedup: Process one ticket from each group of duplicate tickets.
+    --changed: Process only the tickets created or changed since the last --changed run with the
+               same model, as recorded in the change journal.
+    --min_date, --max_date: Process only tickets created in this range of dates (YYYY-MM-DD).
+                            Not allowed with --changed.
     --list: List tickets. Don't summarise.
 """
+import datetime
 import sys
 import time
 from argparse import ArgumentParser
 from utils import print_exit, match_key
 from ticket_processor import ZendeskData, describe_tickets
+from zendesk_wrapper import get_change_journal
 from models import LLM_MODELS, sub_models, set_best_embedding
 from classify_tfdidf import classify_tickets
 
@@ -52,6 +59,14 @@ def main():
     parser.add_argument("--pattern", type=str, required=False, default="",
         help="Select tickets with this pattern in the comments."
     )
+    parser.add_argument("--dedup", action="store_true",
+        help="Process one ticket from each group of duplicate tickets.")
+    parser.add_argument("--min_date", type=datetime.datetime.fromisoformat, default=None,
+        help="Process only tickets created on or after this date (YYYY-MM-DD).")
+    parser.add_argument("--max_date", type=datetime.datetime.fromisoformat, default=None,
+        help="Process only tickets created up to this date (YYYY-MM-DD[THH:MM]).")
+    parser.add_argument("--changed", action="store_true",
+        help="Process only the tickets changed since the last --changed run. See change_journal.py.")
     parser.add_argument("--high", action="store_true",
         help="Process only high priority tickets.")
     parser.add_argument("--all", action="store_true",
@@ -65,10 +80,20 @@ def main():
 
     args = parser.parse_args()
     positionals = args.vars
-
-    zd = ZendeskData()
-
-    if positionals:
+    if args.changed and (args.min_date or args.max_date):
+        # The journal offset is committed past every pending change, so changed tickets outside
+        # the dates would never be summarised.
+        print_exit("--changed can't be used with --min_date or --max_date.")
+
+    zd = ZendeskData(args.min_date, args.max_date)
+
+    # The change journal consumer for this model's summaries or features.
+    journal_consumer = f"summarise_tickets.{args.model}" + (".features" if args.features else "")
+    journal_offset = None
+    if args.changed:
+        ticket_numbers, journal_offset = get_change_journal().pending_tickets(journal_consumer)
+        print(f"{len(ticket_numbers)} tickets changed since the last --changed run.")
+    elif positionals:
         ticket_numbers = [int(x) for x in positionals if x.isdigit()]
         new_numbers, bad_numbers = zd.add_new_tickets(ticket_numbers)
         if bad_numbers:
@@ -76,6 +101,8 @@ def main():
     else:
         ticket_numbers = zd.ticket_numbers()
         priority = "high" if args.high else None
+        if args.dedup:
+            ticket_numbers = zd.representative_tickets(ticket_numbers)
         ticket_numbers = zd.filter_tickets(ticket_numbers, args.pattern, priority,
                     args.max_size, args.max_tickets)
 
@@ -121,13 +148,18 @@ def main():
     print(f"  LLM family: {model_name}")
     print(f"  LLM model: {model}")
 
-    if not any((positionals, args.all, args.high, args.pattern, args.max_size, args.max_tickets)):
+    if not any((positionals, args.all, args.high, args.pattern, args.max_size, args.max_tickets,
+                args.changed)):
         print_exit("Please select a ticket number(s), specify a filter or use the --all flage.")
 
     print(f"Processing {len(ticket_numbers)} tickets with {model} " +
         f"(max {args.max_size} kb {args.max_tickets} tickets)...  ")
 
-    summaryPaths = zd.summarise_tickets(ticket_numbers, summariser, overwrite=args.overwrite)
+    # Changed tickets are summarised again, since their summaries are out of date.
+    summaryPaths = zd.summarise_tickets(ticket_numbers, summariser,
+                                        overwrite=args.overwrite or args.changed)
+    if journal_offset is not None:
+        get_change_journal().commit(journal_consumer, journal_offset)
 
     print(f"{len(summaryPaths)} summary paths saved. {summaryPaths[:2]} ...")
 
@@ -0,0 +1,18 @@
+"""
+    pytest setup for the tests of the top-level modules, which are imported from the repository root.
+
+    zendesk_wrapper needs Zendesk credentials to make API calls and config.py reads ZENDESK_FILE_ROOT
+    when it is imported, so these are set to dummy values and a temporary directory before any test
+    imports them. The tests make no calls to Zendesk. Those that call the API use fake_zendesk.py,
+    which needs no client rate limit.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key in ["ZENDESK_USER", "ZENDESK_TOKEN", "ZENDESK_SUBDOMAIN"]:
+    os.environ.setdefault(key, "test")
+os.environ["ZENDESK_FILE_ROOT"] = tempfile.mkdtemp(prefix="zendesk_tests_")
+os.environ.setdefault("ZENDESK_REQUESTS_PER_MINUTE", "100000")
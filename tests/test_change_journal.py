@@ -0,0 +1,66 @@
+"Tests of the change journal's events and consumer offsets."
+import os
+from change_journal import ChangeJournal, TICKET_CREATED, TICKET_UPDATED, TICKET_DELETED
+
+def make_journal(tmp_path):
+    return ChangeJournal(os.path.join(tmp_path, "journal.jsonl"), os.path.join(tmp_path, "offsets"))
+
+def test_empty_journal(tmp_path):
+    journal = make_journal(tmp_path)
+    assert journal.read() == ([], 0)
+    assert journal.offset("stage") == 0
+    assert journal.pending_tickets("stage") == ([], 0)
+
+def test_append_and_read(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "2024-01-01T00:00:00Z", "2024-01-01T00:00:00Z"),
+                    (TICKET_UPDATED, "2", "2024-01-02T00:00:00Z")])
+    events, end_offset = journal.read()
+    assert [(e["type"], e["ticket_number"]) for e in events] == [(TICKET_CREATED, 1), (TICKET_UPDATED, 2)]
+    assert events[0]["created_at"] == "2024-01-01T00:00:00Z"
+    assert "created_at" not in events[1]
+    assert end_offset == os.path.getsize(journal.path)
+
+def test_consumers_have_separate_offsets(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "t1")])
+    tickets, offset1 = journal.pending_tickets("a")
+    assert tickets == [1]
+    journal.commit("a", offset1)
+    journal.append([(TICKET_UPDATED, 2, "t2")])
+
+    assert journal.offset("a") == offset1
+    assert journal.pending_tickets("a")[0] == [2]
+    assert journal.pending_tickets("b")[0] == [1, 2]
+
+def test_uncommitted_events_are_read_again(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "t1")])
+    journal.pending("a")
+    assert journal.pending_tickets("a")[0] == [1]
+
+def test_deleted_tickets(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "t1"), (TICKET_CREATED, 2, "t1"), (TICKET_DELETED, 1, "t2")])
+    assert journal.pending_tickets("a")[0] == [2]
+    assert journal.pending_tickets("a", include_deleted=True)[0] == [1, 2]
+    assert journal.pending_tickets("a", event_types=[TICKET_UPDATED])[0] == []
+
+def test_partly_written_last_line_is_left_for_the_next_read(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "t1")])
+    with open(journal.path, "a") as f:
+        f.write('{"type": "ticket_upd')
+    events, end_offset = journal.read()
+    assert [e["ticket_number"] for e in events] == [1]
+
+    # The next append starts a new line, and the torn line is skipped.
+    journal.append([(TICKET_UPDATED, 2, "t2")])
+    events, _ = journal.read(end_offset)
+    assert [e["ticket_number"] for e in events] == [2]
+
+def test_offset_past_the_end_reads_from_the_start(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([(TICKET_CREATED, 1, "t1")])
+    journal.commit("a", 10_000)
+    assert journal.pending_tickets("a")[0] == [1]
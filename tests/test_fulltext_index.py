@@ -0,0 +1,49 @@
+"Tests of the literals the full-text index looks up to narrow a regular expression search."
+import re
+import pytest
+from fulltext_index import required_literals
+
+@pytest.mark.parametrize("pattern, literals", [
+    ("printer", ["printer"]),
+    (r"foo\.bar", ["foo.bar"]),
+    (r"\bword\s+list", ["word", "list"]),
+    ("[abc]defg", ["defg"]),
+    ("x{2}yzw", ["yzw"]),
+    ("colou?r", ["colo"]),
+    ("pa?per", ["per"]),
+    ("abc*", []),
+    ("ab", []),
+    ("^error.*timeout$", ["error", "timeout"]),
+    (r"\d+ pages\Z", [" pages"]),
+    (r"\Aerror\W+\S+ failed", ["error", " failed"]),
+])
+def test_required_literals(pattern, literals):
+    assert required_literals(pattern) == literals
+
+@pytest.mark.parametrize("pattern", ["printer|scanner", "(print)er", "a(bc)+def"])
+def test_alternations_and_groups_are_not_reasoned_about(pattern):
+    assert required_literals(pattern) is None
+
+@pytest.mark.parametrize("pattern, text", [
+    (r"\x41BC", "ABC"),
+    (r"\u0041BCD", "ABCD"),
+    (r"\N{LATIN CAPITAL LETTER A}BCD", "ABCD"),
+    (r"\101BCD", "ABCD"),
+    (r"abc\tdef", "abc\tdef"),
+])
+def test_character_escapes_are_not_reasoned_about(pattern, text):
+    assert re.search(pattern, text)
+    assert required_literals(pattern) is None
+
+@pytest.mark.parametrize("pattern, text", [
+    ("colou?r", "the color is"),
+    ("pa?per", "pper"),
+    ("abc*def", "abdef"),
+    ("x{2}yzw", "xxyzw"),
+    (r"error\s+\d+ in", "error   42 in"),
+])
+def test_every_match_contains_the_literals(pattern, text):
+    match = re.search(pattern, text)
+    assert match
+    for literal in required_literals(pattern):
+        assert literal in match.group()
@@ -0,0 +1,77 @@
+"Tests of how update_index() merges tickets from several batches with read_latest_tickets()."
+import os
+from ticket_batches import save_batch
+from zendesk_wrapper import read_latest_tickets
+
+def make_ticket(ticket_number, updated_at, subject="subject", status="open", comment_count=1):
+    "Returns a Zendesk ticket with the fields extract_metadata() reads."
+    return {
+        "id": ticket_number,
+        "subject": subject,
+        "status": status,
+        "priority": "normal",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": updated_at,
+        "comment_count": comment_count,
+        "custom_fields": [],
+    }
+
+def save_batches(tmp_path, batches):
+    "Saves each (name, tickets) of `batches` to a batch file in `tmp_path`. Returns their paths."
+    paths = []
+    for name, tickets in batches:
+        path = os.path.join(tmp_path, f"{name}.jsonl.gz")
+        save_batch(path, tickets)
+        paths.append(path)
+    return paths
+
+def read_all(paths):
+    return read_latest_tickets(paths, lambda ticket: True)
+
+def test_latest_copy_wins_whatever_the_batch_order(tmp_path):
+    old = make_ticket(1, "2024-01-02T00:00:00Z", subject="old", comment_count=1)
+    new = make_ticket(1, "2024-03-01T00:00:00Z", subject="new", comment_count=5)
+    paths = save_batches(tmp_path, [("inc_000", [new]), ("2024-01_000", [old])])
+    for batch_paths in [paths, paths[::-1]]:
+        latest, comment_counts, num_tickets = read_all(batch_paths)
+        updated_at, metadata = latest[1]
+        assert updated_at == new["updated_at"]
+        assert metadata["subject"] == "new"
+        assert comment_counts[1] == 5
+        assert num_tickets == 2
+
+def test_tickets_are_merged_across_batches(tmp_path):
+    paths = save_batches(tmp_path, [
+        ("2024-01_000", [make_ticket(1, "2024-01-02T00:00:00Z"), make_ticket(2, "2024-01-03T00:00:00Z")]),
+        ("inc_000", [make_ticket(3, "2024-02-01T00:00:00Z")]),
+    ])
+    latest, _, num_tickets = read_all(paths)
+    assert sorted(latest) == [1, 2, 3]
+    assert num_tickets == 3
+
+def test_later_batch_wins_a_tie(tmp_path):
+    first = make_ticket(1, "2024-01-02T00:00:00Z", subject="first")
+    second = make_ticket(1, "2024-01-02T00:00:00Z", subject="second")
+    paths = save_batches(tmp_path, [("a", [first]), ("b", [second])])
+    latest, _, _ = read_all(paths)
+    assert latest[1][1]["subject"] == "second"
+
+def test_deletion_is_kept_only_if_latest(tmp_path):
+    live = make_ticket(1, "2024-01-02T00:00:00Z")
+    deleted = make_ticket(1, "2024-02-01T00:00:00Z", status="deleted")
+    paths = save_batches(tmp_path, [("inc_000", [deleted]), ("2024-01_000", [live])])
+    latest, _, _ = read_all(paths)
+    assert latest[1] is None
+
+    revived = make_ticket(1, "2024-03-01T00:00:00Z", subject="revived")
+    paths += save_batches(tmp_path, [("inc_001", [revived])])
+    latest, _, _ = read_all(paths[::-1])
+    assert latest[1][1]["subject"] == "revived"
+
+def test_out_of_range_tickets_are_skipped(tmp_path):
+    paths = save_batches(tmp_path, [
+        ("a", [make_ticket(1, "2024-01-02T00:00:00Z"), make_ticket(2, "2024-01-03T00:00:00Z")]),
+    ])
+    latest, _, num_tickets = read_latest_tickets(paths, lambda ticket: ticket["id"] != 2)
+    assert list(latest) == [1]
+    assert num_tickets == 2
@@ -0,0 +1,74 @@
+"Tests of interrupting and resuming a sharded ticket fetch from fake_zendesk.py."
+import shutil
+import time
+import pytest
+import zendesk_wrapper
+from config import TICKET_BATCHES_DIR, TICKET_BACKFILL_SHARDS_DIR
+from fake_zendesk import FakeZendesk, FakeZendeskServer
+from ticket_batches import iter_batch, list_batches
+
+NUM_TICKETS = 300
+NUM_SHARDS = 4
+PAGE_SIZE = 20
+
+@pytest.fixture
+def server(monkeypatch):
+    "A fake Zendesk API that zendesk_wrapper fetches from, with empty batch and shard directories."
+    server = FakeZendeskServer(FakeZendesk(NUM_TICKETS, comments_per_ticket=1))
+    server.start()
+    monkeypatch.setattr(zendesk_wrapper, "ZENDESK_API", server.api_url())
+    monkeypatch.setattr(zendesk_wrapper, "EXPORT_PAGE_SIZE", PAGE_SIZE)
+    for path in [TICKET_BATCHES_DIR, TICKET_BACKFILL_SHARDS_DIR]:
+        shutil.rmtree(path, ignore_errors=True)
+    yield server
+    server.shutdown()
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(monkeypatch, num_pages):
+    "Makes zendesk_wrapper fail every search export page request after the first `num_pages`."
+    fetch_page = zendesk_wrapper.fetch_page
+    num_fetched = 0
+
+    def interrupted_fetch_page(url, *args, **kwargs):
+        nonlocal num_fetched
+        if "search/export" in url:
+            if num_fetched == num_pages:
+                raise Interrupted(url)
+            num_fetched += 1
+        return fetch_page(url, *args, **kwargs)
+    monkeypatch.setattr(zendesk_wrapper, "fetch_page", interrupted_fetch_page)
+
+def fetched_tickets():
+    "Returns the numbers of the tickets in the sharded fetch's batches, in no particular order."
+    return [ticket["id"] for path in list_batches(TICKET_BATCHES_DIR) for ticket in iter_batch(path)]
+
+def test_resumed_fetch_continues_each_shard(server, monkeypatch):
+    assert zendesk_wrapper.fetch_sharded_ticket_batches(NUM_SHARDS, num_workers=1) == NUM_TICKETS
+    num_pages = server.request_counts["export"]
+    shutil.rmtree(TICKET_BATCHES_DIR)
+    shutil.rmtree(TICKET_BACKFILL_SHARDS_DIR)
+
+    num_before = num_pages // 2
+    with monkeypatch.context() as m:
+        interrupt_after(m, num_before)
+        with pytest.raises(Interrupted):
+            zendesk_wrapper.fetch_sharded_ticket_batches(NUM_SHARDS, num_workers=1)
+    # max_date is None, so each run's windows would end at a different "now".
+    time.sleep(1.1)
+
+    exports0, tickets0 = server.request_counts["export"], server.request_counts["tickets"]
+    zendesk_wrapper.fetch_sharded_ticket_batches(NUM_SHARDS, num_workers=1, resume=True)
+    # Only the pages that weren't fetched before the interruption are fetched.
+    assert server.request_counts["export"] - exports0 == num_pages - num_before
+    # The oldest ticket's date is saved with the windows, not fetched again.
+    assert server.request_counts["tickets"] == tickets0
+    assert sorted(fetched_tickets()) == list(FakeZendesk(NUM_TICKETS).ticket_numbers())
+
+def test_fetch_without_resume_starts_again(server):
+    zendesk_wrapper.fetch_sharded_ticket_batches(NUM_SHARDS, num_workers=1)
+    num_pages = server.request_counts["export"]
+    zendesk_wrapper.fetch_sharded_ticket_batches(NUM_SHARDS, num_workers=1)
+    assert server.request_counts["export"] == 2 * num_pages
+    assert sorted(fetched_tickets()) == list(FakeZendesk(NUM_TICKETS).ticket_numbers())
@@ -0,0 +1,33 @@
+"Tests of fetching tickets again with their cached ETags from fake_zendesk.py."
+import os
+import pytest
+import zendesk_wrapper
+from fake_zendesk import FakeZendesk, FakeZendeskServer, FIRST_TICKET
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    "A fake Zendesk API that zendesk_wrapper fetches from, with an empty ticket cache."
+    server = FakeZendeskServer(FakeZendesk(20, comments_per_ticket=1))
+    server.start()
+    monkeypatch.setattr(zendesk_wrapper, "ZENDESK_API", server.api_url())
+    monkeypatch.setattr(zendesk_wrapper, "_ticket_cache",
+                        zendesk_wrapper.TicketCache(os.path.join(tmp_path, "ticket_cache.sqlite")))
+    yield server
+    server.shutdown()
+
+def test_unchanged_ticket_is_read_from_the_cache(server):
+    ticket = zendesk_wrapper.fetch_ticket(FIRST_TICKET)
+    assert ticket["id"] == FIRST_TICKET
+    assert server.request_counts["304"] == 0
+    assert zendesk_wrapper.fetch_ticket(FIRST_TICKET) == ticket
+    assert server.request_counts["304"] == 1
+
+def test_cache_keeps_one_row_per_ticket(tmp_path):
+    path = os.path.join(tmp_path, "cache", "tickets.sqlite")
+    cache = zendesk_wrapper.TicketCache(path)
+    assert cache.get(1) == (None, None)
+    cache.save(1, 'W/"a"', {"id": 1, "subject": "old"})
+    cache.save(1, 'W/"b"', {"id": 1, "subject": "new"})
+    cache = zendesk_wrapper.TicketCache(path)
+    assert cache.get(1) == ('W/"b"', {"id": 1, "subject": "new"})
+    assert os.listdir(os.path.dirname(path)) == ["tickets.sqlite"]
@@ -0,0 +1,113 @@
+"Tests of the UpdateQueue's coalescing and priority lanes."
+import asyncio
+import threading
+from dataclasses import dataclass
+from update_queue import UpdateQueue, priority_lane
+
+@dataclass
+class Update:
+    id: int
+    priority: str
+    version: int = 0
+
+class Handler:
+    "Records the updates it handles. Blocks while `gate` is cleared."
+    def __init__(self):
+        self.handled = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, update):
+        self.gate.wait(5)
+        self.handled.append((update.id, update.version))
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+async def start_busy(handler):
+    """ Returns a started UpdateQueue with one worker, busy with an update to ticket 0 until
+        `handler.gate` is set, so updates queued meanwhile are all queued before any is handled.
+    """
+    handler.gate.clear()
+    queue = UpdateQueue(handler, num_workers=1, max_pending=10)
+    queue.start()
+    await queue.put(Update(0, "normal"))
+    while not queue.running:
+        await asyncio.sleep(0.01)
+    return queue
+
+def test_priority_lane():
+    assert priority_lane("URGENT") == "urgent"
+    assert priority_lane(None) == "normal"
+    assert priority_lane("unknown") == "normal"
+
+def test_updates_to_a_queued_ticket_are_coalesced():
+    async def main():
+        handler = Handler()
+        queue = await start_busy(handler)
+        for version in range(3):
+            await queue.put(Update(1, "normal", version))
+        await queue.put(Update(2, "normal"))
+        handler.gate.set()
+        await queue.join()
+        await queue.stop()
+        return handler.handled, queue.stats()
+
+    handled, stats = run(main())
+    assert handled == [(0, 0), (1, 2), (2, 0)]
+    assert stats["received"] == 5
+    assert stats["coalesced"] == 2
+    assert stats["handled"] == 3
+
+def test_higher_priority_lanes_go_first():
+    async def main():
+        handler = Handler()
+        queue = await start_busy(handler)
+        await queue.put(Update(1, "low"))
+        await queue.put(Update(2, "normal"))
+        await queue.put(Update(3, "urgent"))
+        # A coalesced update moves its ticket up to a higher lane, never down.
+        await queue.put(Update(1, "high", 1))
+        await queue.put(Update(3, "low", 1))
+        handler.gate.set()
+        await queue.join()
+        await queue.stop()
+        return handler.handled
+
+    assert run(main()) == [(0, 0), (3, 1), (1, 1), (2, 0)]
+
+def test_update_to_a_running_ticket_is_handled_after_it():
+    async def main():
+        handler = Handler()
+        handler.gate.clear()
+        queue = UpdateQueue(handler, num_workers=2, max_pending=10)
+        queue.start()
+        await queue.put(Update(1, "normal", 0))
+        while not queue.running:
+            await asyncio.sleep(0.01)
+        await queue.put(Update(1, "normal", 1))
+        await asyncio.sleep(0.05)
+        # The second worker must not handle the ticket while the first is.
+        assert queue.stats()["running"] == 1
+        handler.gate.set()
+        await queue.join()
+        await queue.stop()
+        return handler.handled
+
+    assert run(main()) == [(1, 0), (1, 1)]
+
+def test_failed_updates_are_counted():
+    def fail(update):
+        raise ValueError("failed")
+
+    async def main():
+        queue = UpdateQueue(fail, num_workers=1, max_pending=10)
+        queue.start()
+        await queue.put(Update(1, "normal"))
+        await queue.join()
+        await queue.stop()
+        return queue.stats()
+
+    stats = run(main())
+    assert stats["failed"] == 1
+    assert stats["handled"] == 0
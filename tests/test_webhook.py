@@ -0,0 +1,95 @@
+"Tests of server.py's Zendesk webhook signature checking and payload handling."
+import base64
+import hashlib
+import hmac
+import json
+import pytest
+from fastapi.testclient import TestClient
+import server
+import zendesk_wrapper
+from fake_zendesk import FakeZendesk, FakeZendeskServer, FIRST_TICKET
+from server import webhook_signature
+
+SECRET = "dGhpc19zZWNyZXQ="
+PAYLOAD = {"detail": {"id": 123, "subject": "Printer offline", "description": "It's offline.",
+                      "updated_at": "2024-01-02T03:04:05Z", "priority": "high"}}
+
+def signed_headers(body, secret=SECRET, timestamp="2024-01-02T03:04:05Z"):
+    return {"Content-Type": "application/json",
+            "X-Zendesk-Webhook-Signature-Timestamp": timestamp,
+            "X-Zendesk-Webhook-Signature": webhook_signature(body, timestamp, secret)}
+
+@pytest.fixture
+def queued(monkeypatch):
+    "Returns the list of issues the webhook queues, instead of handling them."
+    issues = []
+
+    async def put(issue):
+        issues.append(issue)
+    monkeypatch.setattr(server.updates, "put", put)
+    monkeypatch.setattr(server, "WEBHOOK_SECRET", SECRET)
+    return issues
+
+@pytest.fixture
+def client():
+    # Not used as a context manager, so the app's lifespan tasks don't start.
+    return TestClient(server.app)
+
+def test_webhook_signature():
+    body, timestamp = b'{"id": 1}', "1700000000"
+    digest = hmac.new(SECRET.encode(), (timestamp + '{"id": 1}').encode(), hashlib.sha256).digest()
+    assert webhook_signature(body, timestamp, SECRET) == base64.b64encode(digest).decode()
+    assert webhook_signature(body, "1700000001", SECRET) != webhook_signature(body, timestamp, SECRET)
+    assert webhook_signature(body, timestamp, "other") != webhook_signature(body, timestamp, SECRET)
+
+def test_signed_webhook_is_queued(client, queued):
+    body = json.dumps(PAYLOAD).encode()
+    response = client.post("/webhooks/zendesk", content=body, headers=signed_headers(body))
+    assert response.status_code == 200
+    assert response.json() == {"queued": 123}
+    assert [(issue.id, issue.priority) for issue in queued] == [(123, "high")]
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"X-Zendesk-Webhook-Signature-Timestamp": "2024-01-02T03:04:05Z",
+     "X-Zendesk-Webhook-Signature": "bm90IGEgc2lnbmF0dXJl"},
+])
+def test_unsigned_or_badly_signed_webhook_is_rejected(client, queued, headers):
+    body = json.dumps(PAYLOAD).encode()
+    response = client.post("/webhooks/zendesk", content=body, headers=headers)
+    assert response.status_code == 401
+    assert not queued
+
+def test_webhook_signed_with_another_secret_is_rejected(client, queued):
+    body = json.dumps(PAYLOAD).encode()
+    response = client.post("/webhooks/zendesk", content=body, headers=signed_headers(body, "other"))
+    assert response.status_code == 401
+    assert not queued
+
+def test_tampered_body_is_rejected(client, queued):
+    body = json.dumps(PAYLOAD).encode()
+    headers = signed_headers(body)
+    tampered = body.replace(b"Printer", b"Scanner")
+    response = client.post("/webhooks/zendesk", content=tampered, headers=headers)
+    assert response.status_code == 401
+    assert not queued
+
+def test_unsigned_webhook_is_accepted_without_a_secret(client, queued, monkeypatch):
+    monkeypatch.setattr(server, "WEBHOOK_SECRET", None)
+    response = client.post("/webhooks/zendesk", json=PAYLOAD)
+    assert response.status_code == 200
+    assert [issue.id for issue in queued] == [123]
+
+def test_webhook_with_only_a_ticket_id_fetches_the_ticket(client, queued, monkeypatch):
+    fake = FakeZendeskServer(FakeZendesk(10, comments_per_ticket=1))
+    fake.start()
+    monkeypatch.setattr(zendesk_wrapper, "ZENDESK_API", fake.api_url())
+    try:
+        body = json.dumps({"ticket_id": FIRST_TICKET}).encode()
+        response = client.post("/webhooks/zendesk", content=body, headers=signed_headers(body))
+    finally:
+        fake.shutdown()
+    assert response.status_code == 200
+    ticket = fake.corpus.ticket(FIRST_TICKET)
+    assert [(issue.id, issue.subject, issue.url) for issue in queued] == [
+        (FIRST_TICKET, ticket["raw_subject"], ticket["url"])]
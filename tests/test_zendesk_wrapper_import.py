@@ -0,0 +1,21 @@
+"Tests that importing zendesk_wrapper has no side effects."
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_needs_no_credentials_and_creates_no_files(tmp_path):
+    env = {k: v for k, v in os.environ.items()
+           if k not in {"ZENDESK_USER", "ZENDESK_TOKEN", "ZENDESK_SUBDOMAIN"}}
+    env["ZENDESK_FILE_ROOT"] = str(tmp_path)
+    subprocess.run([sys.executable, "-c", "import zendesk_wrapper"], cwd=REPO_ROOT, env=env, check=True)
+    assert os.listdir(tmp_path) == []
+
+def test_api_calls_need_credentials(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "ZENDESK_TOKEN"}
+    env["ZENDESK_FILE_ROOT"] = str(tmp_path)
+    result = subprocess.run([sys.executable, "-c", "import zendesk_wrapper; zendesk_wrapper.get_transport()"],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "missing ZENDESK_TOKEN" in result.stderr
@@ -0,0 +1,138 @@
+"""
+    Reading and writing the raw ticket batches in TICKET_BATCHES_DIR.
+
+    Batches are saved as gzip compressed JSON lines, one ticket per line. This is several times
+    smaller than indented JSON, and a batch can be read one ticket at a time. orjson is used to
+    serialise and parse tickets if it is installed.
+    Batches saved as indented JSON arrays by earlier versions are still read.
+
+    Batches are partitioned by the month the tickets were created. A fetched page is saved as one
+    batch file per month in `batches_dir`/YYYY-MM/, so reading the tickets created in a date range
+    only opens the partitions of the months in the range. `batches_dir`/manifest.json records the
+    number of batches and tickets in each partition.
+    Batches saved directly in `batches_dir` by earlier versions are read for every date range, until
+    partition_legacy_batches() moves them into partitions.
+"""
+import glob
+import gzip
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from utils import load_json, save_json, month_in_range
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BATCH_SUFFIX = ".jsonl.gz"
+LEGACY_SUFFIX = ".json"
+# Fast compression. Batches are written once per fetch and read on every index update.
+COMPRESS_LEVEL = 3
+
+def _dumps(ticket):
+    "Returns `ticket` as one line of JSON bytes."
+    if orjson:
+        return orjson.dumps(ticket)
+    return json.dumps(ticket, separators=(",", ":")).encode("utf-8")
+
+def _loads(line):
+    return orjson.loads(line) if orjson else json.loads(line)
+
+def batch_path(batches_dir, name):
+    "Returns the path of the batch called `name` in `batches_dir`."
+    return os.path.join(batches_dir, f"{name}{BATCH_SUFFIX}")
+
+def save_batch(path, tickets):
+    """ Saves the list of `tickets` to batch file `path`.
+        The file is written under a temporary name and then renamed, so an interrupted fetch never
+        leaves a partial batch.
+    """
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wb", compresslevel=COMPRESS_LEVEL) as f:
+        for ticket in tickets:
+            f.write(_dumps(ticket))
+            f.write(b"\n")
+    os.replace(temp_path, path)
+
+def iter_batch(path):
+    "Yields the tickets in batch file `path` one at a time."
+    if path.endswith(LEGACY_SUFFIX):
+        with open(path, "rb") as f:
+            yield from _loads(f.read())
+        return
+    with gzip.open(path, "rb") as f:
+        for line in f:
+            yield _loads(line)
+
+RE_MONTH = re.compile(r"^\d{4}-\d{2}$")
+MANIFEST_NAME = "manifest.json"
+# Batches are saved from several threads by a sharded fetch.
+_manifest_lock = threading.Lock()
+
+def _batch_name(path):
+    name = os.path.basename(path)
+    return name[:-len(BATCH_SUFFIX)] if name.endswith(BATCH_SUFFIX) else name[:-len(LEGACY_SUFFIX)]
+
+def load_manifest(batches_dir):
+    "Returns the {month: {num_batches, num_tickets}} manifest of the partitions in `batches_dir`."
+    path = os.path.join(batches_dir, MANIFEST_NAME)
+    return load_json(path) if os.path.exists(path) else {}
+
+def save_partitioned_batch(batches_dir, name, tickets):
+    """ Saves the list of `tickets` as batch `name` in the `created_at` month partitions of
+        `batches_dir` and updates the manifest.
+        Returns: The paths of the batch files saved.
+    """
+    by_month = defaultdict(list)
+    for ticket in tickets:
+        by_month[ticket["created_at"][:7]].append(ticket)
+    paths = []
+    counts = {}
+    for month, month_tickets in sorted(by_month.items()):
+        month_dir = os.path.join(batches_dir, month)
+        os.makedirs(month_dir, exist_ok=True)
+        path = batch_path(month_dir, name)
+        # A batch saved again, e.g. by a resumed fetch, replaces the old one in the counts.
+        num_old = sum(1 for _ in iter_batch(path)) if os.path.exists(path) else None
+        save_batch(path, month_tickets)
+        paths.append(path)
+        counts[month] = (num_old, len(month_tickets))
+    with _manifest_lock:
+        manifest = load_manifest(batches_dir)
+        for month, (num_old, num_new) in counts.items():
+            partition = manifest.setdefault(month, {"num_batches": 0, "num_tickets": 0})
+            if num_old is None:
+                partition["num_batches"] += 1
+            partition["num_tickets"] += num_new - (num_old or 0)
+        save_json(os.path.join(batches_dir, MANIFEST_NAME), manifest)
+    return paths
+
+def _legacy_batches(batches_dir):
+    paths = glob.glob(os.path.join(batches_dir, f"*{BATCH_SUFFIX}"))
+    paths += glob.glob(os.path.join(batches_dir, f"*{LEGACY_SUFFIX}"))
+    return [path for path in paths if os.path.basename(path) != MANIFEST_NAME]
+
+def list_batches(batches_dir, min_date=None, max_date=None):
+    """ Returns the paths of the batch files in `batches_dir` in the order they should be read.
+        Only the partitions of the months that overlap `min_date` to `max_date` are listed.
+        The batches are ordered by name. Readers must not rely on this order to pick the latest copy
+        of a ticket, since incremental batch names sort after full and sharded fetch names whenever
+        they were fetched. See zendesk_wrapper.read_latest_tickets().
+    """
+    if not os.path.exists(batches_dir):
+        return []
+    paths = _legacy_batches(batches_dir)
+    for month in os.listdir(batches_dir):
+        if RE_MONTH.match(month) and month_in_range(month, min_date, max_date):
+            paths += glob.glob(os.path.join(batches_dir, month, f"*{BATCH_SUFFIX}"))
+    return sorted(paths, key=lambda path: (_batch_name(path), path))
+
+def partition_legacy_batches(batches_dir):
+    "Moves the batches saved directly in `batches_dir` by earlier versions into month partitions."
+    paths = sorted(_legacy_batches(batches_dir))
+    for path in paths:
+        save_partitioned_batch(batches_dir, _batch_name(path), list(iter_batch(path)))
+        os.remove(path)
+    return len(paths)
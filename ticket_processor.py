@@ -3,6 +3,8 @@
       tickets, summarising tickets, and listing tickets.
     - ticket_has_pattern() returns True if any of the comments for a ticket contains a
        specified pattern.
+    - tickets_with_pattern() returns the tickets that have a specified pattern, using the full-text
+       comment index to avoid reading every ticket's comments.
     - describe_tickets() prints the ticket information for each metadata in a list.
 """
 import glob
@@ -10,8 +12,10 @@ import os
 import re
 import time
 import sys
-from utils import total_size_kb, current_time, since, load_text
-from zendesk_wrapper import comment_paths, add_tickets_to_index, load_existing_index
+from config import TICKET_ALIASES_PATH, TICKET_NEAR_ALIASES_PATH
+from utils import current_time, since, load_json
+from zendesk_wrapper import (ticket_comments, comment_sizes, comments_size_kb, add_tickets_to_index,
+                             load_existing_index, panderise_date, get_search_index)
 from evaluate_summary import summarise_ticket, summary_text
 from rag_summariser import PydanticSummariser
 from rag_classifier import PydanticFeatureGenerator
@@ -19,8 +23,20 @@ from rag_classifier import PydanticFeatureGenerator
 def ticket_has_pattern(ticket_number, pattern):
     "Returns True if any of the comments for ticket with number `ticket_number` contains `pattern`."
     regex = re.compile(pattern, re.MULTILINE | re.DOTALL | re.IGNORECASE)
-    paths = comment_paths(ticket_number)
-    return any(regex.search(load_text(path)) for path in paths)
+    return any(regex.search(text) for _, text in ticket_comments(ticket_number))
+
+def tickets_with_pattern(ticket_numbers, pattern):
+    """ Returns the tickets in `ticket_numbers` with a comment that contains `pattern`.
+        Only the tickets that the full-text index can't rule out are checked with ticket_has_pattern().
+    """
+    candidates = get_search_index().candidates(pattern)
+    if candidates is not None:
+        indexed = get_search_index().indexed_tickets()
+        reduced_numbers = [t for t in ticket_numbers if t in candidates or t not in indexed]
+        print(f"    Full-text index reduced {len(ticket_numbers)} tickets to {len(reduced_numbers)} " +
+              f"candidates for '{pattern}'.")
+        ticket_numbers = reduced_numbers
+    return [t for t in ticket_numbers if ticket_has_pattern(t, pattern)]
 
 TICKETS_SHOWN = 5   # Number of tickets to show in the summary.
 
@@ -41,8 +57,8 @@ def show_tickets(ticket_numbers, num_shown):
     """
     def show_one(i):
         ticket_number = ticket_numbers[i]
-        paths = comment_paths(ticket_number)
-        print(f"{i:8}: {ticket_number:8} {len(paths):3} comments {total_size_kb(paths):6.2f} kb")
+        sizes = comment_sizes(ticket_number)
+        print(f"{i:8}: {ticket_number:8} {len(sizes):3} comments {sum(sizes) / 1024:6.2f} kb")
 
     if len(ticket_numbers) <= num_shown:
         for i in range(len(ticket_numbers)):
@@ -57,8 +73,9 @@ def show_tickets(ticket_numbers, num_shown):
         show_one(i)
 
 def summarise_one_ticket(summariser, i, ticket_number, metadata, overwrite):
-    commentCount = len(comment_paths(ticket_number))
-    commentSize = total_size_kb(comment_paths(ticket_number))
+    sizes = comment_sizes(ticket_number)
+    commentCount = len(sizes)
+    commentSize = sum(sizes) / 1024
 
     print(f"{i:2}: ticket_number={ticket_number:8} {commentCount:3} comments {commentSize:7.3f} kb {current_time()}",
         flush=True)
@@ -110,8 +127,16 @@ class ZendeskData:
         summarise_tickets(ticket_numbers, llm, model, structured, overwrite=False): Summarizes the
                 conversations from the Zendesk support tickets specified by `ticket_numbers`.
     """
-    def __init__(self):
-        df = load_existing_index()
+    def __init__(self, min_date=None, max_date=None, read_only=False):
+        """ Loads the index of the tickets created from `min_date` to `max_date`, or of all tickets
+            if they are None. Only the index partitions of the months in the range are read.
+            The stored index is never written if `read_only` is True. See load_existing_index().
+        """
+        df = load_existing_index(min_date, max_date, read_only=read_only)
+        if min_date:
+            df = df[df["created_at"] >= panderise_date(min_date)]
+        if max_date:
+            df = df[df["created_at"] <= panderise_date(max_date)]
         self.df = df
 
     def ticket_numbers(self):
@@ -125,8 +150,8 @@ class ZendeskData:
         subject = metadata["subject"]
         return repr(subject[:max_len])
 
-    def comment_paths(self, ticket_number: int):
-        return comment_paths(ticket_number)
+    def comments(self, ticket_number: int):
+        return ticket_comments(ticket_number)
 
     def ticket_has_priority(self, ticket_number, priority):
         "Returns True if ticket with number `ticket_number` has priority `priority`."
@@ -145,6 +170,20 @@ class ZendeskData:
             print(f"    Ticket numbers reduced to {len(reduced_numbers)} for existing tickets.")
         return reduced_numbers
 
+    def representative_tickets(self, ticket_numbers):
+        """ Filters out tickets that are exact or near duplicates of other tickets, keeping one
+            representative ticket of each group in TICKET_ALIASES_PATH and TICKET_NEAR_ALIASES_PATH.
+        """
+        duplicates = set()
+        for path in [TICKET_ALIASES_PATH, TICKET_NEAR_ALIASES_PATH]:
+            if os.path.exists(path):
+                for others in load_json(path).values():
+                    duplicates.update(others)
+        reduced_numbers = [t for t in ticket_numbers if t not in duplicates]
+        if len(reduced_numbers) < len(ticket_numbers):
+            print(f"    Ticket numbers reduced to {len(reduced_numbers)} for one ticket per duplicate group.")
+        return reduced_numbers
+
     def add_new_tickets(self, ticket_numbers):
         """ Adds tickets with numbers `ticket_numbers` to the index.
             Returns new_ticket_numbers, bad_ticket_numbers where:
@@ -161,12 +200,12 @@ class ZendeskData:
             print(f"    Ticket numbers reduced to {len(reduced_numbers)} to match priority '{priority}'.")
             ticket_numbers = reduced_numbers
         if max_size > 0:
-            reduced_numbers = [k for k in ticket_numbers if total_size_kb(comment_paths(k)) <= max_size]
+            reduced_numbers = [k for k in ticket_numbers if comments_size_kb(k) <= max_size]
             if len(reduced_numbers) < len(ticket_numbers):
                 print(f"    Ticket numbers reduced to {len(reduced_numbers)} for {max_size} kb size limit")
                 ticket_numbers = reduced_numbers
         if pattern:
-            reduced_numbers = [t for t in ticket_numbers if ticket_has_pattern(t, pattern)]
+            reduced_numbers = tickets_with_pattern(ticket_numbers, pattern)
             print(f"    Ticket numbers reduced to {len(reduced_numbers)} to match '{pattern}'.")
             ticket_numbers = reduced_numbers
         if max_tickets > 0:
@@ -174,7 +213,7 @@ class ZendeskData:
             if len(reduced_numbers) < len(ticket_numbers):
                 print(f"    Ticket numbers reduced to {len(reduced_numbers)} for {max_tickets} number limit")
                 ticket_numbers = reduced_numbers
-        ticket_numbers.sort(key=lambda k: (total_size_kb(comment_paths(k)), k))
+        ticket_numbers.sort(key=lambda k: (comments_size_kb(k), k))
         return ticket_numbers
 
     def get_summariser(self, llm, model, do_features):
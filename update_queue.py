@@ -0,0 +1,133 @@
+"""
+    A bounded asyncio work queue of ticket updates for server.py's handle_update().
+
+    - Priority lanes: each update is queued in the lane of its ticket's Zendesk `priority`, and
+      workers take updates from the highest priority lane first.
+    - Coalescing: an update to a ticket that is already queued replaces the queued update, keeping
+      its place in the queue, so a burst of updates to a busy ticket is handled once, in its latest
+      state. A ticket is never handled by two workers at once. Updates that arrive while it is
+      being handled are queued and handled after that run.
+    - Backpressure: put() waits while `max_pending` tickets are queued.
+    - Workers: `num_workers` asyncio tasks run the blocking handler in threads.
+"""
+import asyncio
+
+# The lanes in the order they are served, named by Zendesk ticket priority.
+PRIORITY_LANES = ["urgent", "high", "normal", "low"]
+# The lane of updates whose ticket has no priority.
+DEFAULT_LANE = "normal"
+
+def priority_lane(priority):
+    "Returns the lane for a ticket with Zendesk `priority`, which may be None or upper case."
+    lane = (priority or "").lower()
+    return lane if lane in PRIORITY_LANES else DEFAULT_LANE
+
+class UpdateQueue:
+    """
+    Queues ticket updates and runs `handler(update)` on them with a pool of `num_workers` workers.
+    Updates must have an `id` (the ticket number) and a `priority` attribute.
+    """
+    def __init__(self, handler, num_workers, max_pending):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        # The queued update of each ticket, and the tickets in each lane in the order they were
+        # queued. Dicts keep their insertion order, so each lane is a FIFO.
+        self.pending = {}
+        self.lanes = {lane: {} for lane in PRIORITY_LANES}
+        self.running = set()
+        self.cond = None
+        self.loop = None
+        self.tasks = []
+        self.num_queued = 0
+        self.num_coalesced = 0
+        self.num_handled = 0
+        self.num_failed = 0
+
+    def start(self):
+        "Starts the workers. Must be called from the event loop, e.g. in the FastAPI lifespan."
+        self.loop = asyncio.get_running_loop()
+        self.cond = asyncio.Condition()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        "Cancels the workers. Queued updates are dropped."
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def put(self, update):
+        """ Queues `update`, replacing a queued update to the same ticket. Waits while
+            `max_pending` tickets are queued.
+        """
+        lane = priority_lane(update.priority)
+        async with self.cond:
+            key = update.id
+            if key not in self.pending:
+                await self.cond.wait_for(lambda: len(self.pending) < self.max_pending or key in self.pending)
+            self.num_queued += 1
+            old = self.pending.get(key)
+            if old is not None:
+                self.num_coalesced += 1
+                _, old_lane = old
+                if PRIORITY_LANES.index(lane) < PRIORITY_LANES.index(old_lane):
+                    del self.lanes[old_lane][key]
+                    self.lanes[lane][key] = None
+                else:
+                    lane = old_lane
+            else:
+                self.lanes[lane][key] = None
+            self.pending[key] = (update, lane)
+            self.cond.notify_all()
+
+    def put_threadsafe(self, update):
+        "Queues `update` from a thread outside the event loop, waiting for room in the queue."
+        asyncio.run_coroutine_threadsafe(self.put(update), self.loop).result()
+
+    def _next_ready(self):
+        return any(key not in self.running for lane in self.lanes.values() for key in lane)
+
+    def _next(self):
+        "Returns the next (ticket, update) to handle, or None if every queued ticket is running."
+        for lane in PRIORITY_LANES:
+            for key in self.lanes[lane]:
+                if key not in self.running:
+                    del self.lanes[lane][key]
+                    update, _ = self.pending.pop(key)
+                    return key, update
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(self._next_ready)
+                key, update = self._next()
+                self.running.add(key)
+                self.cond.notify_all()
+            try:
+                await asyncio.to_thread(self.handler, update)
+                self.num_handled += 1
+            except Exception as e:
+                self.num_failed += 1
+                print(f"UpdateQueue: handler failed for ticket {key}: {e}")
+            finally:
+                async with self.cond:
+                    self.running.discard(key)
+                    self.cond.notify_all()
+
+    async def join(self):
+        "Waits until every queued update has been handled."
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.pending and not self.running)
+
+    def stats(self):
+        "Returns counts of the queued, running, handled and coalesced updates."
+        return {
+            "queued": {lane: len(keys) for lane, keys in self.lanes.items()},
+            "running": len(self.running),
+            "received": self.num_queued,
+            "coalesced": self.num_coalesced,
+            "handled": self.num_handled,
+            "failed": self.num_failed,
+        }
@@ -46,6 +46,18 @@ def iso2date(text):
     date = date.replace(tzinfo=None)
     return date
 
+def date_month(date):
+    "Returns the 'YYYY-MM' month of `date`."
+    return date.strftime("%Y-%m")
+
+def month_in_range(month, min_date=None, max_date=None):
+    "Returns True if `month` ('YYYY-MM') overlaps the dates from `min_date` to `max_date`."
+    if min_date and month < date_month(min_date):
+        return False
+    if max_date and month > date_month(max_date):
+        return False
+    return True
+
 def list_index(arr, k):
     "Returns the index of `k` in `arr` or the length of `arr` if `k` is not found."
     try:
@@ -0,0 +1,175 @@
+"""
+    A shared HTTP transport for the Zendesk API.
+    - Keeps connections alive in a pool so that each request doesn't pay for a new TLS handshake.
+    - Limits requests to the account's requests/minute with a token bucket.
+    - Retries 429 responses after their Retry-After delay, and retries connection errors and 5xx
+      responses with exponential backoff.
+    - Keeps per-endpoint latency counters.
+    https://developer.zendesk.com/api-reference/introduction/rate-limits/
+"""
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait after a 429 response that has no Retry-After header.
+DEFAULT_RETRY_AFTER = 60
+# The maximum number of times a failed request is retried.
+MAX_RETRIES = 6
+# The delay in seconds before the first retry of a failed request. It doubles on each retry.
+BACKOFF_BASE = 1.0
+# The maximum delay in seconds between retries of a failed request.
+BACKOFF_MAX = 60.0
+# HTTP status codes that are worth retrying.
+RETRY_STATUSES = {500, 502, 503, 504}
+# The number of keep-alive connections kept in the pool.
+POOL_SIZE = 16
+# Seconds to wait for a response before giving up on a request.
+REQUEST_TIMEOUT = 60
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that allows `rate_per_min` requests per minute on average, with
+    bursts of up to `capacity` requests.
+    """
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity if capacity else max(1.0, rate_per_min / 10.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Blocks until a token is available, then consumes it."
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+
+RE_NUMBER = re.compile(r"/\d+")
+RE_API_PREFIX = re.compile(r"^https?://[^/]+(?:/api/v2)?/*")
+
+def endpoint_name(url):
+    """ Returns the endpoint of `url` with the host, query and ids removed.
+        e.g. "https://x.zendesk.com/api/v2/tickets/123/comments?page=2" -> "tickets/{id}/comments"
+    """
+    path = RE_API_PREFIX.sub("", url.split("?")[0])
+    return RE_NUMBER.sub("/{id}", f"/{path}")[1:]
+
+class LatencyCounter:
+    "Counts the requests, errors and total and maximum latency of one endpoint."
+    def __init__(self):
+        self.num_requests = 0
+        self.num_errors = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def record(self, secs, error=False):
+        self.num_requests += 1
+        self.num_errors += int(error)
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def mean_secs(self):
+        return self.total_secs / max(1, self.num_requests)
+
+class ZendeskTransport:
+    """
+    A pooled, rate limited, retrying HTTP client for the Zendesk API. One instance is shared by
+    all the threads in a process.
+
+    Args:
+        auth (tuple): The (user, token) pair used for basic authentication.
+        requests_per_min (int): The average number of requests per minute allowed.
+        pool_size (int): The number of keep-alive connections in the pool.
+    """
+    def __init__(self, auth, requests_per_min, pool_size=POOL_SIZE):
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.bucket = TokenBucket(requests_per_min)
+        self.latencies = defaultdict(LatencyCounter)
+        self.lock = threading.Lock()
+        self.rate_limited_until = 0.0
+
+    def _record(self, endpoint, t0, error=False):
+        with self.lock:
+            self.latencies[endpoint].record(time.monotonic() - t0, error)
+
+    def _wait_for_rate_limit(self):
+        "Sleeps until the most recent Retry-After period has expired."
+        delay = self.rate_limited_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _set_rate_limited(self, retry_after):
+        """ Tells all threads to stop sending requests for `retry_after` seconds. Zendesk rate
+            limits are per account, so when one thread is told to back off all threads wait.
+        """
+        with self.lock:
+            self.rate_limited_until = max(self.rate_limited_until, time.time() + retry_after)
+
+    def get(self, url, params=None, headers=None):
+        """ Sends a GET request to `url`, retrying rate limited and failed requests.
+            Returns: The `requests.Response` of the last attempt.
+            Raises the last connection error if all attempts fail to connect.
+        """
+        endpoint = endpoint_name(url)
+        for attempt in range(MAX_RETRIES + 1):
+            self._wait_for_rate_limit()
+            self.bucket.acquire()
+            t0 = time.monotonic()
+            try:
+                response = self.session.get(url, params=params, headers=headers,
+                                            timeout=REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, t0, error=True)
+                if attempt == MAX_RETRIES:
+                    raise
+                self._backoff(attempt, url, e)
+                continue
+            # 304 Not Modified answers a conditional request. It isn't an error.
+            self._record(endpoint, t0, error=response.status_code >= 400)
+            if attempt == MAX_RETRIES:
+                break
+            if response.status_code == 429:
+                retry_after = float(response.headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+                print(f"  Rate limited on {endpoint}. Retrying in {retry_after:.0f} secs")
+                self._set_rate_limited(retry_after)
+                continue
+            if response.status_code in RETRY_STATUSES:
+                self._backoff(attempt, url, f"HTTP {response.status_code}")
+                continue
+            break
+        return response
+
+    def _backoff(self, attempt, url, reason):
+        "Sleeps for an exponentially increasing, jittered delay before retry `attempt` + 1."
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        print(f"  Request {attempt + 1} failed ({reason}): {url}. Retrying in {delay:.1f} secs")
+        time.sleep(delay)
+
+    def latency_report(self):
+        "Returns a multi-line string describing the latency of each endpoint called."
+        with self.lock:
+            items = sorted(self.latencies.items(), key=lambda kv: -kv[1].total_secs)
+        lines = [f"{'endpoint':40} {'requests':>8} {'errors':>6} {'mean':>7} {'max':>7}"]
+        for endpoint, counter in items:
+            lines.append(f"{endpoint[:40]:40} {counter.num_requests:8} {counter.num_errors:6} " +
+                         f"{counter.mean_secs():7.3f} {counter.max_secs:7.3f}")
+        return "\n".join(lines)
@@ -3,46 +3,87 @@
     https://developer.zendesk.com/api-reference/ticketing/tickets/tickets/#show-ticket
 """
 from collections import defaultdict
-import glob
+import datetime
+import itertools
 import json
 import os
 import pytz
 import requests
 import shutil
+import sqlite3
+import threading
 import time
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-from config import (COMMENTS_DIR, TICKET_INDEX_PATH, TICKET_ALIASES_PATH, TICKET_BATCHES_DIR,
-                    METADATA_KEYS, FIELD_KEY_NAMES, CUSTOM_FIELDS_KEY)
-from utils import save_json, save_text, load_json, load_text, iso2date, since
+from config import (COMMENTS_DIR, COMMENT_STORE_DIR, COMMENT_STORAGE, COMMENT_STORE_COMPRESS,
+                    TICKET_INDEX_PARTITIONS_DIR, TICKET_ALIASES_PATH, TICKET_BATCHES_DIR,
+                    TICKET_SYNC_CURSOR_PATH, COMMENT_SEARCH_INDEX_PATH,
+                    TICKET_NEAR_ALIASES_PATH, NEAR_DUPLICATES_INDEX_PATH,
+                    TICKET_BACKFILL_CHECKPOINT_PATH, TICKET_BACKFILL_SHARDS_DIR, AUTHORS_PATH,
+                    TICKET_CACHE_PATH, INDEX_DELTA_MAX_ROWS, CHANGE_JOURNAL_PATH, CHANGE_JOURNAL_OFFSETS_DIR,
+                    COMMENTS_STATE_PATH, CHANGED_TICKETS_PATH,
+                    METADATA_KEYS, FIELD_KEY_NAMES, CUSTOM_FIELDS_KEY, ZENDESK_REQUESTS_PER_MINUTE)
+from utils import save_json, load_json, iso2date, since
+from zendesk_transport import ZendeskTransport
+from comment_store import make_comment_store
+from fulltext_index import CommentSearchIndex
+from near_duplicates import NearDuplicateIndex
+from change_journal import (ChangeJournal, TICKET_CREATED, COMMENT_ADDED, TICKET_UPDATED,
+                            TICKET_DELETED)
+from ticket_batches import save_partitioned_batch, iter_batch, list_batches
+from index_store import (expand_custom_fields, categorise, save_index, load_index, index_path,
+                         stored_index_path, index_exists, append_index_delta, load_index_delta)
 
 USER = os.environ.get("ZENDESK_USER")
 TOKEN = os.environ.get("ZENDESK_TOKEN")
 SUBDOMAIN = os.environ.get("ZENDESK_SUBDOMAIN")
 
-assert USER, "missing ZENDESK_USER"
-assert TOKEN, "missing ZENDESK_TOKEN"
-assert SUBDOMAIN, "missing ZENDESK_SUBDOMAIN"
-
-ZENDESK_API = f"https://{SUBDOMAIN}.zendesk.com/api/v2/"
+# Set ZENDESK_API_URL to use another server with the Zendesk API, such as fake_zendesk.py.
+ZENDESK_API = os.environ.get("ZENDESK_API_URL") or f"https://{SUBDOMAIN}.zendesk.com/api/v2/"
 
 def make_url(path):
     "Constructs and returns a URL by appending `path` to `ZENDESK_API.`"
     return f"{ZENDESK_API}/{path}"
 
+# The objects below that hold files, databases or credentials are created by their first use rather
+# than when this module is imported, so importing it doesn't create files or need Zendesk credentials.
+_shared_lock = threading.RLock()
+
+# The shared HTTP client for all Zendesk API calls in this process. See get_transport().
+_transport = None
+
+def get_transport():
+    "Returns the shared ZendeskTransport, creating it on first use. It needs the Zendesk credentials."
+    global _transport
+    with _shared_lock:
+        if _transport is None:
+            assert USER, "missing ZENDESK_USER"
+            assert TOKEN, "missing ZENDESK_TOKEN"
+            assert SUBDOMAIN, "missing ZENDESK_SUBDOMAIN"
+            _transport = ZendeskTransport((f"{USER}/token", TOKEN), ZENDESK_REQUESTS_PER_MINUTE)
+        return _transport
+
 def url_get(url, params=None):
-    """Sends a GET request to `url` with authentication and headers.
+    """Sends a GET request to `url` through the shared get_transport().
+        Requests are rate limited, and rate limited and failed requests are retried.
         Returns: The JSON response parsed as a dictionary.
         Raises exceptions if the GET request fails or the response is not valid JSON.
     """
-    auth = (f"{USER}/token", TOKEN)
-    headers = {"Content-Type": "application/json"}
-    if params:
-        response = requests.request("GET", url, auth=auth, headers=headers, params=params)
-    else:
-        response = requests.request("GET", url, auth=auth, headers=headers)
+    response = get_transport().get(url, params=params)
     return response.json()
 
+def url_get_conditional(url, params=None, etag=None):
+    """ Sends a GET request to `url` that only returns a body if it has changed since ETag `etag`.
+        Returns: (result, etag) where result is the JSON response parsed as a dictionary, or None if
+            the response hasn't changed since `etag`, and etag is the response's ETag.
+        https://developer.zendesk.com/api-reference/introduction/requests/#conditional-requests
+    """
+    headers = {"If-None-Match": etag} if etag else None
+    response = get_transport().get(url, params=params, headers=headers)
+    if response.status_code == 304:
+        return None, etag
+    return response.json(), response.headers.get("ETag")
+
 def zd_get(path, params=None):
     "Calls the Zendesk API with the specified path and returns the response parsed as a dictionary."
     url = make_url(path)
@@ -51,122 +92,560 @@ def zd_get(path, params=None):
 def fetch_ticket_fields():
     return zd_get("ticket_fields")
 
+# The number of users fetched per users/show_many call. 100 is the Zendesk maximum.
+USERS_PER_REQUEST = 100
+
+def fetch_users(user_ids):
+    """ Fetches the Zendesk users with ids `user_ids`, USERS_PER_REQUEST at a time.
+        Returns: A list of the users found. Deleted users are not returned.
+        https://developer.zendesk.com/api-reference/ticketing/users/users/#show-many-users
+    """
+    user_ids = sorted(set(user_ids))
+    users = []
+    for i in range(0, len(user_ids), USERS_PER_REQUEST):
+        ids = ",".join(str(u) for u in user_ids[i:i + USERS_PER_REQUEST])
+        result = fetch_page(make_url("users/show_many.json"), params={"ids": ids}, key="users")
+        users.extend(result["users"])
+    return users
+
 def fetch_author(author_id):
-    return zd_get(f"users/{author_id}")
+    "Returns the Zendesk user `author_id` from get_author_cache(), or None if there is no such user."
+    return get_author_cache().get(author_id)
+
+class TicketCache:
+    """
+    The last fetched copy of each ticket with its ETag, stored in the SQLite database `path`, so
+    that fetching an unchanged ticket again gets a body-less 304 response.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS tickets (ticket_number INTEGER PRIMARY KEY, etag TEXT, ticket TEXT)
+        """)
+        self.db.commit()
+
+    def get(self, ticket_number):
+        "Returns the (etag, ticket) saved for `ticket_number`, or (None, None) if there is none."
+        with self.lock:
+            row = self.db.execute("SELECT etag, ticket FROM tickets WHERE ticket_number = ?",
+                                  (ticket_number,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, None)
+
+    def save(self, ticket_number, etag, ticket):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO tickets VALUES (?, ?, ?)",
+                            (ticket_number, etag, json.dumps(ticket)))
+            self.db.commit()
+
+_ticket_cache = None
+
+def get_ticket_cache():
+    "Returns the TicketCache at TICKET_CACHE_PATH, creating it on first use."
+    global _ticket_cache
+    with _shared_lock:
+        if _ticket_cache is None:
+            _ticket_cache = TicketCache(TICKET_CACHE_PATH)
+        return _ticket_cache
 
 def fetch_ticket(ticket_number: int) -> dict:
-    """ Fetches Zendesk ticket number `ticket_number`.
+    """ Fetches Zendesk ticket number `ticket_number` with its comment_count sideloaded.
+        If the ticket hasn't changed since it was last fetched, Zendesk returns 304 Not Modified and
+        the copy in get_ticket_cache() is returned.
         Returns: A dictionary representing the ticket.
         https://developer.zendesk.com/api-reference/ticketing/tickets/tickets/#show-ticket
     """
-    result = zd_get(f"tickets/{ticket_number}")
+    etag, cached = get_ticket_cache().get(ticket_number)
+    result, etag = url_get_conditional(make_url(f"tickets/{ticket_number}"),
+                                       params={"include": "comment_count"}, etag=etag)
+    if result is None:
+        return cached
     if "error" in result or "ticket" not in result:
         return None
+    if etag:
+        get_ticket_cache().save(ticket_number, etag, result["ticket"])
     return result["ticket"]
 
+# The number of comments per page fetched by iter_ticket_comment_pages(). 100 is the Zendesk maximum.
+COMMENTS_PAGE_SIZE = 100
+
+def fetch_first_comment_page(ticket_number, etag=None):
+    """ Fetches the first page of comments for Zendesk ticket number `ticket_number`, with the
+        comment authors sideloaded.
+        Returns: (result, etag) as url_get_conditional(). result is None if the page hasn't changed
+            since ETag `etag`.
+    """
+    params = {"page[size]": COMMENTS_PAGE_SIZE, "include_inline_images": "false", "include": "users"}
+    return fetch_page_conditional(make_url(f"tickets/{ticket_number}/comments"), params=params,
+                                  key="comments", etag=etag)
+
+def iter_ticket_comment_pages(ticket_number, first_page=None):
+    """ Yields the pages of comments for Zendesk ticket number `ticket_number` as lists of comments,
+        following the cursor pagination links. Only one page is held in memory at a time, however
+        many comments the ticket has.
+        The sideloaded comment authors are added to get_author_cache().
+        `first_page` is the result of fetch_first_comment_page() if it has already been fetched.
+        https://developer.zendesk.com/api-reference/ticketing/tickets/ticket_comments/#list-comments
+    """
+    result = first_page or fetch_first_comment_page(ticket_number)[0]
+    while True:
+        get_author_cache().add(result.get("users", []))
+        yield result["comments"]
+        has_more = result.get("meta", {}).get("has_more")
+        url = result.get("links", {}).get("next") if has_more else None
+        if not url:
+            break
+        result = fetch_page(url, key="comments")
+
+# The number of tickets fetched per tickets/show_many call. 100 is the Zendesk maximum.
+TICKETS_PER_REQUEST = 100
+
+def fetch_tickets(ticket_numbers):
+    """ Fetches the Zendesk tickets with numbers `ticket_numbers`, TICKETS_PER_REQUEST at a time.
+        Returns: A dict of {ticket_number: ticket} for the tickets found.
+        https://developer.zendesk.com/api-reference/ticketing/tickets/tickets/#show-multiple-tickets
+    """
+    ticket_numbers = sorted(set(ticket_numbers))
+    tickets = {}
+    for i in range(0, len(ticket_numbers), TICKETS_PER_REQUEST):
+        ids = ",".join(str(t) for t in ticket_numbers[i:i + TICKETS_PER_REQUEST])
+        result = fetch_page(make_url("tickets/show_many.json"),
+                            params={"ids": ids, "include": "comment_count"})
+        tickets.update((ticket["id"], ticket) for ticket in result["tickets"])
+    return tickets
+
 def fetch_ticket_comments(ticket_number):
     """ Fetches the comments for Zendesk ticket number `ticket_number`.
         Returns: A list of comments for the specified ticket number.
     """
-    result = zd_get(f"tickets/{ticket_number}/comments?include=&include_inline_images=false")
-    assert "error" not in result, f"^^^ {ticket_number} {result}"
+    return [comment for page in iter_ticket_comment_pages(ticket_number) for comment in page]
 
-    comments = []
-    for i in range(1_000):
-        comments.extend(result["comments"])
-        url = result.get("next_page")
-        if not url:
-            break
+# Where the downloaded comments are saved. See comment_store.py.
+_comment_store = None
 
-        result = url_get(url)
-        if i > 5:
-            # Crazy number of comments.
-            print(f" {len(comments)} comments fetched for {ticket_number}: {url}")
-            break
+def get_comment_store():
+    "Returns the store of the downloaded comments, creating it on first use."
+    global _comment_store
+    with _shared_lock:
+        if _comment_store is None:
+            _comment_store = make_comment_store(COMMENT_STORAGE, COMMENTS_DIR, COMMENT_STORE_DIR,
+                                                compress=COMMENT_STORE_COMPRESS)
+        return _comment_store
+
+def ticket_comments(ticket_number):
+    "Returns the (name, text) pairs of the comments in Zendesk ticket `ticket_number` in comment order."
+    return get_comment_store().comments(ticket_number)
+
+def comment_sizes(ticket_number):
+    "Returns the sizes in bytes of the comments in Zendesk ticket `ticket_number`."
+    return get_comment_store().comment_sizes(ticket_number)
+
+def comments_size_kb(ticket_number):
+    "Returns the total size in kilobytes of the comments in Zendesk ticket `ticket_number`."
+    return sum(comment_sizes(ticket_number)) / 1024
+
+# The full-text index of the downloaded comments. See fulltext_index.py.
+_search_index = None
 
-    return comments
+def get_search_index():
+    "Returns the CommentSearchIndex at COMMENT_SEARCH_INDEX_PATH, creating it on first use."
+    global _search_index
+    with _shared_lock:
+        if _search_index is None:
+            _search_index = CommentSearchIndex(COMMENT_SEARCH_INDEX_PATH)
+        return _search_index
 
-os.makedirs(COMMENTS_DIR, exist_ok=True)
+def update_search_index(ticket_numbers):
+    """ Adds the comments of `ticket_numbers` to get_search_index(), replacing any comments already
+        indexed for them.
+    """
+    if not get_search_index().enabled() or not ticket_numbers:
+        return
+    t0 = time.time()
+    ticket_texts = ((t, [text for _, text in ticket_comments(t)]) for t in ticket_numbers)
+    get_search_index().update_tickets(ticket_texts)
+    print(f"   Indexed the comments of {len(ticket_numbers)} tickets for search in {since(t0):.1f} secs")
 
-def _path_func(ticket_number, dir_name, ext):
-    "Returns the path give by joining directory name `dir_name` and `ticket_number`."
-    return os.path.abspath(os.path.join(dir_name, f"{ticket_number}{ext}"))
+# The MinHash signatures of the downloaded comments. See near_duplicates.py.
+_duplicates_index = None
 
-def _list_func(dir_name, ext):
-    "Returns the files in `dir_name` matching `ext`."
-    return sorted(glob.glob(os.path.join(dir_name, f"*{ext}")))
+def get_duplicates_index():
+    "Returns the NearDuplicateIndex at NEAR_DUPLICATES_INDEX_PATH, creating it on first use."
+    global _duplicates_index
+    with _shared_lock:
+        if _duplicates_index is None:
+            _duplicates_index = NearDuplicateIndex(NEAR_DUPLICATES_INDEX_PATH)
+        return _duplicates_index
 
-def _make_ticket_path_func(dir_name, ext=""):
-    """ Returns path_func, list_func where:
-        path_func: function that returns the path give by joining directory name `dir_name` and
-        `ticket_number`.
-        list_func: function that returns the files in `dir_name` matching `ext`.
+def update_duplicates_index(ticket_numbers):
+    """ Adds the comments of `ticket_numbers` to get_duplicates_index(), replacing any signatures already
+        computed for them.
     """
-    path_func = partial(_path_func, dir_name=dir_name, ext=ext)
-    list_func = partial(_list_func, dir_name=dir_name, ext=ext)
-    return path_func, list_func
+    if not ticket_numbers:
+        return
+    t0 = time.time()
+    ticket_texts = ((t, "\n".join(text for _, text in ticket_comments(t))) for t in ticket_numbers)
+    num_pairs = get_duplicates_index().update_tickets(ticket_texts)
+    print(f"   Hashed the comments of {len(ticket_numbers)} tickets and found {num_pairs} " +
+          f"near-duplicates in {since(t0):.1f} secs")
+
+# The ticket changes found by ingestion, for the downstream stages.
+_change_journal = None
+
+def get_change_journal():
+    "Returns the ChangeJournal at CHANGE_JOURNAL_PATH, creating it on first use."
+    global _change_journal
+    with _shared_lock:
+        if _change_journal is None:
+            _change_journal = ChangeJournal(CHANGE_JOURNAL_PATH, CHANGE_JOURNAL_OFFSETS_DIR)
+        return _change_journal
 
-# The functions for constructing paths to ticket data.
-get_comments_dir, list_comment_dirs = _make_ticket_path_func(COMMENTS_DIR)
+def journal_events(df, latest, changed_tickets, skipped):
+    """ Returns the change journal events for the tickets read by update_index().
+        `df` is the index before the update, `latest` maps ticket numbers to (updated_at, metadata)
+        or None for deleted tickets, and the tickets in `skipped` were not re-indexed.
+    """
+    changed_set = set(changed_tickets)
+    events = []
+    for ticket_number, value in latest.items():
+        if ticket_number in skipped:
+            continue
+        if value is None:
+            if ticket_number in df.index:
+                events.append((TICKET_DELETED, ticket_number, "", df.at[ticket_number, "created_at"]))
+            continue
+        updated_at, metadata = value
+        if ticket_number not in df.index:
+            event_type = TICKET_CREATED
+        elif ticket_number in changed_set:
+            event_type = COMMENT_ADDED
+        elif pd.Timestamp(metadata["updated_at"]) != df.at[ticket_number, "updated_at"]:
+            event_type = TICKET_UPDATED
+        else:
+            continue
+        events.append((event_type, ticket_number, updated_at, metadata["created_at"]))
+    return events
 
-def comment_paths(ticket_number):
-    "Returns a sorted list of file paths for the comments in Zendesk ticket `ticket_number`."
-    folder = get_comments_dir(ticket_number)
-    return sorted(glob.glob(os.path.join(folder, "*.txt")))
+# The maximum number of pages to scroll in fetch_all_ticket_batches()
+MAX_PAGES = 10_000
+# The maximum number of tickets to fetch.
+MAX_TICKETS = 10_000_000
 
 # The functions for accessing TICKET_BATCHES_DIR which contains the raw ticket data.
-def _batch_path(i): return os.path.join(TICKET_BATCHES_DIR, f"{i:05d}.json")
-def _list_batches(): return sorted(glob.glob(os.path.join(TICKET_BATCHES_DIR, "*.json")))
+# Batches are saved in the partitions of the months their tickets were created. See ticket_batches.py.
+def _batch_name(i): return f"{i:05d}"
+def _save_batch(name, tickets): return save_partitioned_batch(TICKET_BATCHES_DIR, name, tickets)
+def _list_batches(min_date=None, max_date=None): return list_batches(TICKET_BATCHES_DIR, min_date, max_date)
+
+# The number of times a page of tickets that returns an error is fetched again.
+PAGE_RETRIES = 5
+# The delay in seconds before fetching an error page again. It doubles on each retry.
+PAGE_RETRY_DELAY = 10
+# Zendesk errors that won't go away if the page is fetched again.
+PERMANENT_ERRORS = {"RecordNotFound", "InvalidEndpoint", "Forbidden"}
 
-def fetch_all_ticket_batches(ticket_batches_dir, max_pages, ret_tickets: bool = False):
+def fetch_page_conditional(url, params=None, key="tickets", etag=None):
+    """ Fetches a page of results from Zendesk API `url` if it has changed since ETag `etag`.
+        Pages that fail, return an error payload or have no `key` are fetched again, up to
+        PAGE_RETRIES times, since these errors are usually transient during long exports.
+        Returns: (result, etag) as url_get_conditional().
+    """
+    for attempt in range(PAGE_RETRIES + 1):
+        try:
+            result, new_etag = url_get_conditional(url, params, etag)
+            if result is None or ("error" not in result and key in result):
+                return result, new_etag
+            reason = result.get("error", f"no '{key}' in {list(result.keys())}")
+            assert reason not in PERMANENT_ERRORS, f"{url}: {result}"
+        except (requests.RequestException, ValueError) as e:
+            reason = e
+        assert attempt < PAGE_RETRIES, f"{url} failed {attempt + 1} times: {reason}"
+        delay = PAGE_RETRY_DELAY * 2 ** attempt
+        print(f"  Page fetch failed ({reason}): {url}. Retrying in {delay} secs")
+        time.sleep(delay)
+
+def fetch_page(url, params=None, key="tickets"):
+    """ Fetches a page of results from Zendesk API `url`, retrying errors as fetch_page_conditional().
+        Returns: The page parsed as a dictionary.
+    """
+    result, _ = fetch_page_conditional(url, params, key)
+    return result
+
+def fetch_all_ticket_batches(ticket_batches_dir, max_pages, ret_tickets: bool = False,
+                             checkpoint_path=None, resume=False):
     """
     Fetches all ticket batches from the Zendesk API and saves them as JSON files.
 
     Args:
         ticket_batches_dir (str): The directory where the ticket batches will be saved.
         max_pages (int): The maximum number of pages to fetch.
+        checkpoint_path (str, optional): Where to save the number and URL of the next page after
+            each batch is saved. Defaults to None for no checkpoint.
+        resume (bool, optional): Whether to continue from the page in `checkpoint_path` instead of
+            the first page. Defaults to False.
 
     https://developer.zendesk.com/api-reference/introduction/pagination/
     https://example.zendesk.com/api/v2/tickets.json?page[size]=100
     """
-    params = {
-        "page[size]": 100,
-        "sort_by": "created_at",
-    }
-    result = zd_get("tickets.json", params=params)
-    assert "error" not in result, f"^^^ {result}"
+    checkpoint = {}
+    if resume:
+        assert checkpoint_path, "resume needs a checkpoint_path"
+        if os.path.exists(checkpoint_path):
+            checkpoint = load_json(checkpoint_path)
+    if checkpoint.get("done"):
+        print(f"  Ticket backfill already finished at page {checkpoint['next_page']}. Nothing to resume.")
+        return []
+    if checkpoint.get("next_url"):
+        start = checkpoint["next_page"]
+        print(f"  Resuming ticket backfill from page {start}")
+        result = fetch_page(checkpoint["next_url"])
+    else:
+        start = 0
+        params = {
+            "page[size]": 100,
+            "sort_by": "created_at",
+            "include": "comment_count",
+        }
+        result = fetch_page(make_url("tickets.json"), params=params)
 
     t0 = time.time()
     num_tickets = 0
     all_tickets = []
-    for i in range(max_pages):
-        assert "error" not in result, f"i={i}: {result}"
-        assert "tickets" in result, f"i={i}: {list(result.keys())}"
+    for i in range(start, max_pages):
         tickets = result["tickets"]
-        save_json(_batch_path(i), tickets)
+        _save_batch(_batch_name(i), tickets)
         num_tickets += len(tickets)
         all_tickets += tickets
 
         has_more = result.get("meta", {}).get("has_more")
-        if not has_more:
-            break
-        url = result.get("links", {}).get("next")
+        url = result.get("links", {}).get("next") if has_more else None
+        if checkpoint_path:
+            save_json(checkpoint_path, {"next_page": i + 1, "next_url": url, "done": not url})
         if not url:
             break
-        result = url_get(url)
-        if "error" in result:
-            break
+        result = fetch_page(url)
 
         if i % 10 == 1:
             print(f"  Page {i:5}: fetched {num_tickets:6} tickets in {since(t0):6.1f} secs")
     return all_tickets
 
+def iter_incremental_pages(start_time=0, cursor=None, max_pages=MAX_PAGES):
+    """ Yields the pages of Zendesk's incremental ticket export of the tickets created or updated
+        since export cursor `cursor`, or since Unix time `start_time` if there is no cursor.
+        The `after_cursor` of the last page yielded continues the export from where it stopped.
+        https://developer.zendesk.com/api-reference/ticketing/ticket-management/incremental_exports/
+    """
+    params = {"cursor": cursor} if cursor else {"start_time": int(start_time)}
+    result = fetch_page(make_url("incremental/tickets/cursor.json"), params=params)
+    for _ in range(max_pages):
+        yield result
+        if result.get("end_of_stream") or not result.get("after_url"):
+            break
+        result = fetch_page(result["after_url"])
+
+def fetch_changed_tickets(start_time=0, cursor=None, max_pages=MAX_PAGES):
+    """ Fetches the tickets created or updated since export cursor `cursor`, or since Unix time
+        `start_time` if there is no cursor, without saving them.
+        Returns: (tickets, cursor) where `cursor` continues the export after these tickets.
+    """
+    tickets = []
+    for result in iter_incremental_pages(start_time, cursor, max_pages):
+        tickets += result["tickets"]
+        cursor = result.get("after_cursor") or cursor
+    return tickets, cursor
+
+def _incremental_batch_name(sync_id, i):
+    return f"inc_{sync_id}_{i:05d}"
+
+def fetch_incremental_ticket_batches(start_time=0, max_pages=MAX_PAGES):
+    """
+    Fetches the tickets created or updated since the last sync using Zendesk's incremental ticket
+    export and saves them as JSON batches in `TICKET_BATCHES_DIR`.
+    The export continues from the cursor in `TICKET_SYNC_CURSOR_PATH`. `start_time` is only used
+    when there is no saved cursor. The new cursor is returned, not saved. The caller saves it with
+    save_sync_cursor() once the fetched tickets are in the index, so that a sync that fails before
+    then fetches the same tickets again.
+
+    Args:
+        start_time (int): The Unix time to start the export from if there is no saved cursor.
+        max_pages (int): The maximum number of pages to fetch.
+
+    Returns:
+        tuple: (batch_paths, cursor) where `batch_paths` are the paths of the batches saved and
+            `cursor` continues the export after them.
+
+    https://developer.zendesk.com/api-reference/ticketing/ticket-management/incremental_exports/
+    """
+    state = load_json(TICKET_SYNC_CURSOR_PATH) if os.path.exists(TICKET_SYNC_CURSOR_PATH) else {}
+    cursor = state.get("cursor")
+
+    t0 = time.time()
+    sync_id = int(t0)
+    num_tickets = 0
+    batch_paths = []
+    for i, result in enumerate(iter_incremental_pages(start_time, cursor, max_pages)):
+        tickets = result["tickets"]
+        if tickets:
+            batch_paths += _save_batch(_incremental_batch_name(sync_id, i), tickets)
+            num_tickets += len(tickets)
+        cursor = result.get("after_cursor") or cursor
+
+        if i % 10 == 1:
+            print(f"  Page {i:5}: fetched {num_tickets:6} changed tickets in {since(t0):6.1f} secs")
+    print(f"   Fetched {num_tickets} changed tickets in {len(batch_paths)} batches")
+    return batch_paths, cursor
+
+def save_sync_cursor(cursor):
+    "Records that the tickets before incremental export `cursor` are in the index."
+    save_json(TICKET_SYNC_CURSOR_PATH, {"cursor": cursor, "synced_at": int(time.time())})
+
+# The number of date shards of a sharded ticket fetch that are fetched at the same time.
+NUM_SHARD_WORKERS = 8
+# The number of tickets per page of the search export. 1000 is the Zendesk maximum.
+EXPORT_PAGE_SIZE = 1000
+
+def _shard_batch_name(shard, i):
+    return f"backfill_{shard:03d}_{i:05d}"
+
+def _shard_checkpoint_path(shard):
+    return os.path.join(TICKET_BACKFILL_SHARDS_DIR, f"shard_{shard:03d}.json")
+
+def _shard_run_path():
+    return os.path.join(TICKET_BACKFILL_SHARDS_DIR, "run.json")
+
+def _zendesk_date(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def first_ticket_date():
+    "Returns the creation date of the oldest Zendesk ticket."
+    result = fetch_page(make_url("tickets.json"), params={"page[size]": 1, "sort_by": "created_at"})
+    assert result["tickets"], "There are no Zendesk tickets."
+    return iso2date(result["tickets"][0]["created_at"])
+
+def date_windows(start_date, end_date, num_shards):
+    "Returns `num_shards` consecutive (start, end) windows that cover `start_date` to `end_date`."
+    step = (end_date - start_date) / num_shards
+    bounds = [start_date + k * step for k in range(num_shards)] + [end_date]
+    return [(bounds[k], bounds[k + 1]) for k in range(num_shards)]
+
+def shard_date_range(num_shards, min_date=None, max_date=None, resume=False):
+    """
+    Returns the (start_date, end_date) of a sharded fetch of the tickets created from `min_date` to
+    `max_date`, which default to the creation date of the oldest ticket and now.
+    The range is saved to _shard_run_path(). If `resume` is True and the saved range is for the same
+    arguments, it is returned instead, so that a resumed fetch has the same shard windows as the
+    interrupted one, even though "now" has moved on.
+    """
+    requested = [_zendesk_date(min_date) if min_date else None,
+                 _zendesk_date(max_date) if max_date else None, num_shards]
+    run_path = _shard_run_path()
+    run = load_json(run_path) if resume and os.path.exists(run_path) else {}
+    if run.get("requested") == requested:
+        return iso2date(run["start_date"]), iso2date(run["end_date"])
+
+    start_date = min_date or first_ticket_date()
+    # The windows are half-open, so the end is just after the last ticket to fetch.
+    if max_date:
+        end_date = max_date + datetime.timedelta(days=1)
+    else:
+        end_date = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    run = {"requested": requested, "start_date": _zendesk_date(start_date),
+           "end_date": _zendesk_date(end_date)}
+    save_json(run_path, run)
+    # The saved dates, which are rounded to the second, so a resumed fetch gets the same windows.
+    return iso2date(run["start_date"]), iso2date(run["end_date"])
+
+def fetch_shard(shard, window_start, window_end, max_pages, resume=False):
+    """
+    Fetches the tickets created from `window_start` up to `window_end` with the Zendesk search
+    export and saves them as batches _shard_batch_name(shard, i).
+    The number and URL of the next page are saved to _shard_checkpoint_path(shard) after each batch,
+    so that if `resume` is True an interrupted shard continues from its last saved page.
+
+    Returns:
+        int: The number of tickets fetched.
+
+    https://developer.zendesk.com/api-reference/ticketing/ticket-management/search/#export-search-results
+    """
+    checkpoint_path = _shard_checkpoint_path(shard)
+    window = [_zendesk_date(window_start), _zendesk_date(window_end)]
+    checkpoint = load_json(checkpoint_path) if resume and os.path.exists(checkpoint_path) else {}
+    if checkpoint.get("window") != window:
+        checkpoint = {}
+    if checkpoint.get("done"):
+        return 0
+    if checkpoint.get("next_url"):
+        start = checkpoint["next_page"]
+        result = fetch_page(checkpoint["next_url"], key="results")
+    else:
+        start = 0
+        params = {
+            "query": f"type:ticket created>={window[0]} created<{window[1]}",
+            "filter[type]": "ticket",
+            "page[size]": EXPORT_PAGE_SIZE,
+        }
+        result = fetch_page(make_url("search/export.json"), params=params, key="results")
+
+    num_tickets = 0
+    for i in range(start, max_pages):
+        tickets = result["results"]
+        _save_batch(_shard_batch_name(shard, i), tickets)
+        num_tickets += len(tickets)
+
+        has_more = result.get("meta", {}).get("has_more")
+        url = result.get("links", {}).get("next") if has_more else None
+        save_json(checkpoint_path, {"window": window, "next_page": i + 1, "next_url": url, "done": not url})
+        if not url:
+            break
+        result = fetch_page(url, key="results")
+    return num_tickets
+
+def fetch_sharded_ticket_batches(num_shards, min_date=None, max_date=None, max_pages=MAX_PAGES,
+                                 resume=False, num_workers=NUM_SHARD_WORKERS):
+    """
+    Fetches all tickets by splitting their creation dates into `num_shards` windows and fetching
+    the windows concurrently with fetch_shard(). Each shard can be resumed independently.
+
+    Args:
+        num_shards (int): The number of date windows.
+        min_date (datetime.datetime, optional): The start of the first window. Defaults to the
+            creation date of the oldest ticket.
+        max_date (datetime.datetime, optional): The end of the last window. Defaults to now, or to
+            the end of the interrupted fetch if `resume` is True. See shard_date_range().
+        max_pages (int): The maximum number of pages to fetch per shard.
+        resume (bool, optional): Whether to continue interrupted shards from their last saved page.
+            Defaults to False.
+        num_workers (int, optional): The number of shards fetched at the same time.
+
+    Returns:
+        int: The number of tickets fetched.
+    """
+    os.makedirs(TICKET_BATCHES_DIR, exist_ok=True)
+    os.makedirs(TICKET_BACKFILL_SHARDS_DIR, exist_ok=True)
+    start_date, end_date = shard_date_range(num_shards, min_date, max_date, resume)
+    windows = date_windows(start_date, end_date, num_shards)
+    print(f"  Fetching tickets created from {start_date} to {end_date} in {num_shards} shards " +
+          f"with {num_workers} workers")
+
+    t0 = time.time()
+    num_tickets = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(fetch_shard, shard, window_start, window_end, max_pages, resume): shard
+                   for shard, (window_start, window_end) in enumerate(windows)}
+        for n, future in enumerate(as_completed(futures)):
+            shard = futures[future]
+            num_fetched = future.result()
+            num_tickets += num_fetched
+            print(f"  Shard {shard:3} ({n + 1} of {num_shards}): fetched {num_fetched:6} tickets. " +
+                  f"Total {num_tickets:7} tickets in {since(t0):6.1f} secs")
+    return num_tickets
+
 def run_on_all_tickets(func):
     "Runs function `func` on all tickets in `TICKET_BATCHES_DIR`."
     batch_paths = _list_batches()
     for path in batch_paths:
-        tickets = load_json(path)
-        for ticket in tickets:
+        for ticket in iter_batch(path):
             func(ticket)
 
 def panderise_date(date):
@@ -188,43 +667,316 @@ def extract_metadata(ticket, add_custom_fields=True):
 
     return metadata
 
-def download_comments(ticket_number, overwrite=False):
-    """ Download the comments in Zendesk ticket `ticket_number` and save them as one text file per
-        comment in directory `COMMENTS_DIR/ticket_number`.
+class CommentsState:
     """
-    folder = get_comments_dir(ticket_number)
-    if not overwrite and os.path.exists(folder):
-        return
-    comments = fetch_ticket_comments(ticket_number)
-
-    os.makedirs(folder, exist_ok=True)
-    has_paths = False
-    for i, comment in enumerate(comments):
-        body = comment["body"]
-        body = body.strip()
-        if not any(c.isalnum() for c in body):
+    Records the Zendesk `updated_at` and the number of comments that each ticket's comments were
+    downloaded at, so that only tickets that have changed since then are downloaded again.
+    For tickets whose comments fit on one page, the ETag of the page is recorded too, so that
+    fetching them again only downloads the comments if they have changed.
+    The state is saved to `COMMENTS_STATE_PATH`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        state = load_json(path) if os.path.exists(path) else {}
+        self.state = {int(k): v for k, v in state.items()}
+
+    def get(self, ticket_number):
+        """ Returns the {updated_at, num_comments, etag} dict for `ticket_number` or None if it wasn't
+            downloaded.
+        """
+        return self.state.get(ticket_number)
+
+    def set(self, ticket_number, updated_at, num_comments, etag=None):
+        with self.lock:
+            self.state[ticket_number] = {"updated_at": updated_at, "num_comments": num_comments,
+                                         "etag": etag}
+
+    def save(self):
+        with self.lock:
+            save_json(self.path, self.state)
+
+_comments_state = None
+
+def get_comments_state():
+    "Returns the CommentsState saved to COMMENTS_STATE_PATH, loading it on first use."
+    global _comments_state
+    with _shared_lock:
+        if _comments_state is None:
+            _comments_state = CommentsState(COMMENTS_STATE_PATH)
+        return _comments_state
+
+# The user fields kept in the author cache.
+AUTHOR_KEYS = ["id", "name", "email", "role"]
+
+class AuthorCache:
+    """
+    A persistent cache of the Zendesk users who wrote comments, saved to `AUTHORS_PATH`.
+    Ids are noted as comments are downloaded and resolved in bulk with fetch_users(), so looking up
+    an author never needs a request of its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        authors = load_json(path) if os.path.exists(path) else {}
+        self.authors = {int(k): v for k, v in authors.items()}
+        self.pending = set()
+
+    def note(self, author_ids):
+        "Records `author_ids` to be fetched by the next resolve() if they aren't in the cache."
+        with self.lock:
+            self.pending.update(a for a in author_ids if a is not None and a not in self.authors)
+
+    def resolve(self, author_ids=()):
+        """ Fetches the noted authors and `author_ids` that aren't in the cache.
+            Authors that Zendesk doesn't return are cached as None so that they aren't fetched again.
+        """
+        self.note(author_ids)
+        with self.lock:
+            todo, self.pending = self.pending, set()
+        if not todo:
+            return
+        users = {user["id"]: {k: user.get(k) for k in AUTHOR_KEYS} for user in fetch_users(todo)}
+        with self.lock:
+            for author_id in todo:
+                self.authors[author_id] = users.get(author_id)
+        print(f"   Fetched {len(users)} of {len(todo)} new comment authors")
+        self.save()
+
+    def add(self, users):
+        "Adds Zendesk `users`, e.g. users sideloaded with comments, to the cache."
+        if not users:
+            return
+        with self.lock:
+            for user in users:
+                self.authors[user["id"]] = {k: user.get(k) for k in AUTHOR_KEYS}
+                self.pending.discard(user["id"])
+
+    def get(self, author_id):
+        "Returns the cached {id, name, email, role} of user `author_id`, fetching it if it isn't cached."
+        author_id = int(author_id)
+        if author_id not in self.authors:
+            self.resolve([author_id])
+        return self.authors.get(author_id)
+
+    def save(self):
+        with self.lock:
+            save_json(self.path, self.authors)
+
+_author_cache = None
+
+def get_author_cache():
+    "Returns the AuthorCache saved to AUTHORS_PATH, loading it on first use."
+    global _author_cache
+    with _shared_lock:
+        if _author_cache is None:
+            _author_cache = AuthorCache(AUTHORS_PATH)
+        return _author_cache
+
+def comments_changed(ticket_number, updated_at):
+    """ Returns True if the comments of ticket `ticket_number`, which Zendesk last updated at
+        `updated_at`, need to be downloaded.
+    """
+    state = get_comments_state().get(ticket_number)
+    if state is None:
+        return not get_comment_store().has_ticket(ticket_number)
+    return bool(updated_at) and (not state["updated_at"] or updated_at > state["updated_at"])
+
+def download_comments(ticket_number, overwrite=False, updated_at=None):
+    """ Download the comments in Zendesk ticket `ticket_number` and save them in get_comment_store().
+        `updated_at` is the ticket's Zendesk "updated_at". If the comments were already downloaded
+        they are only fetched again if `updated_at` is later than when they were downloaded, and
+        then only the new comments are saved.
+        Comments downloaded before the comments state was recorded are assumed to be up to date.
+        Returns: The number of new comments, or None if the comments were not fetched.
+    """
+    comments_state, comment_store = get_comments_state(), get_comment_store()
+    state = comments_state.get(ticket_number)
+    if overwrite:
+        num_seen = 0
+    elif state is not None:
+        if not comments_changed(ticket_number, updated_at):
+            return None
+        num_seen = state["num_comments"]
+    elif comment_store.has_ticket(ticket_number):
+        comments_state.set(ticket_number, updated_at, comment_store.num_comments_saved(ticket_number))
+        return None
+    else:
+        num_seen = 0
+
+    # The ETag of the first page only covers all the comments if they fit on one page.
+    etag = state.get("etag") if state and not overwrite else None
+    first_page, etag = fetch_first_comment_page(ticket_number, etag)
+    if first_page is None:
+        comments_state.set(ticket_number, updated_at, num_seen, etag)
+        return None
+
+    # Comments are numbered by their position in the ticket, so new comments are appended.
+    # Each page is saved as it arrives so that huge tickets are never held in memory.
+    num_comments = 0
+    for page in iter_ticket_comment_pages(ticket_number, first_page):
+        numbered_texts = []
+        get_author_cache().note(comment.get("author_id") for comment in page[max(0, num_seen - num_comments):])
+        for i, comment in enumerate(page, start=num_comments):
+            if i < num_seen:
+                continue
+            body = comment["body"]
+            body = body.strip()
+            if not any(c.isalnum() for c in body):
+                continue
+            numbered_texts.append((i, body))
+        comment_store.save_comments(ticket_number, numbered_texts)
+        num_comments += len(page)
+    comments_state.set(ticket_number, updated_at, num_comments,
+                       etag if num_comments <= COMMENTS_PAGE_SIZE else None)
+    return max(0, num_comments - num_seen)
+
+# The number of threads used to download comments in download_all_comments().
+NUM_DOWNLOAD_WORKERS = 8
+
+def tickets_per_min(num_tickets, t0):
+    "Returns the rate in tickets per minute of processing `num_tickets` since `t0`."
+    return 60.0 * num_tickets / (since(t0) + 0.001)
+
+def download_all_comments(ticket_updates, num_workers=NUM_DOWNLOAD_WORKERS, comment_counts=None):
+    """ Downloads the comments for the tickets in `ticket_updates` with a pool of `num_workers`
+        threads.
+        `ticket_updates` is a list of (ticket_number, updated_at) pairs. Tickets that haven't
+        changed since their comments were downloaded are skipped, as in download_comments().
+        `comment_counts` is an optional dict of {ticket_number: comment_count} from tickets fetched
+        with the comment_count sideload. Changed tickets that have no new comments are skipped too.
+        Returns: The numbers of the tickets whose comments were downloaded.
+    """
+    comment_counts = comment_counts or {}
+    comments_state = get_comments_state()
+    todo = []
+    for t, u in ticket_updates:
+        if not comments_changed(t, u):
+            continue
+        state = comments_state.get(t)
+        count = comment_counts.get(t)
+        if state is not None and count is not None and count == state["num_comments"]:
+            # The ticket changed, e.g. its status, but it has no new comments.
+            comments_state.set(t, u, count, state.get("etag"))
             continue
-        path = os.path.join(folder, f"comment_{i:03d}.txt")
-        save_text(path, body)
-        has_paths = True
-    if not has_paths:
-        os.rmdir(folder)
+        todo.append((t, u))
+    print(f"   Downloading comments for {len(todo)} of {len(ticket_updates)} tickets " +
+          f"with {num_workers} workers")
+    t0 = time.time()
+    num_done = 0
+    changed = []
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        futures = {executor.submit(download_comments, t, updated_at=u): t for t, u in todo}
+        for future in as_completed(futures):
+            if future.result() is not None:
+                changed.append(futures[future])
+            num_done += 1
+            if num_done % 1_000 == 10:
+                print(f"Downloaded {num_done:6} of {len(todo)} comments in {since(t0):.1f} secs " +
+                      f"({tickets_per_min(num_done, t0):.1f} tickets per min)")
+    comments_state.save()
+    get_author_cache().resolve()
+    print(f"Downloaded {num_done} comments in {since(t0):.1f} secs " +
+          f"({tickets_per_min(num_done, t0):.1f} tickets per min)")
+    return sorted(changed)
+
+def _fill_blank(series):
+    "Returns `series` with missing values replaced by empty strings."
+    if not series.hasnans:
+        return series
+    if isinstance(series.dtype, pd.CategoricalDtype) and "" not in series.cat.categories:
+        series = series.cat.add_categories("")
+    return series.fillna("")
 
 def format_index_df(df):
     """
     Formats the `df` by sorting it based on specific columns, converting certain columns
     to appropriate data types, and filling missing values with empty strings.
+    The custom fields are expanded into one column per field and `status` and `priority` are
+    made categorical.
     """
+    df = expand_custom_fields(df)
     df["comments_num"] = df["comments_num"].astype(int)
     df["comments_size"] = df["comments_size"].astype(int)
     for column in ["status", "priority", "problem_type", "product_name", "product_version",
                    "recipient", "customer", "region", "subject"]:
-        df[column] = df[column].fillna("")
+        df[column] = _fill_blank(df[column])
     df["created_at"] = pd.to_datetime(df["created_at"])
     df["updated_at"] = pd.to_datetime(df["updated_at"])
+    df = categorise(df)
     df = df.sort_values(by=["created_at", "updated_at", "ticket_number"])
     return df
 
+class IndexBuilder:
+    """
+    Collects ticket metadata in column buffers and builds index rows in one step, instead of
+    reallocating the index DataFrame with a `df.loc` insert for every ticket.
+    A ticket that is added more than once keeps its last metadata.
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.buffers = {column: [] for column in self.columns}
+        self.ticket_numbers = []
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.ticket_numbers)
+
+    def add(self, ticket_number, metadata):
+        "Adds the `metadata` dict of ticket `ticket_number`."
+        for key in metadata.keys():
+            assert key in self.buffers, f"bad key {key}"
+        row = self.rows.get(ticket_number)
+        if row is None:
+            self.rows[ticket_number] = len(self.ticket_numbers)
+            self.ticket_numbers.append(ticket_number)
+            for column in self.columns:
+                self.buffers[column].append(metadata.get(column))
+        else:
+            for column in self.columns:
+                self.buffers[column][row] = metadata.get(column)
+
+    def items(self):
+        "Returns the added (ticket_number, metadata) pairs."
+        return [(t, {column: self.buffers[column][row] for column in self.columns})
+                for row, t in enumerate(self.ticket_numbers)]
+
+    def to_df(self):
+        "Returns the added rows as an index DataFrame."
+        index = pd.Index(self.ticket_numbers, name="ticket_number")
+        return pd.DataFrame(self.buffers, index=index, columns=self.columns)
+
+    def merge_into(self, df):
+        """ Returns index `df` with the added rows replacing any rows with the same ticket numbers,
+            formatted by format_index_df().
+        """
+        new_df = format_index_df(self.to_df())
+        if not df.empty:
+            new_df = pd.concat([df[~df.index.isin(new_df.index)], new_df])
+            new_df.index.name = "ticket_number"
+        return format_index_df(new_df)
+
+    def append_to(self, df):
+        """ Returns index `df` with the added rows, which must not already be in `df`, appended.
+            Only the new rows are formatted, so `df` is not re-sorted. load_existing_index() sorts
+            the whole index when it is next loaded.
+        """
+        new_df = format_index_df(self.to_df())
+        if df.empty:
+            return new_df
+        assert not df.index.isin(new_df.index).any(), "appended tickets are already in the index"
+        df = pd.concat([df, new_df])
+        df.index.name = "ticket_number"
+        # Concatenating categoricals with different categories gives object columns.
+        return categorise(df)
+
+def index_columns(add_custom_fields):
+    "Returns the columns of the metadata added to the index by IndexBuilder."
+    columns = METADATA_KEYS + ["comments_num", "comments_size"]
+    if add_custom_fields:
+        columns.append(CUSTOM_FIELDS_KEY)
+    return columns
+
 def make_empty_index(add_custom_fields):
     """
     Create an empty index DataFrame for tickets.
@@ -236,31 +988,96 @@ def make_empty_index(add_custom_fields):
     - df (pandas.DataFrame): An empty DataFrame with columns representing ticket metadata and custom fields (if specified).
                              The index is labeled with ticket numbers.
     """
-    columns = METADATA_KEYS + ["comments_num", "comments_size"]
-    if add_custom_fields:
-        columns.append(CUSTOM_FIELDS_KEY)
-    df = pd.DataFrame(columns=columns)
+    df = pd.DataFrame(columns=index_columns(add_custom_fields))
     df.index.name = "ticket_number"
     return df
 
-# The maximum number of pages to scroll in fetch_all_ticket_batches()
-MAX_PAGES = 10_000
-# The maximum number of tickets to fetch.
-MAX_TICKETS = 10_000_000
+def sync_start_time(df):
+    "Returns the Unix time to start an incremental export from for an index `df` with no saved cursor."
+    if df.empty:
+        return 0
+    return int(pd.to_datetime(df["updated_at"]).max().timestamp())
+
+def merge_aliases(path, aliases, ticket_numbers, partial):
+    """ Returns the alias groups `aliases` found among `ticket_numbers`. If `partial` is True,
+        `ticket_numbers` are only some of the indexed tickets, so the groups saved in `path` for the
+        other tickets are kept.
+    """
+    if not partial or not os.path.exists(path):
+        return aliases
+    ticket_set = set(ticket_numbers)
+    merged = {int(t): others for t, others in load_json(path).items() if int(t) not in ticket_set}
+    merged.update(aliases)
+    return merged
+
+def read_latest_tickets(batch_paths, in_range):
+    """ Reads the tickets for which `in_range(ticket)` is True from the batch files `batch_paths`.
+        A ticket in several batches, e.g. from a full fetch and an incremental sync, is taken from
+        the copy with the latest `updated_at`, whatever the order of the batches. Of copies with the
+        same `updated_at`, the one in the later batch is taken.
+        Returns: (latest, comment_counts, num_tickets) where
+            - latest: maps each ticket number to its (updated_at, metadata), or to None if the
+              ticket was deleted.
+            - comment_counts: maps each ticket number to its `comment_count`.
+            - num_tickets: the number of tickets read, including duplicates and those out of range.
+    """
+    latest = {}
+    updated = {}
+    comment_counts = {}
+    t0 = time.time()
+    num_tickets = 0
+    for i, path in enumerate(batch_paths):
+        for ticket in itertools.islice(iter_batch(path), MAX_TICKETS):
+            num_tickets += 1
+            if not in_range(ticket):
+                continue
+            ticket_number = ticket["id"]
+            # Zendesk's ISO 8601 UTC timestamps sort in time order.
+            updated_at = ticket.get("updated_at") or ""
+            if updated_at and updated_at < updated.get(ticket_number, ""):
+                continue
+            updated[ticket_number] = updated_at
+            if ticket.get("status") == "deleted":
+                latest[ticket_number] = None
+            else:
+                latest[ticket_number] = (ticket["updated_at"], extract_metadata(ticket))
+                comment_counts[ticket_number] = ticket.get("comment_count")
+
+            if num_tickets % 100_000 == 10_000:
+                dt = since(t0)
+                period = 10_000 * dt / (num_tickets+1)
+                print(f"Read batch {i:4}: {num_tickets:6} tickets in {dt:5.1f} secs ({period:.1f} per 10k)")
+    print(f"   Read {len(latest)} of {num_tickets} tickets from {len(batch_paths)} batches in {since(t0):.1f} secs")
+    return latest, comment_counts, num_tickets
 
-def update_index(df, min_date=None, max_date=None, do_fetch=False, clean_fetch=False):
+def update_index(df, min_date=None, max_date=None, do_fetch=False, clean_fetch=False,
+                 num_workers=NUM_DOWNLOAD_WORKERS, incremental=False, resume=False, num_shards=0):
     """
     Updates the index of Zendesk tickets in the given DataFrame.
 
     Args:
-        df (pandas.DataFrame): The DataFrame containing the ticket index.
-        min_date (datetime.date, optional): The minimum creation date of tickets to include in the index. Defaults to None.
-        max_date (datetime.date, optional): The maximum creation date of tickets to include in the index. Defaults to None.
+        df (pandas.DataFrame): The DataFrame containing the ticket index. If a date range is given,
+            this must hold at least the tickets created in the months of the range, as loaded by
+            load_create_index(add_custom_fields, min_date, max_date).
+        min_date (datetime.date, optional): The minimum creation date of tickets to include in the
+            index. Defaults to None.
+        max_date (datetime.date, optional): The maximum creation date of tickets to include in the
+            index. Defaults to None.
+            Only the batch and index partitions of the months in the range are read and written.
         do_fetch (bool, optional): Whether to fetch new ticket batches. Defaults to False.
-        clean_fetch (bool, optional): Whether to clean the existing ticket batches directory before fetching new batches. Defaults to False.
+        clean_fetch (bool, optional): Whether to clean the existing ticket batches directory before
+            fetching new batches. Defaults to False.
+        num_workers (int, optional): The number of threads used to download comments. Defaults to NUM_DOWNLOAD_WORKERS.
+        incremental (bool, optional): Whether to fetch and index only the tickets created or updated since the last
+            sync. Tickets already in `df` are updated. Defaults to False.
+        resume (bool, optional): Whether to continue an interrupted fetch from its last saved page
+            instead of fetching from the first page. Defaults to False.
+        num_shards (int, optional): If more than 1, fetch the tickets in this many concurrent
+            creation date shards with fetch_sharded_ticket_batches(). Defaults to 0.
 
     Returns:
-        tuple: A tuple containing the updated DataFrame and a dictionary of ticket aliases.
+        tuple: A tuple containing the updated DataFrame, a dictionary of ticket aliases and a list of the
+            numbers of the tickets whose comments were downloaded or changed.
     """
     def in_range(ticket):
         "Returns True if the ticket's creation date is within the specified range, False otherwise."
@@ -271,69 +1088,73 @@ def update_index(df, min_date=None, max_date=None, do_fetch=False, clean_fetch=F
             return False
         return True
 
-    if do_fetch:
-        if clean_fetch and os.path.exists(TICKET_BATCHES_DIR):
+    if clean_fetch:
+        if os.path.exists(TICKET_BATCHES_DIR):
             shutil.rmtree(TICKET_BATCHES_DIR)
+        for path in [TICKET_SYNC_CURSOR_PATH, TICKET_BACKFILL_CHECKPOINT_PATH]:
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(TICKET_BACKFILL_SHARDS_DIR):
+            shutil.rmtree(TICKET_BACKFILL_SHARDS_DIR)
+
+    if incremental:
+        os.makedirs(TICKET_BATCHES_DIR, exist_ok=True)
+        t0 = time.time()
+        batch_paths, sync_cursor = fetch_incremental_ticket_batches(sync_start_time(df), MAX_PAGES)
+        print(f"   Fetched  {len(batch_paths)} batches of changed tickets in {since(t0):.1f} secs")
+    elif do_fetch and num_shards > 1:
+        t0 = time.time()
+        fetch_sharded_ticket_batches(num_shards, min_date, max_date, MAX_PAGES, resume=resume)
+        batch_paths = _list_batches(min_date, max_date)
+        print(f"   Fetched  {len(batch_paths)} batches of tickets in {since(t0):.1f} secs")
+    elif do_fetch:
         os.makedirs(TICKET_BATCHES_DIR, exist_ok=True)
         t0 = time.time()
 
-        fetch_all_ticket_batches(TICKET_BATCHES_DIR, MAX_PAGES)
-        batch_paths = _list_batches()
+        fetch_all_ticket_batches(TICKET_BATCHES_DIR, MAX_PAGES,
+                                 checkpoint_path=TICKET_BACKFILL_CHECKPOINT_PATH, resume=resume)
+        batch_paths = _list_batches(min_date, max_date)
         print(f"   Fetched  {len(batch_paths)} batches of tickets in {since(t0):.1f} secs")
     else:
-        batch_paths = _list_batches()
+        batch_paths = _list_batches(min_date, max_date)
         print(f"   Re-using {len(batch_paths)} batches of tickets")
 
-    t0 = time.time()
-    num_tickets = 0
-    for i, batch_path in enumerate(batch_paths):
-        ticket_list = load_json(batch_path)
-        for ticket in ticket_list[:MAX_TICKETS]:
-            if not in_range(ticket):
-                continue
-            ticket_number = ticket["id"]
-            download_comments(ticket_number)
-            num_tickets += 1
-            if num_tickets % 1_000 == 10:
-                dt = since(t0)
-                rate = num_tickets / (60.0 * dt + 0.001)
-                print(f"Downloaded batch {i:4} of {num_tickets:6} comments in {dt:.1f} secs " +
-                      f"({rate:.1f} per min)")
-    print(f"Downloaded {num_tickets} comments  in {since(t0):.1f} secs")
+    latest, comment_counts, num_tickets = read_latest_tickets(batch_paths, in_range)
 
-    t0 = time.time()
-    num_tickets = 0
-    num_range = 0
-    num_processed = 0
-    for i, batch_path in enumerate(batch_paths):
-        ticket_list = load_json(batch_path)
-        for ticket in ticket_list[:MAX_TICKETS]:
-            num_tickets += 1
-            if not in_range(ticket):
-                continue
-            num_range += 1
-            ticket_number = ticket["id"]
-            if ticket_number in df.index:
-                continue
-            num_processed += 1
-            metadata = extract_metadata(ticket)
-            paths = comment_paths(ticket_number)
-            metadata["comments_num"] = len(paths)
-            metadata["comments_size"] = sum(os.path.getsize(k) for k in paths)
-            for key in metadata.keys():
-                assert key in df.columns, f"bad key {key}"
-            df.loc[ticket_number] = metadata
+    ticket_updates = [(t, value[0]) for t, value in latest.items() if value is not None]
+    changed_tickets = download_all_comments(ticket_updates, num_workers, comment_counts)
+    unsearchable = {t for t, _ in ticket_updates} - get_search_index().indexed_tickets()
+    update_search_index(sorted(unsearchable | set(changed_tickets)))
+    unhashed = {t for t, _ in ticket_updates} - get_duplicates_index().indexed_tickets()
+    update_duplicates_index(sorted(unhashed | set(changed_tickets)))
+    print(f"Writing {len(changed_tickets)} changed tickets to {CHANGED_TICKETS_PATH}")
+    save_json(CHANGED_TICKETS_PATH, changed_tickets)
 
-            if num_tickets % 100_000 == 10_000:
-                dt = since(t0)
-                period = 10_000 * dt / (num_tickets+1)
-                print(f"Indexed batch {i:4}: {num_tickets:6} metadata in {dt:5.1f} secs ({period:.1f} per 10k)")
+    # Tickets already in the index are only replaced by an incremental sync or if their comments
+    # have changed.
+    existing = set() if incremental else set(df.index) - set(changed_tickets)
+    deleted = {t for t, value in latest.items() if value is None and t not in existing}
+    builder = IndexBuilder(index_columns(add_custom_fields=True))
+    t0 = time.time()
+    for ticket_number, value in latest.items():
+        if value is None or ticket_number in existing:
+            continue
+        _, metadata = value
+        sizes = comment_sizes(ticket_number)
+        metadata["comments_num"] = len(sizes)
+        metadata["comments_size"] = sum(sizes)
+        builder.add(ticket_number, metadata)
+    num_range = len(latest)
+    num_processed = len(builder)
+    events = journal_events(df, latest, changed_tickets, existing)
 
+    df = builder.merge_into(df)
     print(f"   Indexed {num_processed } of {num_range} of {num_tickets} metadatas in {since(t0):.1f} secs")
+    if deleted:
+        df = df.drop(index=[t for t in deleted if t in df.index])
+        print(f"   Removed {len(deleted)} deleted tickets")
     print(f"   Index = {len(df)} tickets")
-    assert num_range - num_processed <= len(df)
-
-    df = format_index_df(df)
+    assert incremental or num_range - num_processed - len(deleted) <= len(df)
 
     # Some Zendesk tickets have the same subject and description, so we need to create aliases
     key_index = {}
@@ -345,58 +1166,119 @@ def update_index(df, min_date=None, max_date=None, do_fetch=False, clean_fetch=F
         else:
             key_index[idx] = row.Index
 
-    print(f"Writing {len(df)} tickets to {TICKET_INDEX_PATH}")
-    df.to_csv(TICKET_INDEX_PATH)
+    print(f"Writing {len(df)} tickets to {index_path()}")
+    save_index(df, min_date, max_date)
+    print(f"Recording {len(events)} ticket changes in {CHANGE_JOURNAL_PATH}")
+    get_change_journal().append(events)
+    if incremental:
+        save_sync_cursor(sync_cursor)
+    partial = bool(min_date or max_date)
+    reversed_aliases = merge_aliases(TICKET_ALIASES_PATH, reversed_aliases, df.index, partial)
     print(f"Writing {len(reversed_aliases)} aliases to {TICKET_ALIASES_PATH}")
     save_json(TICKET_ALIASES_PATH, reversed_aliases)
+    # Tickets with similar but not identical comments, such as forwarded emails and re-opened issues.
+    near_aliases = get_duplicates_index().aliases(df.index)
+    near_aliases = merge_aliases(TICKET_NEAR_ALIASES_PATH, near_aliases, df.index, partial)
+    print(f"Writing {len(near_aliases)} near-duplicate groups to {TICKET_NEAR_ALIASES_PATH}")
+    save_json(TICKET_NEAR_ALIASES_PATH, near_aliases)
+    print(f"Zendesk API latency (secs):\n{get_transport().latency_report()}")
 
-    return df, reversed_aliases
+    return df, reversed_aliases, changed_tickets
 
-def load_existing_index():
-    """Load the ticket index from `TICKET_INDEX_PATH` and perform necessary data transformations.
-        Crash if `TICKET_INDEX_PATH` does not exist.
+def load_existing_index(min_date=None, max_date=None, read_only=False):
+    """Load the ticket index from index_path() and perform necessary data transformations.
+        If `min_date` or `max_date` is given, only the index partitions of the months that overlap
+        the range are loaded. The index then holds every ticket created in those months, which may
+        include tickets just outside the range.
+        A CSV index or an unpartitioned Parquet index is converted to the configured INDEX_FORMAT,
+        and a long delta log is compacted, unless `read_only` is True. Processes that only read the
+        index, such as server.py, must not write it while download_tickets.py is updating it.
+        Crash if there is no stored index.
         Returns: A DataFrame containing the ticket index.
     """
-    print(f"  Reading existing tickets from {TICKET_INDEX_PATH}")
-    df = pd.read_csv(TICKET_INDEX_PATH, index_col="ticket_number")
+    path = stored_index_path()
+    if path != TICKET_INDEX_PARTITIONS_DIR:
+        # Only a partitioned index can be loaded and saved by date range.
+        min_date = max_date = None
+    print(f"  Reading existing tickets from {path}")
+    df = load_index(min_date, max_date)
     df = format_index_df(df)
-    print(f"Loaded {len(df)} tickets from {TICKET_INDEX_PATH}")
+    print(f"Loaded {len(df)} tickets from {path}")
+    delta = load_index_delta(min_date, max_date)
+    if delta:
+        builder = IndexBuilder(index_columns(add_custom_fields=True))
+        for ticket_number, metadata in delta:
+            builder.add(ticket_number, metadata)
+        df = builder.merge_into(df)
+        print(f"Merged {len(delta)} rows from the index delta log")
+    if read_only:
+        return df
+    if path != index_path():
+        print(f"Converting {path} to {index_path()}")
+        save_index(df)
+    elif len(delta) >= INDEX_DELTA_MAX_ROWS:
+        print(f"Compacting {len(delta)} delta rows into {index_path()}")
+        save_index(df, min_date, max_date)
+    return df
+
+def compact_index():
+    "Folds the rows in the index delta log into the stored index."
+    df = load_existing_index()
+    print(f"Writing {len(df)} tickets to {index_path()}")
+    save_index(df)
     return df
 
-def load_create_index(add_custom_fields):
-    """Load the ticket index from `TICKET_INDEX_PATH` and perform necessary data transformations.
-       Create an empty index if `TICKET_INDEX_PATH` does not exist.
+def load_create_index(add_custom_fields, min_date=None, max_date=None):
+    """Load the ticket index from index_path() and perform necessary data transformations.
+       Create an empty index if there is no stored index.
+       If `min_date` or `max_date` is given, only the tickets created in the months that overlap the
+       range are loaded. See load_existing_index().
         Returns: A DataFrame containing the ticket index.
     """
-    print(f"  Reading tickets from {TICKET_INDEX_PATH}")
-    if not os.path.exists(TICKET_INDEX_PATH):
+    print(f"  Reading tickets from {index_path()}")
+    if not index_exists():
         df = make_empty_index(add_custom_fields)
-        df.to_csv(TICKET_INDEX_PATH)
-        print(f"Created empty {TICKET_INDEX_PATH}")
+        save_index(df)
+        print(f"Created empty {index_path()}")
     else:
-        df = load_existing_index()
+        df = load_existing_index(min_date, max_date)
     return df
 
-def add_tickets_to_index(df, ticket_numbers):
-    "Adds the metadata for the specified `ticket_numbers` to the index `df`."
-    ticket_numbers = sorted(set(ticket_numbers))
-    new_ticket_numbers, bad_ticket_numbers = [], []
-    for ticket_number in ticket_numbers:
-        if ticket_number in df.index:
-            continue
-        ticket = fetch_ticket(ticket_number)
-        if not ticket:
-            bad_ticket_numbers.append(ticket_number)
-            continue
-        new_ticket_numbers.append(ticket_number)
-        metadata = extract_metadata(ticket)
-        download_comments(ticket_number)
-        comments_paths = comment_paths(ticket_number)
-        metadata["comments_num"] = len(comments_paths)
-        metadata["comments_size"] = sum(os.path.getsize(k) for k in comments_paths)
-        df.loc[ticket_number] = metadata
-    if new_ticket_numbers:
-        print(f"Adding {len(new_ticket_numbers)} new tickets to {TICKET_INDEX_PATH}.")
-        df = format_index_df(df)
-        df.to_csv(TICKET_INDEX_PATH)
+def add_tickets_to_index(df, ticket_numbers, num_workers=NUM_DOWNLOAD_WORKERS):
+    """ Adds the metadata for the specified `ticket_numbers` to the index `df`.
+        The tickets are fetched in batches with fetch_tickets(), their comments are downloaded
+        with a pool of `num_workers` threads, and the new rows are appended to the index delta
+        log, which is merged into the index when it is loaded.
+        Returns: df, new_ticket_numbers, bad_ticket_numbers where
+            - new_ticket_numbers: the ticket numbers that were added to the index.
+            - bad_ticket_numbers: the numbers that were not Zendesk ticket numbers.
+    """
+    todo = [t for t in sorted(set(ticket_numbers)) if t not in df.index]
+    if not todo:
+        return df, [], []
+    t0 = time.time()
+    tickets = fetch_tickets(todo)
+    print(f"   Fetched {len(tickets)} of {len(todo)} tickets in {since(t0):.1f} secs")
+    new_ticket_numbers = [t for t in todo if t in tickets]
+    bad_ticket_numbers = [t for t in todo if t not in tickets]
+    if not new_ticket_numbers:
+        return df, new_ticket_numbers, bad_ticket_numbers
+
+    # download_all_comments() saves comments_state and resolves the new comment authors.
+    download_all_comments([(t, tickets[t]["updated_at"]) for t in new_ticket_numbers], num_workers,
+                          {t: tickets[t].get("comment_count") for t in new_ticket_numbers})
+    builder = IndexBuilder(index_columns(add_custom_fields=True))
+    for ticket_number in new_ticket_numbers:
+        metadata = extract_metadata(tickets[ticket_number])
+        sizes = comment_sizes(ticket_number)
+        metadata["comments_num"] = len(sizes)
+        metadata["comments_size"] = sum(sizes)
+        builder.add(ticket_number, metadata)
+    update_search_index(new_ticket_numbers)
+    update_duplicates_index(new_ticket_numbers)
+    print(f"Adding {len(new_ticket_numbers)} new tickets to the index delta log.")
+    df = builder.append_to(df)
+    append_index_delta(builder.items())
+    get_change_journal().append([(TICKET_CREATED, t, tickets[t]["updated_at"], tickets[t]["created_at"])
+                                 for t in new_ticket_numbers])
     return df, new_ticket_numbers, bad_ticket_numbers